@@ -13,6 +13,7 @@ import webbrowser as wb
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 from cbr import CBR
 from utils import load_constraints
+from rendering import format_recipe
 
 DATA_PATH = os.path.join(os.path.dirname(__file__), '..', 'Data')
 USER_MANUAL = 'User_Manual.pdf'
@@ -202,24 +203,15 @@ class CocktailsApp():
         # Get new case
         self.retrieved_cocktail, self.adapted_cocktail, original = self.cbr.get_new_case(constraints)
             
-        # Get info about retrieved and adapted cocktails
-        or_name = self.retrieved_cocktail.find("name").text
-        print(f'\nRetrieved cocktail: {or_name}')
-        print('\nOriginal Ingredients:')
-        or_ingr_str = self.cbr.print_ingredients(self.retrieved_cocktail)
-        print('\nOriginal Preparation:')
-        or_prep_str = self.cbr.print_preparation(self.retrieved_cocktail)
-
-        ad_name = self.adapted_cocktail.find("name").text
-        print(f'\nAdapted cocktail: {ad_name}')
-        print('\nAdapted Ingredients:')
-        ad_ingr_str = self.cbr.print_ingredients(self.adapted_cocktail)
-        print('\nAdapted Preparation:')
-        ad_prep_str = self.cbr.print_preparation(self.adapted_cocktail)
+        # Get the recipes of the retrieved and adapted cocktails (cached by the CBR)
+        or_recipe = self.cbr.render_recipe(self.retrieved_cocktail)
+        ad_recipe = self.cbr.render_recipe(self.adapted_cocktail)
+        print(f'\nRetrieved cocktail: {or_recipe.name}')
+        print(f'Adapted cocktail: {ad_recipe.name}')
 
         # Output original and adapte recipe
-        self.dialog.or_recipe_text.setText(f'{or_name}\n\nIngredients:\n{or_ingr_str}\nPreparation:\n{or_prep_str}')
-        self.dialog.ad_recipe_text.setText(f'{ad_name}\n\nIngredients:\n{ad_ingr_str}\nPreparation:\n{ad_prep_str}')
+        self.dialog.or_recipe_text.setText(format_recipe(or_recipe))
+        self.dialog.ad_recipe_text.setText(format_recipe(ad_recipe))
         
         # Evaluate if cocktail is derivated (not original)
         if not original:
@@ -276,7 +268,9 @@ class CocktailsApp():
         
         try:
             # Init CBR
-            self.cbr = CBR(library_file, verbose=True)
+            cbr = CBR(library_file, verbose=True)
+            self.cbr.close()
+            self.cbr = cbr
         except Exception as e:
             # Prompt error message
             button = QtWidgets.QMessageBox.critical(self.dialog, "Library error!",
@@ -295,4 +289,6 @@ if __name__ == "__main__":
     ui_filename = 'form.ui'
     app = QtWidgets.QApplication(sys.argv)
     cocktail_app = CocktailsApp(ui_filename)
-    sys.exit(app.exec_())
\ No newline at end of file
+    exit_code = app.exec_()
+    cocktail_app.cbr.close()
+    sys.exit(exit_code)
\ No newline at end of file
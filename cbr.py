@@ -10,101 +10,337 @@ Authors:    Xavier Cucurull Salamero <xavier.cucurull@estudiantat.upc.edu>
 """
 
 from lxml import etree
-import numpy as np
 import random
 import itertools
-from collections import namedtuple
-from copy import deepcopy
+import heapq
+from collections import namedtuple, Counter
 import re
+import time
+import zlib
+
+import storage
+from storage import open_storage, LazyCaseLibrary
+from recorder import WorkloadRecorder
+from memory import MemoryReport, deep_getsizeof, lxml_tree_size, top_allocations
+from stats import IngredientCooccurrence, LibraryStatistics, load_statistics, save_statistics, names_checksum
+from usage import CaseUsage, save_usage
+from features import CaseFeatureStore, CaseRows, FeatureEncoder, MappedFeatureStore
+from rendering import RecipeCache
+from similarity import create_backend
 
 # Declare Ingredient namedtuple() 
 Ingredient = namedtuple('Ingredient', ['name', 'identifier', 'alc_type', 'basic_taste', 'measure', 'quantity', 'unit'])
 
+# Declare ConstraintError namedtuple(), with the constraint field and the values causing the error
+# kind: 'invalid' for values or names that can not be used, 'contradiction' for exclusions that
+#       contradict the positive constraints (only reported by check_constraints_batch)
+ConstraintError = namedtuple('ConstraintError', ['field', 'values', 'message', 'kind'])
+
+# Declare QueryInfo namedtuple(), with the outcome of the last call to get_new_case
+# The query is its identifier in the workload log, None if it is not recorded
+QueryInfo = namedtuple('QueryInfo', ['retrieved', 'adapted', 'original', 'similarity', 'n_retrievals', 'timings',
+                                     'query'])
+
 MAX_RETRIEVE_RETRIES = 10
 
+# Ways of choosing the ingredients added by the adaptation: by compatibility with the ingredients
+# of the cocktail (co-occurrences in the library) or only by their frequency in the library
+SUBSTITUTION_MODES = ['cooccurrence', 'frequency']
+
+# Compatibility given to an ingredient that never appears with the ingredients of the cocktail
+COMPATIBILITY_SMOOTHING = 0.1
+
+# Constraints that the retrieved cases must fulfill in strict mode
+HARD_CONSTRAINTS = ['glass_type', 'exc_ingredients', 'exc_alc_type', 'exc_basic_taste']
+
+
+class AdaptedCase:
+    """ Copy-on-write view of a cocktail being adapted.
+
+    Only the fields touched by the adaptation (name, glass, ingredients...) are stored,
+    while the preparation steps are read from the retrieved cocktail until they are edited.
+    The XML Element is only built with to_element() once the case is accepted or learned.
+    """
+
+    def __init__(self, base):
+        """ Initialize the adapted case from a cocktail Element.
+
+        Args:
+            base (Element): cocktail Element the case is derived from
+        """
+        self.base = base
+        self.name = base.find('name').text
+        self.category = base.find('category').text
+        self.glasstype = base.find('glasstype').text
+        self.utility = base.find('utility').text
+        self.derivation = base.find('derivation').text
+        self.evaluation = base.find('evaluation').text
+        self.ingredients = [Ingredient(i.text, i.get('id'), i.get('alc_type'), i.get('basic_taste'),
+                                       i.get('measure'), i.get('quantity'), i.get('unit'))
+                            for i in base.findall('ingredients/ingredient')]
+        self._steps = None
+
+    def get_steps(self):
+        """ Get the preparation steps of the case.
+
+        Returns:
+            list: preparation steps (do not modify it, use edit_steps instead)
+        """
+        if self._steps is None:
+            return [s.text for s in self.base.findall('preparation/step')]
+        return self._steps
+
+    def edit_steps(self):
+        """ Get the preparation steps of the case to modify them.
+
+        Steps are copied from the base case the first time they are edited.
+
+        Returns:
+            list: preparation steps
+        """
+        if self._steps is None:
+            self._steps = self.get_steps()
+        return self._steps
+
+    def to_element(self):
+        """ Materialize the adapted case into a new cocktail Element.
+
+        Returns:
+            Element: cocktail Element
+        """
+        cocktail = etree.Element('cocktail')
+        etree.SubElement(cocktail, 'name').text = self.name
+        etree.SubElement(cocktail, 'category').text = self.category
+        etree.SubElement(cocktail, 'glasstype').text = self.glasstype
+
+        ingredients = etree.SubElement(cocktail, 'ingredients')
+        for ingr in self.ingredients:
+            ingr_element = etree.SubElement(ingredients, 'ingredient', id=ingr.identifier,
+                                            alc_type=ingr.alc_type, basic_taste=ingr.basic_taste,
+                                            measure=ingr.measure, quantity=ingr.quantity, unit=ingr.unit)
+            ingr_element.text = ingr.name
+
+        preparation = etree.SubElement(cocktail, 'preparation')
+        for step in self.get_steps():
+            etree.SubElement(preparation, 'step').text = step
+
+        etree.SubElement(cocktail, 'utility').text = self.utility
+        etree.SubElement(cocktail, 'derivation').text = self.derivation
+        etree.SubElement(cocktail, 'evaluation').text = self.evaluation
+
+        # Keep the same layout as the cases of the library file
+        etree.indent(cocktail, space='  ', level=1)
+        cocktail.tail = self.base.tail
+
+        return cocktail
+
+
+def make_rng(rng=None):
+    """ Get the random generator of a request.
+
+    Args:
+        rng (int or random.Random, optional): seed or random generator. Defaults to None.
+
+    Returns:
+        random.Random: a new generator seeded with rng if it is a seed, rng itself if it is
+                       a generator, or the random module (global generator) if it is None
+    """
+    if rng is None:
+        return random
+    if isinstance(rng, random.Random):
+        return rng
+    return random.Random(rng)
+
+
 class CBR:
     """ Class that implements our Case Based Reasoning algorithm.
     """
     
-    def __init__(self, cbl_filename, threshold_eval=8.0, verbose=False):
+    def __init__(self, cbl_filename, threshold_eval=8.0, verbose=False, lazy=False, memory_budget=None,
+                 storage=None, record=None, mapped=False, strict=False, similarity=None,
+                 substitution='cooccurrence'):
         """ Initialize CBR.
 
         Args:
-            cbl_filename (string): filename of the XML case library
+            cbl_filename (string): filename of the XML case library, directory of a case library
+                                   sharded by category or filename of a SQLite case library
             verbose (boolean, optional): defines if execution messages are printed in the terminal. 
                                          Defaults to False.
+            lazy (boolean, optional): load the cases of each category the first time they are needed,
+                                      if the storage supports it. Defaults to False.
+            memory_budget (int, optional): in lazy mode, maximum size in bytes of the categories
+                                           kept in memory. Defaults to None (no limit).
+            storage (CaseStorage, optional): storage of the case library. Defaults to None
+                                             (chosen from cbl_filename).
+            record (str, optional): filename of a JSONL log where queries and evaluations are
+                                    recorded, to be replayed with replay.py. Defaults to None (no log).
+            mapped (boolean, optional): compute the similarities from the memory-mapped feature store
+                                        of the library (built if needed), which implies lazy loading.
+                                        Only the retrieved cases are loaded. Defaults to False.
+            strict (boolean, optional): skip the cases which violate the glass and exclusion constraints
+                                        before scoring, unless no case fulfills them. Defaults to False.
+            similarity (str, optional): name of the similarity backend (see similarity.py). Defaults to None
+                                        ("features" if the features are encoded, "reference" otherwise).
+            substitution (str, optional): how the adaptation chooses the ingredients it adds, one of
+                                          SUBSTITUTION_MODES. Defaults to "cooccurrence".
         """
+        if substitution not in SUBSTITUTION_MODES:
+            raise ValueError(f'Unknown substitution mode: {substitution}')
+
         self.cbl_filename = cbl_filename
-        self.tree = etree.parse(cbl_filename)
-        self.cocktails = self.tree.getroot()
+        self.storage = storage if storage is not None else open_storage(cbl_filename)
+        self.lazy = lazy or mapped
+        self.mapped = mapped
+        self.strict = strict
+        self.substitution = substitution
+        self.memory_budget = memory_budget
+        if self.lazy and not self.storage.supports_lazy:
+            raise ValueError('Lazy loading is not supported by the storage of the case library')
+
+        # In lazy mode there is no tree with all the cases, only the categories that are used are loaded
+        if self.lazy:
+            self.tree = None
+            self.cocktails = None
+        else:
+            self.cocktails = self.storage.load()
+            self.tree = etree.ElementTree(self.cocktails)
         self.alcohol_types = set()
         self.basic_tastes = set()
         self.glass_types = set()
         self.categories = set()
         self.cocktail_names = set()
         self.ingredients_list = []
-        self.ingredient_names = []
+        self.ingredient_names = set()
         self.threshold_eval = threshold_eval
 
         self._init_structure()
+
+        # Backend of the similarity computations
+        if similarity is None:
+            similarity = 'features' if self.features is not None else 'reference'
+        self.similarity_backend = create_backend(similarity, self)
         
         self.verboseprint = print if verbose else lambda *a, **k: None
 
+        # Opt-in recording of the workload
+        self.recorder = WorkloadRecorder(record) if record else None
+
+        # Statistics of the case library, loaded or computed when they are first requested
+        self.statistics = None
+        self.statistics_checked = False
+
+        # Co-occurrences of the ingredients, counted the first time an ingredient is chosen by compatibility
+        self.cooccurrence = None
+
+        # Outcome of the last query (QueryInfo)
+        self.last_query = None
+
+        # Retrievals and additions of cases since the usage of the library was last saved
+        self.usage = CaseUsage()
+
+        # Rendered recipes of the most used cocktails
+        self.recipes = RecipeCache()
+
     def _init_structure(self):
         """ Initialize library structure
         
         Parse cocktails tree and extract relevant information such as 
         the unique categories, alcohol types, ingredients, etc.
+
+        In lazy mode, this information is read from the vocabularies of the storage.
         """
-        # Get unique categories
-        self.categories = set([c.find('category').text for c in self.cocktails])
+        if self.lazy:
+            shards = self.storage.load_vocabularies()
+
+            # Get unique categories, cocktail names and glass types
+            self.categories = set(shards)
+            self.cocktail_names = set(itertools.chain.from_iterable([s['names'] for s in shards.values()]))
+            self.glass_types = set(itertools.chain.from_iterable([s['glass_types'] for s in shards.values()]))
+
+            # Get the ingredients catalog from the ingredients (and their counts) of each category
+            self.ingredients_catalog = Counter()
+            for shard in shards.values():
+                for name, alc_type, basic_taste, measure, quantity, unit, count in shard['ingredients']:
+                    self.ingredients_catalog[Ingredient(name, None, alc_type, basic_taste,
+                                                        measure, quantity, unit)] += count
+        else:
+            # Get unique categories
+            self.categories = set([c.find('category').text for c in self.cocktails])
 
-        # Get unique cocktail names
-        self.cocktail_names = set([c.find('name').text for c in self.cocktails])
+            # Get unique cocktail names
+            self.cocktail_names = set([c.find('name').text for c in self.cocktails])
+
+            # Get unique values for glass type
+            self.glass_types = set([c.find('glasstype').text for c in self.cocktails])
+
+            # Get the ingredients catalog: one entry per ingredient variant (name, types and measure)
+            # together with the number of times it appears in the case library
+            self.ingredients_catalog = Counter(
+                [Ingredient(i.text, None, i.get('alc_type'), i.get('basic_taste'),
+                            i.get('measure'), i.get('quantity'), i.get('unit'))
+                 for i in self.cocktails.findall('cocktail/ingredients/ingredient')])
+
+        # Checksum of the case names, updated when cases are added so that it is never recomputed
+        self.names_checksum = names_checksum(self.cocktail_names)
+
+        # Sorted catalog, so that the random choices of a seed do not depend on the storage of the library
+        self.ingredients_list = sorted(self.ingredients_catalog, key=lambda i: tuple([v or '' for v in i]))
+
+        # Get unique values for alcohol types and basic tastes, removing the empty type
+        self.alcohol_types = set([i.alc_type for i in self.ingredients_list]) - {''}
+        self.basic_tastes = set([i.basic_taste for i in self.ingredients_list]) - {''}
+        self.ingredient_names = set([i.name for i in self.ingredients_list])
+
+        # Get catalog entries of each ingredient name
+        self.ingredients_by_name = {}
+        for ingr in self.ingredients_list:
+            self.ingredients_by_name.setdefault(ingr.name, []).append(ingr)
 
-        # Get unique values for glass type
-        self.glass_types = set([c.find('glasstype').text for c in self.cocktails])
-        
-        # Get unique values for alcohol types
-        self.alcohol_types.update(
-            [i.attrib['alc_type'] for i in self.cocktails.findall('cocktail/ingredients/ingredient')])
-        self.alcohol_types.remove('')  # remove empty type
-
-        # Get unique values for basic taste
-        self.basic_tastes.update(
-            [i.attrib['basic_taste'] for i in self.cocktails.findall('cocktail/ingredients/ingredient')])
-        self.basic_tastes.remove('')  # remove empty type
-        
         # Get dicts of alcohol types and basic tastes
         self.alcohol_dict = {atype: set() for atype in self.alcohol_types}
         self.basic_dict = {btype: set() for btype in self.basic_tastes}
 
-        # Get ingredients of each alcohol type
-        for atype in self.alcohol_types:
-            self.alcohol_dict[atype].update(
-                set([i.text for i in self.cocktails.findall('cocktail/ingredients/ingredient')
-                     if i.attrib['alc_type'] == atype]))
-
-        # Get ingredients of each basic taste
-        for btaste in self.basic_tastes:
-            self.basic_dict[btaste].update(
-                set([i.text for i in self.cocktails.findall('cocktail/ingredients/ingredient')
-                     if i.attrib['basic_taste'] == btaste]))
-            
-        # Get all ingredients
-        self.ingredients_list = [Ingredient(i.text, i.get('id'), i.get('alc_type'), i.get('basic_taste'), 
-                                            i.get('measure'), i.get('quantity'), i.get('unit')) 
-                                 for i in self.cocktails.findall('cocktail/ingredients/ingredient')]
-        self.ingredient_names = [i.name for i in self.ingredients_list]
+        # Get ingredients of each alcohol type and of each basic taste
+        for ingr in self.ingredients_list:
+            if ingr.alc_type in self.alcohol_dict:
+                self.alcohol_dict[ingr.alc_type].add(ingr.name)
+            if ingr.basic_taste in self.basic_dict:
+                self.basic_dict[ingr.basic_taste].add(ingr.name)
+
+        # Define an index of the cases by name (in lazy mode, each loaded category has its own index)
+        if not self.lazy:
+            self.cases_by_name = {c.find('name').text: c for c in self.cocktails}
+
+        # Encode the features used by the similarity (in lazy mode, the cases are read from the Elements
+        # unless the features are memory-mapped)
+        if not self.lazy:
+            self.features = CaseFeatureStore.from_cases(self.cocktails)
+        elif self.mapped:
+            self.features = MappedFeatureStore.open(self.cbl_filename, self.names_checksum,
+                                                    self._load_case)
+            if self.features is None:
+                # Encode the cases one category at a time, so that the library is never fully loaded
+                cases = (c for cat in sorted(self.categories) for c in self.storage.load_category(cat))
+                self.features = MappedFeatureStore.build(self.cbl_filename, cases, self._load_case)
+        else:
+            self.features = None
+
+        # Encoder of the constraint checks, which shares the vocabularies of the features (if any)
+        self.encoder = self.features if self.features is not None else FeatureEncoder()
 
         # Define history for all cases in case library, containing number of successes and failures
         self.cases_history = {}
-        [self.cases_history.update({c.find("name").text:[0,0]}) for c in self.cocktails]
+        [self.cases_history.update({name: [0, 0]}) for name in self.cocktail_names]
 
         # Define a structure that stores all the cases of the dataset divided by category
-        self.library_by_category = {}
-        [self.library_by_category.update({cat: [c for c in self.cocktails
-                                                if c.find('category').text == cat]}) for cat in self.categories]
+        if self.lazy:
+            self.library_by_category = LazyCaseLibrary(self.storage, sorted(self.categories), self.memory_budget)
+        else:
+            # Categories are sorted and their cases kept in library order, so that iterating them does not
+            # depend on the order of the categories set
+            self.library_by_category = {cat: [] for cat in sorted(self.categories)}
+            for c in self.cocktails:
+                self.library_by_category[c.find('category').text].append(c)
 
         # Define weight structure
         self.similarity_weights = {}
@@ -145,18 +381,155 @@ class CBR:
         print(self.similarity_weights)
         return self.similarity_weights
 
+    def get_statistics(self):
+        """ Get the statistics of the case library (frequencies and unique counts).
+
+        They are read from the cache next to the case library if it is up to date,
+        otherwise they are computed in a single pass and cached.
+
+        Returns:
+            LibraryStatistics: statistics of the case library
+        """
+        if self.statistics is None and not self.statistics_checked:
+            self.statistics = load_statistics(self.cbl_filename, self.names_checksum)
+            self.statistics_checked = True
+
+        if self.statistics is None:
+            cases = self.storage.load() if self.lazy else self.cocktails
+            self.statistics = LibraryStatistics.from_cases(cases)
+            save_statistics(self.cbl_filename, self.statistics)
+
+        return self.statistics
+
+    def get_cooccurrence(self):
+        """ Get the co-occurrences of the ingredients of the case library.
+
+        They are counted in a single pass over the cases the first time they are needed
+        (one category at a time in lazy mode), and updated when cases are learned.
+
+        Returns:
+            IngredientCooccurrence: co-occurrences of the ingredients
+        """
+        if self.cooccurrence is None:
+            if self.lazy:
+                cases = (c for cat in sorted(self.categories) for c in self.storage.load_category(cat))
+            else:
+                cases = self.cocktails
+            self.cooccurrence = IngredientCooccurrence.from_cases(cases)
+
+        return self.cooccurrence
+
+    def memory_report(self, baseline=None):
+        """ Break down the memory used by the structures of the CBR.
+
+        Python structures are measured with a deep-size walk, and the lxml tree with an
+        approximation of its libxml2 nodes. If tracemalloc is tracing, the traced memory
+        and the largest allocation sites of the CBR modules are also reported.
+
+        Args:
+            baseline (MemoryReport, optional): previous report, to compute the growth of each
+                                               structure per case learned since then. Defaults to None.
+
+        Returns:
+            MemoryReport: bytes of each structure, number of cases, traced memory and growth per case
+        """
+        if self.lazy:
+            tree_cases = itertools.chain.from_iterable(
+                [self.library_by_category[cat] for cat in self.library_by_category.loaded_categories()])
+            library_by_category = (self.library_by_category._cache, self.library_by_category._indexes)
+            cases_by_name = None
+        else:
+            tree_cases = [self.cocktails]
+            library_by_category = self.library_by_category
+            cases_by_name = self.cases_by_name
+
+        # Shared objects are counted once, in the first structure that references them
+        seen = set()
+        sizes = {'tree': lxml_tree_size(tree_cases)}
+        for name, structure in [('ingredients_catalog', self.ingredients_catalog),
+                                ('ingredients_list', self.ingredients_list),
+                                ('ingredient_names', self.ingredient_names),
+                                ('ingredients_by_name', self.ingredients_by_name),
+                                ('alcohol_dict', self.alcohol_dict),
+                                ('basic_dict', self.basic_dict),
+                                ('library_by_category', library_by_category),
+                                ('cases_by_name', cases_by_name),
+                                ('cocktail_names', self.cocktail_names),
+                                ('cases_history', self.cases_history),
+                                ('failure_parents', self.failure_parents),
+                                ('features', self.features),
+                                ('recipes', self.recipes),
+                                ('cooccurrence', self.cooccurrence)]:
+            sizes[name] = deep_getsizeof(structure, seen)
+
+        # tracemalloc is only imported for the report, not by the queries
+        import tracemalloc
+
+        n_cases = len(self.cocktail_names)
+        traced = tracemalloc.get_traced_memory() if tracemalloc.is_tracing() else None
+        allocations = top_allocations([__file__, storage.__file__]) if traced is not None else []
+
+        growth_per_case = None
+        if baseline is not None and n_cases > baseline.n_cases:
+            growth_per_case = {name: (size - baseline.sizes[name]) / (n_cases - baseline.n_cases)
+                               for name, size in sizes.items()}
+
+        return MemoryReport(sizes, n_cases, traced, allocations, growth_per_case)
+
+    def _choose_ingredient(self, candidates, rng=random, cocktail=None):
+        """ Choose a random ingredient from a list of catalog entries.
+
+        Each entry is weighted by its number of occurrences in the case library,
+        so the choice follows the same distribution as picking a random ingredient
+        line of a random cocktail.
+
+        If a cocktail is given and the substitution mode is "cooccurrence", the weights are
+        also multiplied by the compatibility of each ingredient with the ingredients of the
+        cocktail, so the ingredients that often appear with them are preferred.
+
+        Args:
+            candidates (list): list of Ingredient entries of the catalog
+            rng (random.Random, optional): random generator of the request. Defaults to the random module.
+            cocktail (AdaptedCase, optional): cocktail the ingredient is added to. Defaults to None.
+
+        Returns:
+            Ingredient: chosen ingredient
+        """
+        weights = [self.ingredients_catalog[ingr] for ingr in candidates]
+
+        if cocktail is not None and self.substitution == 'cooccurrence':
+            cooccurrence = self.get_cooccurrence()
+            names = [ingr.name for ingr in cocktail.ingredients]
+            weights = [w * (COMPATIBILITY_SMOOTHING + cooccurrence.compatibility(ingr.name, names))
+                       for w, ingr in zip(weights, candidates)]
+
+        return rng.choices(candidates, weights=weights)[0]
+
+    def render_recipe(self, cocktail):
+        """ Get the recipe of the given cocktail, without printing it.
+
+        Recipes are cached, so the cocktails that are retrieved often are only rendered once.
+
+        Args:
+            cocktail (Element): cocktail Element
+
+        Returns:
+            Recipe: structured recipe, with its ingredients and preparation as text
+        """
+        return self.recipes.get(cocktail)
+
     def print_ingredients(self, cocktail):
         """ Print the ingredients (with measures) of the given cocktail.
 
         Args:
             cocktail (Element): cocktail Element
+
+        Returns:
+            str: printed ingredients, one per line
         """
-        ingr_str = ""
-        
-        for i in cocktail.findall('ingredients/ingredient'):
-            print(f'{i.get("measure")} {i.text}')
-            ingr_str += f'{i.get("measure")} {i.text}\n'
-        
+        ingr_str = self.render_recipe(cocktail).ingredients_text
+        print(ingr_str, end='')
+
         return ingr_str
             
     def print_preparation(self, cocktail):
@@ -164,26 +537,28 @@ class CBR:
 
         Args:
             cocktail (Element): cocktail Element
+
+        Returns:
+            str: printed steps, one per line
         """
-        prep_str = ""
-        
-        for s in cocktail.findall('preparation/step'):
-            step = s.text
-            for i in cocktail.findall('ingredients/ingredient'):
-                ingr_pattern = r"\b({})\b".format(i.get('id'))
-                step = re.sub(ingr_pattern, i.text, step)
-            prep_str += f'{step}\n'
-            print(step)
-            
+        prep_str = self.render_recipe(cocktail).preparation_text
+        print(prep_str, end='')
+
         return prep_str
 
-    def get_new_case(self, constraints):
+    def get_new_case(self, constraints, rng=None):
         """ Retrieve and adapt a cocktail that fulfills the given constraints.
 
         If the adapted cocktail is considered a failure, repeat the process.
+
+        All the random choices of the request (ties of the retrieval and ingredients and glasses
+        of the adaptation) are drawn from rng, so that a request with a given seed gets the same
+        result regardless of the requests run before it or in parallel.
         
         Args:
             constraints (dict): constraints to be fulfilled
+            rng (int or random.Random, optional): seed or random generator of the request.
+                                                  Defaults to None, which uses the random module.
             
         Returns:
             retrieved_case (Element): Element of the retrieved cocktail from the library
@@ -192,20 +567,41 @@ class CBR:
         """
         retrieve = True
         max_iter = MAX_RETRIEVE_RETRIES
+        adapted_case = None
+        start_time = time.perf_counter()
+        timings = {'retrieval': 0.0, 'adaptation': 0.0}
+
+        # Only integer seeds are recorded, generators cannot be replayed
+        seed = rng if isinstance(rng, int) else None
+        rng = make_rng(rng)
+
+        # Cases are scored once, each retry moves to the next best untried case
+        ranking = self._rank_cases(constraints, rng)
         
         while retrieve and max_iter:
             # RETRIEVAL PHASE
-            retrieved_case = self._retrieval(constraints)
+            phase_time = time.perf_counter()
+            candidate_case, candidate_similarity = self._retrieval(constraints, ranking, return_similarity=True)
+            timings['retrieval'] += time.perf_counter() - phase_time
+
+            # No more cases to try, keep the last adapted case
+            if candidate_case is None:
+                if adapted_case is None:
+                    raise ValueError('No case of the library can be retrieved for the given constraints')
+                break
+            retrieved_case = candidate_case
+            similarity = candidate_similarity
             
             # ADAPTATION PHASE
-            adapted_case, n_changes = self._adaptation(constraints, retrieved_case)
+            phase_time = time.perf_counter()
+            adapted_case, n_changes = self._adaptation(constraints, retrieved_case, rng)
                 
             if n_changes > 0:
                 # Learn from errors, avoid making a previously FAILED adaptation
                 if self._check_adapted_failure(adapted_case):
-                    adapted_case.get('evaluation').text = "Failure"
+                    adapted_case.evaluation = "Failure"
                     ev_score = 0.0
-                    self._learning(retrieved_case, adapted_case, ev_score)
+                    self._learning(retrieved_case, adapted_case.to_element(), ev_score)
                     
                     self.verboseprint(f'[CBR] Error: adapted case is a failure. Getting new case...')
                 
@@ -229,19 +625,40 @@ class CBR:
                 for err in constraints_err:
                     self.verboseprint(f'[CBR] {err}')
 
+            timings['adaptation'] += time.perf_counter() - phase_time
             max_iter -= 1
             
-        original =  adapted_case.find('derivation').text.lower() == 'original'
+        original = adapted_case.derivation.lower() == 'original'
+
+        # Only the returned adapted case is converted into an XML Element
+        adapted_case = adapted_case.to_element()
+
+        timings['total'] = time.perf_counter() - start_time
+        retrieved_name, adapted_name = retrieved_case.find('name').text, adapted_case.find('name').text
+        n_retrievals = MAX_RETRIEVE_RETRIES - max_iter
+        self.usage.record_retrieval(retrieved_name)
+
+        query_id = None
+        if self.recorder is not None:
+            query_id = self.recorder.record_query(constraints, retrieved_name, adapted_name, original, n_retrievals,
+                                                  timings, seed)
+
+        self.last_query = QueryInfo(retrieved_name, adapted_name, original, similarity, n_retrievals, timings,
+                                    query_id)
         
         return retrieved_case, adapted_case, original
     
-    def evaluate_new_case(self, retrieved_case, adapted_case, score):
+    def evaluate_new_case(self, retrieved_case, adapted_case, score, query=None):
         """ Evaluate new cocktail using the score given by the user.
         
         The evaluation will affect the learning phase.
 
         Args:
-            constraints (dict): constraints to be fulfilled
+            retrieved_case (Element): retrieved cocktail returned by get_new_case
+            adapted_case (Element): adapted cocktail returned by get_new_case
+            score (float): evaluation score given by the user
+            query (int, optional): identifier of the query of the cases in the workload log (QueryInfo.query).
+                                   Defaults to None (the last query, if it returned this adapted case).
         """
         # Original cocktails are not evaluated
         if adapted_case.find('derivation').text.lower() != 'original':
@@ -256,102 +673,38 @@ class CBR:
                 self.verboseprint(f'[CBR] Cocktail evaluation: Failure')
             
             # LEARNING PHASE
+            start_time = time.perf_counter()
             self._learning(retrieved_case, adapted_case, score)
+
+            if self.recorder is not None:
+                if query is None and self.last_query is not None and \
+                        self.last_query.adapted == adapted_case.find('name').text:
+                    query = self.last_query.query
+                self.recorder.record_evaluation(query, retrieved_case.find('name').text,
+                                                adapted_case.find('name').text, score,
+                                                adapted_case.find('evaluation').text,
+                                                {'learning': time.perf_counter() - start_time})
             
     def _evaluate_constraints_fulfillment(self, constraints, cocktail):
         """ Check that a cocktail fulfills all the requiered constraints.
 
         Args:
             constraints (dict): constraints to fulfill
-            cocktail (Element): cocktail Element to evaluate
+            cocktail (Element or AdaptedCase): cocktail to evaluate
             
         Returns:
             (boolean): True if no errors found
             (list): list of the found errors (if any)
         """
-        ckt_category = cocktail.find('category').text
-        ckt_glass = cocktail.find('glasstype').text
-        ckt_ingredients = [i.text for i in cocktail.findall('ingredients/ingredient')]
-        ckt_alc_types = [i.get('alc_type') for i in cocktail.findall('ingredients/ingredient')]
-        ckt_basic_tastes = [i.get('basic_taste') for i in cocktail.findall('ingredients/ingredient')]
-
-        cnst_categories = constraints.get('category')
-        cnst_glass = constraints.get('glass_type')
-        cnst_ingredients = constraints.get('ingredients')
-        cnst_alc_types = constraints.get('alc_type')
-        cnst_basic_tastes = constraints.get('basic_taste')
-        cnst_exc_ingredients = constraints.get('exc_ingredients')
-        cnst_exc_alc_types = constraints.get('exc_alc_type')
-        cnst_exc_basic_tastes = constraints.get('exc_basic_taste')
-
-        evaluation = []
-        evaluation_results = []
-
-        # Check cocktail category
-        if cnst_categories:
-            if ckt_category in cnst_categories:
-                evaluation.append(True)
-            else:
-                evaluation.append(False)
-                evaluation_results.append('Category constraint failed')
+        if not isinstance(cocktail, AdaptedCase):
+            cocktail = AdaptedCase(cocktail)
 
-        # Check glass type
-        if cnst_glass:
-            if ckt_glass in cnst_glass:
-                evaluation.append(True)
-            else:
-                evaluation.append(False)
-                evaluation_results.append('Glass constraint failed')
+        # Compare the bitsets of the cocktail with the masks of the required, allowed and forbidden values
+        evaluation_results = self.encoder.fulfillment_errors(
+            constraints, cocktail.category, cocktail.glasstype,
+            [(i.name, i.alc_type, i.basic_taste) for i in cocktail.ingredients])
 
-        # Check that cocktail contains ingredients
-        if cnst_ingredients:
-            if all(i in ckt_ingredients for i in cnst_ingredients):
-                evaluation.append(True)
-            else:
-                evaluation.append(False)
-                evaluation_results.append('Ingredients constraint failed')
-
-        # Check that cocktail does not contain any of the excluded ingredients
-        if cnst_exc_ingredients:
-            if not any(i in ckt_ingredients for i in cnst_exc_ingredients):
-                evaluation.append(True)
-            else:
-                evaluation.append(False)
-                evaluation_results.append('Excluded ingredients constraint failed')
-
-        # Check alc_type
-        if cnst_alc_types:
-            if all(i in ckt_alc_types for i in cnst_alc_types):
-                evaluation.append(True)
-            else:
-                evaluation.append(False)
-                evaluation_results.append('Alcohol types constraint failed')
-
-        # Check that cocktail does not contain any of the excluded alcohol types
-        if cnst_exc_alc_types:
-            if not any(i in ckt_alc_types for i in cnst_exc_alc_types):
-                evaluation.append(True)
-            else:
-                evaluation.append(False)
-                evaluation_results.append('Excluded alcohol types constraint failed')
-
-        # Check basic_taste
-        if cnst_basic_tastes:
-            if all(i in ckt_basic_tastes for i in cnst_basic_tastes):
-                evaluation.append(True)
-            else:
-                evaluation.append(False)
-                evaluation_results.append('Basic tastes constraint failed')
-
-        # Check that cocktail does not contain any of the excluded alcohol types
-        if cnst_exc_basic_tastes:
-            if not any(i in ckt_basic_tastes for i in cnst_exc_basic_tastes):
-                evaluation.append(True)
-            else:
-                evaluation.append(False)
-                evaluation_results.append('Excluded basic tastes constraint failed')
-
-        return False not in evaluation, evaluation_results
+        return not evaluation_results, evaluation_results
 
     def _check_adapted_failure(self, adapted_case):
         """ Check if adapted case can be considred a failure.
@@ -360,35 +713,38 @@ class CBR:
         and its evaluation is Failure, evaluate the adapted_case as failure.
         
         Args:
-            adapted_case (Element): cocktail Element
+            adapted_case (Element or AdaptedCase): adapted cocktail
 
         Returns:
             boolean: True if failure, false otherwise
         """
-        searching_list = list(itertools.chain.from_iterable([self.library_by_category[adapted_case.find('category').text]]))
+        if not isinstance(adapted_case, AdaptedCase):
+            adapted_case = AdaptedCase(adapted_case)
+
         constraints = {'glass_type': [], 'basic_taste': [], 'ingredients': [], 'exc_ingredients': [], 'alc_type': [],
-                       'category': adapted_case.find('category').text}
-        constraints['glass_type'].append(adapted_case.find('glasstype').text)
+                       'category': adapted_case.category}
+        constraints['glass_type'].append(adapted_case.glasstype)
         
         # A constraint is created to reuse the _compute_similarity function
-        for ingr in adapted_case.findall('ingredients/ingredient'):
-            constraints['ingredients'].append(ingr.text)
-            if ingr.get('alc_type') not in constraints['alc_type'] and ingr.get('alc_type') != "":
-                constraints['alc_type'].append(ingr.get('alc_type'))
-            if ingr.get('basic_taste') not in constraints['basic_taste'] and ingr.get('basic_taste') != "":
-                constraints['basic_taste'].append(ingr.get('basic_taste'))
+        for ingr in adapted_case.ingredients:
+            constraints['ingredients'].append(ingr.name)
+            if ingr.alc_type not in constraints['alc_type'] and ingr.alc_type != "":
+                constraints['alc_type'].append(ingr.alc_type)
+            if ingr.basic_taste not in constraints['basic_taste'] and ingr.basic_taste != "":
+                constraints['basic_taste'].append(ingr.basic_taste)
         
         # Compute similarities with the adapted case
-        sim_list = [self._compute_similarity(constraints, c) for c in searching_list]
+        searching_list, sim_list = self._similarities(constraints, [adapted_case.category], limit=1)
         
         # Retrieve case with higher similarity
-        max_indices = np.argwhere(np.array(sim_list) == np.amax(np.array(sim_list))).flatten().tolist()
+        max_sim = max(sim_list)
+        max_indices = [idx for idx, sim in enumerate(sim_list) if sim == max_sim]
         
         list_failures = [searching_list[cocktail_idx].find('evaluation').text for cocktail_idx in max_indices]
         
         # If the adapted case is very similar to a previously failed one
         # it returns failure (True)
-        if max(sim_list) > 0.95 and "Failure" in list_failures:
+        if max_sim > 0.95 and "Failure" in list_failures:
             return True
         return False
 
@@ -400,49 +756,80 @@ class CBR:
             adapted_case (Element): case resulting from adaptation phase, which has been evaluated
             ev_score (float): evaluation score given by the user
         """            
-        # MANAGING UTILITY SCORE OF THE RETRIEVED CASE
-        # Update the cases_history of the retrieved case based on the status
-        # If the adapted case is a success, according to the human oracle
-        if adapted_case.find('evaluation').text == "Success":
-            self.cases_history[retrieved_case.find("name").text][0] += 0.1 * ev_score
-        # If the adapted case is a failure, according to the human oracle
-        elif adapted_case.find('evaluation').text == "Failure":
-            self.cases_history[retrieved_case.find("name").text][1] += 0.1 * ev_score
-            self.failure_parents.append(adapted_case.find("name").text)
-
-        # Compute utility score for retrieved_case
-        utility_score = (self.cases_history[retrieved_case.find("name").text][0] -
-                         self.cases_history[retrieved_case.find("name").text][1] + 1) / 2
-
-        # If utility score is 0.0, set retrieved case as Failure
-        if utility_score == 0.0 and retrieved_case.find("evaluation").text == "Success":
-            for c in self.cocktails:
-                if c.find("name").text == retrieved_case.find("name").text:
-                    c.find("evaluation").text = "Failure"
-                    et = etree.ElementTree(self.cocktails)
-                    et.write(self.cbl_filename, pretty_print=True, encoding="UTF-8")
-                    break
-            '''
-            self.cocktails.remove(retrieved_case)
-            rem = self.cases_history.pop([retrieved_case.find("name").text], None)
-            if rem == None:
-                print("ERROR: You are trying to delete a cocktail that doesn't exist in the cases_history structure")
-            self.library_by_category[retrieved_case.find("category").text] = self.library_by_category[retrieved_case.find("category").text].remove(retrieved_case)
-            '''
-        # Otherwise, update retrieved case utility score if the computed utility score has changed
-        elif str(utility_score) != retrieved_case.find("utility").text:
-            for c in self.cocktails:
-                if c.find("name").text == retrieved_case.find("name").text:
-                    c.find("utility").text = str(utility_score)
-                    et = etree.ElementTree(self.cocktails)
-                    et.write(self.cbl_filename, pretty_print=True, encoding="UTF-8")
-                    break
+        # Lock the case library and merge the changes made by other processes before modifying it
+        with self.storage.transaction() as external_cases:
+            self._merge_external_cases(external_cases)
+
+            # MANAGING UTILITY SCORE OF THE RETRIEVED CASE
+            # Update the cases_history of the retrieved case based on the status
+            # If the adapted case is a success, according to the human oracle
+            if adapted_case.find('evaluation').text == "Success":
+                self.cases_history[retrieved_case.find("name").text][0] += 0.1 * ev_score
+            # If the adapted case is a failure, according to the human oracle
+            elif adapted_case.find('evaluation').text == "Failure":
+                self.cases_history[retrieved_case.find("name").text][1] += 0.1 * ev_score
+                self.failure_parents.append(adapted_case.find("name").text)
+
+            # Compute utility score for retrieved_case
+            utility_score = (self.cases_history[retrieved_case.find("name").text][0] -
+                             self.cases_history[retrieved_case.find("name").text][1] + 1) / 2
+
+            # Case of the library, the retrieved Element may come from a category evicted since then
+            library_case = self._find_case(retrieved_case.find("name").text, retrieved_case.find("category").text)
+
+            # If utility score is 0.0, set retrieved case as Failure
+            if utility_score == 0.0 and retrieved_case.find("evaluation").text == "Success":
+                if library_case is not None:
+                    library_case.find("evaluation").text = "Failure"
+                    self.storage.update_case(library_case, self.library_by_category[library_case.find("category").text])
+                    self._case_modified(library_case)
+                '''
+                self.cocktails.remove(retrieved_case)
+                rem = self.cases_history.pop([retrieved_case.find("name").text], None)
+                if rem == None:
+                    print("ERROR: You are trying to delete a cocktail that doesn't exist in the cases_history structure")
+                self.library_by_category[retrieved_case.find("category").text] = self.library_by_category[retrieved_case.find("category").text].remove(retrieved_case)
+                '''
+            # Otherwise, update retrieved case utility score if the computed utility score has changed
+            elif str(utility_score) != retrieved_case.find("utility").text:
+                if library_case is not None:
+                    library_case.find("utility").text = str(utility_score)
+                    self.storage.update_case(library_case, self.library_by_category[library_case.find("category").text])
+                    self._case_modified(library_case)
+
+            # Initialize utility of adapted_case to 0.1 * evaluation_score
+            adapted_case.find("utility").text = str(0.1 * ev_score)
+
+            # Add new adapted_case to case library
+            self._update_case_library(adapted_case)
+
+            # Persist the changes of the features, while the library is locked
+            if self.features is not None:
+                self.features.save()
+
+            self.save_usage()
+
+    def close(self):
+        """ Save the usage of the cases and close the workload log, if any.
+        """
+        self.save_usage()
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
 
-        # Initialize utility of adapted_case to 0.1 * evaluation_score
-        adapted_case.find("utility").text = str(0.1 * ev_score)
+    def __enter__(self):
+        return self
 
-        # Add new adapted_case to case library
-        self._update_case_library(adapted_case)
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def save_usage(self):
+        """ Add the retrievals and additions of cases since the last save to the usage of the case library,
+        which is used by maintenance.py to find the cases that have not been used for a long time.
+        """
+        if self.usage.last_used:
+            save_usage(self.cbl_filename, self.usage)
+            self.usage = CaseUsage()
 
     def _update_case_library(self, new_case):
         """ Update the case_library with a new case
@@ -455,31 +842,158 @@ class CBR:
 
         # If cocktail already in library, just update utility measure
         if new_case.find('name').text in self.cocktail_names:
-            for c in self.cocktails:
-                if c.find('name').text == new_case.find('name'):
-                    break
-                
-            c.find("utility").text = new_case.find("utility").text
-            self.verboseprint(f"[CBR] update utility of {new_case.find('name')}")
+            c = self._find_case(new_case.find('name').text, new_case.find("category").text)
+            if c is not None:
+                c.find("utility").text = new_case.find("utility").text
+                self.storage.update_case(c, self.library_by_category[c.find("category").text])
+                self._case_modified(c)
+                self.verboseprint(f"[CBR] update utility of {new_case.find('name').text}")
             
         else:
-            # Add new case to XML    
-            index_to_insert = self.cocktails.index(self.library_by_category[new_case.find("category").text][-1])
-            self.cocktails.insert(index_to_insert+1, new_case)
-            et = etree.ElementTree(self.cocktails)
-            et.write(self.cbl_filename, pretty_print=True, encoding="UTF-8")
-
-            # Add new cocktail name
-            self.cocktail_names.add(new_case.find('name').text)
-            
-            # Update case_history with the adapted case:
-            self.cases_history.update({new_case.find('name').text: [0, 0]})
-            
-            # Update library_by_category
-            self.library_by_category[new_case.find("category").text].append(new_case)
+            # Statistics of the library before the new case (if cached), which are updated incrementally.
+            # The cache is read once, a missing or outdated cache is recomputed by get_statistics
+            if self.statistics is None and not self.statistics_checked:
+                self.statistics = load_statistics(self.cbl_filename, self.names_checksum)
+                self.statistics_checked = True
+            statistics = self.statistics
+
+            self._insert_case(new_case)
+            self.usage.record_addition(new_case.find('name').text)
+
+            # Write the case library
+            self.storage.add_case(new_case, self.library_by_category[new_case.find("category").text])
+
+            if statistics is not None:
+                statistics.add_case(new_case)
+                save_statistics(self.cbl_filename, statistics)
             
             self.verboseprint(f"[CBR] {new_case.find('name').text} added to case library ")
             
+    def _insert_case(self, new_case):
+        """ Insert a new case in the in-memory structures of the case library.
+
+        Args:
+            new_case (Element): new cocktail element
+        """
+        # Add new case to XML after the last case of its category (in lazy mode there is only
+        # the list of cases of the category, whose name index is extended on the next lookup)
+        if self.cocktails is not None:
+            category_cases = self.library_by_category[new_case.find("category").text]
+            if category_cases:
+                category_cases[-1].addnext(new_case)
+            else:
+                self.cocktails.append(new_case)
+            self.cases_by_name[new_case.find('name').text] = new_case
+
+        # Encode the features of the new case, extending the vocabularies if needed
+        if self.features is not None:
+            self.features.append(new_case)
+
+        # Count the co-occurrences of its ingredients (if they are already counted)
+        if self.cooccurrence is not None:
+            self.cooccurrence.add_case(new_case)
+
+        # A recipe rendered with the same name (e.g. when the case was adapted) is no longer valid
+        self.recipes.invalidate(new_case.find('name').text)
+
+        # Add new cocktail name
+        self._add_case_name(new_case.find('name').text)
+
+        # Update case_history with the adapted case:
+        self.cases_history.update({new_case.find('name').text: [0, 0]})
+
+        # Update library_by_category
+        self.library_by_category[new_case.find("category").text].append(new_case)
+
+    def _case_modified(self, case):
+        """ Update the structures derived from a case of the library after modifying it in place.
+
+        Args:
+            case (Element): modified cocktail Element
+        """
+        if self.features is not None:
+            self.features.update(case)
+        self.recipes.invalidate(case.find('name').text)
+
+    def _load_case(self, name, category):
+        """ Load a case of the library, reading only this case if its category is not loaded.
+
+        Args:
+            name (str): cocktail name
+            category (str): cocktail category
+
+        Returns:
+            Element: cocktail Element, None if there is no case with this name
+        """
+        if category in self.library_by_category.loaded_categories():
+            return self.library_by_category.find_case(category, name)
+
+        return self.storage.load_case(name, category)
+
+    def _add_case_name(self, name):
+        """ Add a case name to the names of the case library and to their checksum.
+
+        Args:
+            name (str): cocktail name
+        """
+        if name not in self.cocktail_names:
+            self.cocktail_names.add(name)
+            self.names_checksum = (self.names_checksum + names_checksum([name])) % 2**32
+
+    def _find_case(self, name, category):
+        """ Find a case of the case library by its name.
+
+        Args:
+            name (str): cocktail name
+            category (str): cocktail category, used in lazy mode to look up only its cases
+
+        Returns:
+            Element: cocktail Element of the library, None if there is no case with this name
+        """
+        if self.lazy:
+            return self.library_by_category.find_case(category, name)
+
+        return self.cases_by_name.get(name)
+
+    def _merge_external_cases(self, external_cases):
+        """ Merge the cases added or modified in the storage by other processes.
+
+        Args:
+            external_cases (list): cocktail Elements read from the storage
+        """
+        for case in external_cases:
+            name = case.find('name').text
+            category = case.find('category').text
+
+            # In lazy mode, categories that are not loaded will be read from the storage when needed
+            if self.lazy and category not in self.library_by_category.loaded_categories():
+                if self.mapped and name not in self.cocktail_names:
+                    self.features.append(case)
+                elif self.mapped:
+                    self.features.update(case)
+                self._add_case_name(name)
+                self.cases_history.setdefault(name, [0, 0])
+
+            else:
+                # In lazy mode, a loaded category can contain cases written by other processes
+                # whose names were not reported yet, so cases are looked up instead of their names
+                c = self._find_case(name, category)
+
+                # Update utility and evaluation of a known case
+                if c is not None:
+                    c.find('utility').text = case.find('utility').text
+                    c.find('evaluation').text = case.find('evaluation').text
+                    self._case_modified(c)
+                    self._add_case_name(name)
+                    self.cases_history.setdefault(name, [0, 0])
+
+                # Add a case learned by another process
+                else:
+                    self._insert_case(case)
+                    if self.statistics is not None:
+                        self.statistics.add_case(case)
+                    self.verboseprint(f"[CBR] {name} added to case library by another process")
+
     def _compute_similarity(self, constraints, cocktail):
         """ Compute the similarity between a set of constraints and a particular cocktail.
 
@@ -637,78 +1151,132 @@ class CBR:
 
         return normalized_sim * float(cocktail.find("utility").text)
 
-    def _retrieval(self, constraints):
-        """ Retrieve most appropriate cocktail given the provided constraints.
-        
+    def _similarities(self, constraints, categories, skip_failures=False, limit=None, hard_constraints=None):
+        """ Compute the similarity between a set of constraints and the cases of some categories.
+
+        The similarity is computed by the similarity backend of the CBR: from the encoded
+        features of the cases if there are any, otherwise by reading each case with _compute_similarity.
+
+        Args:
+            constraints (dict): dictionary of constraints
+            categories (list): categories of the cases, all the cases if it is empty
+            skip_failures (boolean, optional): skip the cases which are failures and parents of failures.
+                                               Defaults to False.
+            limit (int, optional): number of most similar cases needed. A memory-mapped feature store
+                                   only returns them (and their ties), otherwise all the cases are
+                                   returned. Defaults to None.
+            hard_constraints (dict, optional): constraints that the cases must fulfill to be scored.
+                                               Defaults to None.
+
+        Returns:
+            searching_list (list): cocktail Elements of the cases, which are loaded when accessed
+                                   if the features are memory-mapped
+            sim_list (list): similarity of each case
+        """
+        return self.similarity_backend.similarities(constraints, categories, skip_failures, limit,
+                                                    hard_constraints)
+
+    def _rank_cases(self, constraints, rng=random):
+        """ Rank the cases of the library given the provided constraints.
+
         It does a structured search by first filtering by the category.
         Then, the architecture is like a flat memory.
 
+        Similarities are computed in a single pass and the cases are yielded lazily,
+        from the most similar to the least similar one. Ties are broken randomly, by a seeded
+        hash of the case names, so that the order of the cases scored by the similarity backend
+        does not change the result.
+
+        In strict mode, the cases which violate the glass or exclusion constraints are not
+        scored, unless none of them fulfills those constraints.
+
         Args:
-            constraints (ditc): dictionary of constraints
+            constraints (dict): dictionary of constraints
+            rng (random.Random, optional): random generator used to break ties. Defaults to the random module.
 
-        Returns:
-            retrieved_case (Element): retrieved cocktail Element
-        """
-        # SEARCHING PHASE
-        # Filter elements that correspond to the category constraint
-        # If category constraints is not empty
-        if constraints['category']:
-            searching_list = list(itertools.chain.from_iterable([self.library_by_category[cat]
-                                                                 for cat in constraints['category']]))
-        else:
-            searching_list = [child for child in self.cocktails]
+        Yields:
+            (Element, float): cocktail Element and its similarity with the constraints
+        """
+        # SEARCHING AND SELECTION PHASES
+        # Filter the cases of the categories of the constraints (all the cases if there are none)
+        # and compute their similarity with the constraints
+        hard_constraints = None
+        if self.strict:
+            hard_constraints = {key: constraints.get(key) for key in HARD_CONSTRAINTS}
+        searching_list, sim_list = self._similarities(constraints, constraints['category'], skip_failures=True,
+                                                      limit=MAX_RETRIEVE_RETRIES,
+                                                      hard_constraints=hard_constraints)
+
+        # If no case fulfills the hard constraints, fall back to scoring all the cases
+        if hard_constraints and not sim_list:
+            self.verboseprint('[CBR] No case fulfills the hard constraints, scoring all the cases')
+            searching_list, sim_list = self._similarities(constraints, constraints['category'],
+                                                          skip_failures=True, limit=MAX_RETRIEVE_RETRIES)
+
+        # Order the cases by decreasing similarity, the salt of the hash selects randomly between ties
+        salt = rng.getrandbits(32)
+        ranking = [(-sim, idx) for idx, sim in enumerate(sim_list)]
+        heapq.heapify(ranking)
+
+        while ranking:
+            # Pop all the cases tied with the most similar one, only their names are read
+            neg_sim, index_retrieved = heapq.heappop(ranking)
+            ties = [index_retrieved]
+            while ranking and ranking[0][0] == neg_sim:
+                ties.append(heapq.heappop(ranking)[1])
+
+            if isinstance(searching_list, CaseRows):
+                names = searching_list.case_names(ties)
+            else:
+                names = [searching_list[idx].find('name').text for idx in ties]
+            tie_keys = {idx: (zlib.crc32(name.encode('utf-8'), salt), name) for idx, name in zip(ties, names)}
 
-        # Keep only the cases which are not failure nor parents of failures
-        searching_list = [c for c in searching_list if searching_list[searching_list.index(c)].find("evaluation").text != "Failure"
-                    or searching_list[searching_list.index(c)].find("name").text not in set(self.failure_parents)]
+            for index_retrieved in sorted(ties, key=tie_keys.get):
+                yield searching_list[index_retrieved], sim_list[index_retrieved]
 
-        # SELECTION PHASE
-        # Compute similarity with each of the cocktails of the searching list
-        sim_list = [self._compute_similarity(constraints, c) for c in searching_list]
+    def _retrieval(self, constraints, ranking=None, return_similarity=False):
+        """ Retrieve most appropriate cocktail given the provided constraints.
 
-        # Retrieve case with higher similarity
-        max_indices = np.argwhere(np.array(sim_list) == np.amax(np.array(sim_list))).flatten().tolist()
-        
-        # If there is more than one case with the same highest similarity (ties), one will be selected randomly
-        if len(max_indices) > 1:
-            index_retrieved = random.choice(max_indices)
-        else:
-            index_retrieved = max_indices[0]
-        retrieved_case = searching_list[index_retrieved]
+        If a ranking from _rank_cases is given, the next best untried case
+        of the ranking is retrieved instead of scoring the library again.
+
+        Args:
+            constraints (ditc): dictionary of constraints
+            ranking (generator, optional): ranking of the cases for the constraints. Defaults to None.
+            return_similarity (boolean, optional): also return the similarity of the retrieved case.
+                                                   Defaults to False.
+
+        Returns:
+            retrieved_case (Element): retrieved cocktail Element, None if there are no cases left
+            similarity (float): similarity of the retrieved case, only if return_similarity is True
+        """
+        if ranking is None:
+            ranking = self._rank_cases(constraints)
+
+        retrieved_case, similarity = next(ranking, (None, None))
+        if retrieved_case is None:
+            return (None, None) if return_similarity else None
 
         # Informing the user about what the CBR system is doing
         self.verboseprint(f"[CBR] Retrieved case: {retrieved_case.find('name').text}")
         # Informing the user about the similarity of the retrieved case
-        self.verboseprint(f"[CBR] Similarity between constraints and retrieved case: {sim_list[index_retrieved]}")
+        self.verboseprint(f"[CBR] Similarity between constraints and retrieved case: {similarity}")
         
+        if return_similarity:
+            return retrieved_case, similarity
         return retrieved_case
 
-    def _create_ingr_element(self, ingredient, cocktail, ingr_id):
-        """ Convert an Ingredient Named Tuple to an ingredient XML element
-
-        Args:
-            ingredient (namedtuple): ingredient namedtuple
-        """
-        ingr_element = etree.SubElement(cocktail.find("ingredients"), "ingredient",
-                                        id=ingr_id, alc_type=ingredient.alc_type,
-                                        basic_taste=ingredient.basic_taste,
-                                        measure=ingredient.measure,
-                                        quantity=ingredient.quantity,
-                                        unit=ingredient.unit)
-        ingr_element.text = ingredient.name
-
-        return ingr_element
-
-    def _add_ingredient_by_type(self, cocktail, constraints, idx_ingr, ingr_type, type):
+    def _add_ingredient_by_type(self, cocktail, constraints, idx_ingr, ingr_type, type, rng=random):
         """ Adds an ingredient from the database to a cocktail given its alc_type or basic_taste
 
         Args:
-            cocktail: cocktail in which we aim to add the ingredient
+            cocktail (AdaptedCase): cocktail in which we aim to add the ingredient
             constraints(dict): dictionary of constraints to be fulfilled by the cocktail,
                                used in order to avoid adding excluded ingredients
             idx_ingr (int): corresponding ingredient index to the ingredient we are including
             ingr_type (str): concrete alc_type or basic_taste of the ingredient we aim to add
             type (str): "alc_type" or "basic_taste", depending of the type of the ingredient we aim to add
+            rng (random.Random, optional): random generator of the request. Defaults to the random module.
         """
         if type == "alc_type":
             possible_ingr = [ingredient_to_add for ingredient_to_add in self.ingredients_list if
@@ -721,75 +1289,82 @@ class CBR:
 
         # Choose a random ingredient with this ingredient_type from the database, excluding the non-desired ones
         if len(possible_ingr)>0:
-            ingredient_to_add = random.choice(possible_ingr)
+            ingredient_to_add = self._choose_ingredient(possible_ingr, rng, cocktail)
 
             # Add it to the recipe with a new index
-            to_add = self._create_ingr_element(ingredient_to_add, cocktail, "ingr" + str(idx_ingr))
-            cocktail.find("ingredients").append(to_add)
+            to_add = ingredient_to_add._replace(identifier="ingr" + str(idx_ingr))
+            cocktail.ingredients.append(to_add)
 
             # Informing the user about what the CBR system is doing
-            self.verboseprint(f'[CBR] I added {to_add.text} to the recipe to fulfil your {ingr_type} positive constraint\n')
+            self.verboseprint(f'[CBR] I added {to_add.name} to the recipe to fulfil your {ingr_type} positive constraint\n')
 
             # New step to the recipe in which we include the added ingredient to the cocktail
-            step = etree.SubElement(cocktail.find("preparation"), "step")
-            step.text = "Add ingr" + str(idx_ingr) + " to the cocktail."
-            cocktail.find("preparation").append(step)
+            cocktail.edit_steps().append("Add ingr" + str(idx_ingr) + " to the cocktail.")
 
     def _remove_ingredient(self, cocktail, ingredient):
         """ Removes a concrete ingredient from a cocktail and
         adapts the corresponding steps of the solution (preparation).
 
         Args:
-            cocktail (Element): cocktail Element from which we aim to remove an ingredient
-            ingredient (Element): ingredient to remove
+            cocktail (AdaptedCase): cocktail from which we aim to remove an ingredient
+            ingredient (Ingredient): ingredient to remove
 
         """
-        cocktail.find("ingredients").remove(ingredient)
+        cocktail.ingredients.remove(ingredient)
+
+        ingr_pattern = r"\b({})\b".format(ingredient.identifier)
+        other_patterns = [r"\b({})\b".format(ingr.identifier) for ingr in cocktail.ingredients]
+
+        # Steps are only copied if one of them contains the excluded ingredient
+        if not any(re.search(ingr_pattern, step) for step in cocktail.get_steps()):
+            return
+
+        # Adapt the steps that contain the excluded ingredient
+        new_steps = []
+        for step in cocktail.get_steps():
+            if not re.search(ingr_pattern, step):
+                new_steps.append(step)
 
-        # Adapt the step that contains the excluded ingredient
-        for step in cocktail.find("preparation"):
             # If there is any other ingredient in the step, remove only the excluded one
-            if ingredient.get('id') in step.text and \
-                    any([ingr in step for ingr in cocktail.find("ingredients")]):
-                
-                # Remove ingredient id in step
-                ingr_pattern = r"\b({})\b".format(ingredient.get('id'))
-                step = re.sub(ingr_pattern, "", step)
-                
-            # If the excluded is the only ingredient in the step, remove the whole step from the recipe
-            elif ingredient.get('id') in step.text:
-                cocktail.find("preparation").remove(step)
+            elif any(re.search(pattern, step) for pattern in other_patterns):
+                new_steps.append(re.sub(ingr_pattern, "", step))
 
-    def _adaptation(self, constraints, retrieved_cocktail):
+            # If the excluded is the only ingredient in the step, the whole step is removed from the recipe
+
+        cocktail.edit_steps()[:] = new_steps
+
+    def _adaptation(self, constraints, retrieved_cocktail, rng=random):
         """ Adapt the ingredients and steps of the preparation for the best retrieved case
         following the constraints fixed by the user
 
         Args:
             constraints (dict): dictionary of constraints to be fulfilled
             retrieved_cocktail (Element): retrieved cocktail element that needs to be adapted
+            rng (random.Random, optional): random generator of the request. Defaults to the random module.
 
         Returns:
-            adapted_cocktail (Element): Element of the adapted cocktail from the retrieved one
+            adapted_cocktail (AdaptedCase): adapted cocktail from the retrieved one, use
+                                            to_element() to get its XML Element
             n_changes (int): number of changes needed to adapt the solution of the case
         """
 
-        adapted_cocktail = deepcopy(retrieved_cocktail)
+        adapted_cocktail = AdaptedCase(retrieved_cocktail)
         n_changes = 0
 
         # Change the name of the cocktail according to the constraints
         if constraints["name"]:
-            adapted_cocktail.find("name").text = constraints["name"]
+            adapted_cocktail.name = constraints["name"]
         else:
-            adapted_cocktail.find("name").text += "2.0"
+            adapted_cocktail.name += "2.0"
 
         # Save the derivation parameter for the adapted case
-        adapted_cocktail.find("derivation").text = retrieved_cocktail.find("name").text
+        adapted_cocktail.derivation = retrieved_cocktail.find("name").text
 
         # If glass does not fulfill constraint, change it
         if len(constraints["glass_type"]):
-            if adapted_cocktail.find("glasstype").text not in constraints["glass_type"]:
-                this_glass = random.choice(constraints["glass_type"])
-                adapted_cocktail.find("glasstype").text = this_glass
+            if adapted_cocktail.glasstype not in constraints["glass_type"]:
+                this_glass = rng.choice(constraints["glass_type"])
+                adapted_cocktail.glasstype = this_glass
                 n_changes += 1
 
                 # Informing the user about what the CBR system is doing
@@ -797,54 +1372,54 @@ class CBR:
 
         # REMOVE ingredients that are in the exclude ingredients constraint
         if len(constraints["exc_ingredients"]):
-            for ingr in adapted_cocktail.find("ingredients"):
-                if ingr.text in constraints["exc_ingredients"]:
+            for ingr in list(adapted_cocktail.ingredients):
+                if ingr.name in constraints["exc_ingredients"]:
                     self._remove_ingredient(cocktail=adapted_cocktail, ingredient=ingr)
                     n_changes += 1
 
                     # Informing the user about what the CBR system is doing
-                    self.verboseprint(f'[CBR] I removed {ingr.text} from the recipe to fulfill your '
+                    self.verboseprint(f'[CBR] I removed {ingr.name} from the recipe to fulfill your '
                                       f'negative constraint\n')
 
         # REMOVE alcohol types that are in the exclude alcohol types constraint
         if len(constraints["exc_alc_type"]):
-            for ingr in adapted_cocktail.find("ingredients"):
-                if ingr.get("alc_type") in constraints["exc_alc_type"]:
+            for ingr in list(adapted_cocktail.ingredients):
+                if ingr.alc_type in constraints["exc_alc_type"]:
                     self._remove_ingredient(cocktail=adapted_cocktail, ingredient=ingr)
                     n_changes += 1
 
                     # Informing the user about what the CBR system is doing
-                    self.verboseprint(f'[CBR] I removed {ingr.text} from the recipe to fulfill your '
-                                      f'{ingr.get("alc_type")} negative constraint\n')
+                    self.verboseprint(f'[CBR] I removed {ingr.name} from the recipe to fulfill your '
+                                      f'{ingr.alc_type} negative constraint\n')
 
         # REMOVE basic tastes that are in the exclude basic tastes constraint
         if len(constraints["exc_basic_taste"]):
-            for ingr in adapted_cocktail.find("ingredients"):
-                if ingr.get("basic_taste") in constraints["exc_basic_taste"]:
+            for ingr in list(adapted_cocktail.ingredients):
+                if ingr.basic_taste in constraints["exc_basic_taste"]:
                     self._remove_ingredient(cocktail=adapted_cocktail, ingredient=ingr)
                     n_changes += 1
 
                     # Informing the user about what the CBR system is doing
-                    self.verboseprint(f'[CBR] I removed {ingr.text} from the recipe to fulfill your '
-                                      f'negative {ingr.get("basic_taste")} constraint\n')
+                    self.verboseprint(f'[CBR] I removed {ingr.name} from the recipe to fulfill your '
+                                      f'negative {ingr.basic_taste} constraint\n')
 
         # Define an index for the ingredients in order to avoid repetitions in the indexes when adding new ingredients
-        idx_ingr = 2*len(adapted_cocktail.find("ingredients"))
+        idx_ingr = 2*len(adapted_cocktail.ingredients)
 
         # If a desired alcohol type / basic taste is not in the recipe, ADD an ingredient of this type from the database
         for alcohol in constraints["alc_type"]:
             # If the desired alcohol type it is not in the recipe, add some ingredient from this type
-            if alcohol not in [ingr.get("alc_type") for ingr in adapted_cocktail.find("ingredients")]:
+            if alcohol not in [ingr.alc_type for ingr in adapted_cocktail.ingredients]:
                 self._add_ingredient_by_type(cocktail=adapted_cocktail, constraints=constraints, idx_ingr=idx_ingr,
-                                            ingr_type=alcohol, type="alc_type")
+                                            ingr_type=alcohol, type="alc_type", rng=rng)
                 idx_ingr += 1
                 n_changes += 1
 
         for taste in constraints["basic_taste"]:
             # If the desired basic taste it is not in the recipe, add some ingredient from this type
-            if taste not in [ingr.get("basic_taste") for ingr in adapted_cocktail.find("ingredients")]:
+            if taste not in [ingr.basic_taste for ingr in adapted_cocktail.ingredients]:
                 self._add_ingredient_by_type(cocktail=adapted_cocktail, constraints=constraints, idx_ingr=idx_ingr,
-                                            ingr_type=taste, type="basic_taste")
+                                            ingr_type=taste, type="basic_taste", rng=rng)
                 idx_ingr += 1
                 n_changes += 1
 
@@ -852,7 +1427,7 @@ class CBR:
         # Taking into account that the one we substitute is not another "mandatory" ingredient desired by the user
         for ingre in constraints["ingredients"]:
             # If the desired ingredient is already in the cocktail we skip this constraint and check the following one
-            if ingre in [ingr.text for ingr in adapted_cocktail.find("ingredients")]:
+            if ingre in [ingr.name for ingr in adapted_cocktail.ingredients]:
                 # Informing the user about what the CBR system is doing
                 self.verboseprint(f'[CBR] Ingredient {ingre} is already in the recipe, no changes needed')
                 continue
@@ -860,133 +1435,163 @@ class CBR:
             # Otherwise, we try to substitute some ingredient of the same type or add it directly
             else:
                 # Choose a random ingredient (with different quantities and indexes) with this name
-                possible_ingr = [ingredient_to_add for ingredient_to_add in self.ingredients_list if
-                                 ingredient_to_add.name == ingre]
-                ingredient_to_add = random.choice(possible_ingr)
+                possible_ingr = self.ingredients_by_name.get(ingre, [])
+                ingredient_to_add = self._choose_ingredient(possible_ingr, rng)
 
                 # If we are including a non-alcoholic ingredient
                 if ingredient_to_add.alc_type == "":
                     # Store all the non-alcoholic ingredients in the recipe with the same basic_taste than the desired
                     # and that are not one of the desired ingredients
-                    without_alcohol = [ingr for ingr in adapted_cocktail.find("ingredients") if
-                                       ingr.get("basic_taste") == ingredient_to_add.basic_taste and
-                                       ingr.text not in constraints["ingredients"]]
-
-                    if len(without_alcohol) > 0:
-                        # If we have any possible ingredients to be substituted, we SUBSTITUTE one by the desired
-                        ingr = random.choice(without_alcohol)
-                        adapted_cocktail.find("ingredients").remove(ingr)
-                        to_add = self._create_ingr_element(ingredient_to_add, adapted_cocktail, ingr.get('id'))
-                        adapted_cocktail.find("ingredients").append(to_add)
-
-                        n_changes += 1
-
-                        # Informing the user about what the CBR system is doing
-                        self.verboseprint(f'[CBR] I substituted {ingr.text} by {to_add.text} because they are from the '
-                                          f'same type {ingredient_to_add.basic_taste}, to fulfill your positive '
-                                          f'constraint')
-
-                    else:
-                        # If there is none ingredient of that basic taste we directly ADD the desired one
-                        to_add = self._create_ingr_element(ingredient_to_add, adapted_cocktail, "ingr" + str(idx_ingr))
-                        adapted_cocktail.find("ingredients").append(to_add)
-                        # ADD also a step concerning this ingredient to the recipe
-                        step = etree.SubElement(adapted_cocktail.find("preparation"), "step")
-                        step.text = "Add ingr" + str(idx_ingr) + " to the cocktail."
-
-                        idx_ingr += 1
-                        n_changes += 1
-
-                        # Informing the user about what the CBR system is doing
-                        self.verboseprint(f'[CBR] I added {ingredient_to_add.name} to the recipe to fulfill your '
-                                          f'positive constraint')
+                    candidates = [ingr for ingr in adapted_cocktail.ingredients if
+                                  ingr.basic_taste == ingredient_to_add.basic_taste and
+                                  ingr.name not in constraints["ingredients"]]
+                    same_type = ingredient_to_add.basic_taste
 
                 # If we are including an alcoholic ingredient
                 else:
                     # Store all the alcoholic ingredients in the recipe with the same alcohol type than the desired
                     # and that are not one of the desired ingredients
-                    with_alcohol = [ingr for ingr in adapted_cocktail.find("ingredients") if
-                                    ingr.get('alc_type') == ingredient_to_add.alc_type and
-                                    ingr.text not in constraints["ingredients"]]
-
-                    if len(with_alcohol) > 0:
-                        # If we have any possible ingredients to be substituted, we SUBSTITUTE one by the desired
-                        ingr = random.choice(with_alcohol)
-                        adapted_cocktail.find("ingredients").remove(ingr)
-                        to_add = self._create_ingr_element(ingredient_to_add, adapted_cocktail, ingr.get('id'))
-                        adapted_cocktail.find("ingredients").append(to_add)
-                        n_changes += 1
-
-                        # Informing the user about what the CBR system is doing
-                        self.verboseprint(f'[CBR] I substituted {ingr.text} by {to_add.text} because they are from '
-                                          f'the same type {ingredient_to_add.alc_type}, to fulfill your positive '
-                                          f'constraint')
+                    candidates = [ingr for ingr in adapted_cocktail.ingredients if
+                                  ingr.alc_type == ingredient_to_add.alc_type and
+                                  ingr.name not in constraints["ingredients"]]
+                    same_type = ingredient_to_add.alc_type
+
+                if len(candidates) > 0:
+                    # If we have any possible ingredients to be substituted, we SUBSTITUTE one by the desired
+                    ingr = rng.choice(candidates)
+                    adapted_cocktail.ingredients.remove(ingr)
+                    to_add = ingredient_to_add._replace(identifier=ingr.identifier)
+                    adapted_cocktail.ingredients.append(to_add)
+                    n_changes += 1
 
-                    else:
-                        # If there is none ingredient of that alcohol type we directly ADD the desired one
-                        to_add = self._create_ingr_element(ingredient_to_add, adapted_cocktail, "ingr" + str(idx_ingr))
-                        adapted_cocktail.find("ingredients").append(to_add)
+                    # Informing the user about what the CBR system is doing
+                    self.verboseprint(f'[CBR] I substituted {ingr.name} by {to_add.name} because they are from '
+                                      f'the same type {same_type}, to fulfill your positive constraint')
 
-                        # ADD also a step concerning this ingredient to the recipe
-                        step = etree.SubElement(adapted_cocktail.find("preparation"), "step")
-                        step.text = "Add ingr" + str(idx_ingr) + " to the cocktail."
-                        adapted_cocktail.find("preparation").append(step)
+                else:
+                    # If there is none ingredient of that type we directly ADD the desired one
+                    to_add = ingredient_to_add._replace(identifier="ingr" + str(idx_ingr))
+                    adapted_cocktail.ingredients.append(to_add)
 
-                        idx_ingr += 1
-                        n_changes += 1
+                    # ADD also a step concerning this ingredient to the recipe
+                    adapted_cocktail.edit_steps().append("Add ingr" + str(idx_ingr) + " to the cocktail.")
 
-                        # Informing the user about what the CBR system is doing
-                        self.verboseprint(f'[CBR] I added {ingredient_to_add.name} to the recipe to fulfill your '
-                                          f'positive constraint')
+                    idx_ingr += 1
+                    n_changes += 1
+
+                    # Informing the user about what the CBR system is doing
+                    self.verboseprint(f'[CBR] I added {ingredient_to_add.name} to the recipe to fulfill your '
+                                      f'positive constraint')
 
         # If there were no changes and we are giving the user the original cocktail, give the original name
         if n_changes == 0:
-            adapted_cocktail.find("name").text = retrieved_cocktail.find("name").text
+            adapted_cocktail.name = retrieved_cocktail.find("name").text
 
         return adapted_cocktail, n_changes
 
-    def check_constraints(self, constraints):
-        """ Check that constraints contain valid values.
+    def _validate_constraints(self, constraints, contradictions=False):
+        """ Check that constraints contain valid values and, optionally, do not contradict each other.
 
         Args:
             constraints (dictionary): constraints to fulfill
+            contradictions (boolean, optional): also report the exclusions that contradict the positive
+                                                constraints. Defaults to False.
+
+        Returns:
+            list: list of ConstraintError found (if any)
         """
         errors = []
-        
+
         # Check name
-        if constraints['name'] in self.cocktail_names:
-            errors.append('Name already in use')
-        
-        # Check categories
-        if not all([i in self.categories for i in constraints['category']]):
-            errors.append('Some invalid categories')
-        
-        # Check glass type:
-        if not all([i in self.glass_types for i in constraints['glass_type']]):
-            errors.append('Some invalid glass types')
-            
-        # Check ingredients:
-        if not all([i in self.ingredient_names for i in constraints['ingredients']]):
-            errors.append('Some invalid ingredients')
-        
-        # Check basic tastes:
-        if not all([i in self.basic_tastes for i in constraints['basic_taste']]):
-            errors.append('Some invalid basic tastes')
-        
-        # Check alcohol types:
-        if not all([i in self.alcohol_types for i in constraints['alc_type']]):
-            errors.append('Some invalid alcohol types')
-            
-        # Check exc ingredients:
-        if not all([i in self.ingredient_names for i in constraints['exc_ingredients']]):
-            errors.append('Some invalid exc ingredients')
-        
-        # Check exc alcohol types:
-        if not all([i in self.alcohol_types for i in constraints['exc_alc_type']]):
-            errors.append('Some invalid exc alcohol types')
-            
-        # Check exc basic tastes:
-        if not all([i in self.basic_tastes for i in constraints['exc_basic_taste']]):
-            errors.append('Some invalid exc basic tastes')
+        if constraints.get('name') in self.cocktail_names:
+            errors.append(ConstraintError('name', [constraints['name']], 'Name already in use', 'invalid'))
+
+        # Check that values are in the vocabularies
+        for field, vocabulary, message in [('category', self.categories, 'Some invalid categories'),
+                                           ('glass_type', self.glass_types, 'Some invalid glass types'),
+                                           ('ingredients', self.ingredient_names, 'Some invalid ingredients'),
+                                           ('basic_taste', self.basic_tastes, 'Some invalid basic tastes'),
+                                           ('alc_type', self.alcohol_types, 'Some invalid alcohol types'),
+                                           ('exc_ingredients', self.ingredient_names, 'Some invalid exc ingredients'),
+                                           ('exc_alc_type', self.alcohol_types, 'Some invalid exc alcohol types'),
+                                           ('exc_basic_taste', self.basic_tastes, 'Some invalid exc basic tastes')]:
+            invalid = [i for i in constraints.get(field) or [] if i not in vocabulary]
+            if invalid:
+                errors.append(ConstraintError(field, invalid, message, 'invalid'))
+
+        if contradictions:
+            errors.extend(self._find_contradictions(constraints))
+
+        return errors
+
+    def _find_contradictions(self, constraints):
+        """ Find the exclusions that contradict the positive constraints, directly or through
+        the types of any variant of the requested ingredients.
+
+        Args:
+            constraints (dictionary): constraints to fulfill
+
+        Returns:
+            list: list of ConstraintError of kind 'contradiction' (if any)
+        """
+        errors = []
+        ingredients = constraints.get('ingredients') or []
+        alc_types = set(constraints.get('alc_type') or [])
+        basic_tastes = set(constraints.get('basic_taste') or [])
+
+        # Types of the requested ingredients, which can not be excluded either
+        for ingr in ingredients:
+            alc_types.update([i.alc_type for i in self.ingredients_by_name.get(ingr, []) if i.alc_type])
+            basic_tastes.update([i.basic_taste for i in self.ingredients_by_name.get(ingr, []) if i.basic_taste])
+
+        # Check contradictions between positive and exclusion constraints
+        for field, positive, message in [('exc_ingredients', set(ingredients),
+                                          'Some excluded ingredients are also requested'),
+                                         ('exc_alc_type', alc_types,
+                                          'Some excluded alcohol types are also requested'),
+                                         ('exc_basic_taste', basic_tastes,
+                                          'Some excluded basic tastes are also requested')]:
+            contradictions = [i for i in constraints.get(field) or [] if i in positive]
+            if contradictions:
+                errors.append(ConstraintError(field, contradictions, message, 'contradiction'))
+
+        return errors
+
+    def check_constraints(self, constraints):
+        """ Check that constraints contain valid values.
+
+        Args:
+            constraints (dictionary): constraints to fulfill
+
+        Returns:
+            list: messages of the found errors (if any)
+        """
+        return [err.message for err in self._validate_constraints(constraints)]
+
+    def check_constraints_batch(self, all_constraints):
+        """ Check a whole set of constraints, such as the ones of a tests constraints file.
+
+        Besides the invalid values of each set of constraints, the exclusions that contradict
+        its positive constraints and the names repeated in the batch are reported.
+
+        Args:
+            all_constraints (dict or list): sets of constraints, indexed by their key
+
+        Returns:
+            dict: list of ConstraintError of each set of constraints, indexed by the same keys
+        """
+        if not isinstance(all_constraints, dict):
+            all_constraints = dict(enumerate(all_constraints))
+
+        errors = {}
+        names = set()
+
+        for key, constraints in all_constraints.items():
+            errors[key] = self._validate_constraints(constraints, contradictions=True)
+
+            name = constraints.get('name')
+            if name and name in names:
+                errors[key].append(ConstraintError('name', [name], 'Name repeated in batch', 'invalid'))
+            names.add(name)
 
         return errors
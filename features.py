@@ -0,0 +1,1120 @@
+"""
+
+PW3 - SEL - 2021
+CBR for a cocktail recipe creator
+
+Authors:    Xavier Cucurull Salamero <xavier.cucurull@estudiantat.upc.edu>
+            Daniel Hinjos García <daniel.hinjos@estudiantat.upc.edu>
+            Fernando Vázquez Novoa <fernando.vazquez.novoa@estudiantat.upc.edu>
+            Estela Vázquez-Monjardín Lorenzo <estela.vazquez-monjardin@estudiantat.upc.edu>
+"""
+
+import argparse
+import itertools
+import json
+import mmap
+import os
+from array import array
+
+from storage import atomic_write, file_signature, open_storage
+from stats import library_signature, names_checksum
+
+# Fields of the encoded features of a case, used by the similarity terms and the fulfillment checks
+INGREDIENTS, ALC_TYPES, BASIC_TASTES, GLASS, CATEGORY = range(5)
+
+# Kinds of fulfillment checks: all the bits of the mask are set, any of them is set or none of them is set
+REQUIRE_ALL, REQUIRE_ANY, FORBID = range(3)
+
+# Fulfillment checks of each constraint, in the order of their error messages
+FULFILLMENT_CHECKS = [('category', CATEGORY, REQUIRE_ANY, 'Category constraint failed'),
+                      ('glass_type', GLASS, REQUIRE_ANY, 'Glass constraint failed'),
+                      ('ingredients', INGREDIENTS, REQUIRE_ALL, 'Ingredients constraint failed'),
+                      ('exc_ingredients', INGREDIENTS, FORBID, 'Excluded ingredients constraint failed'),
+                      ('alc_type', ALC_TYPES, REQUIRE_ALL, 'Alcohol types constraint failed'),
+                      ('exc_alc_type', ALC_TYPES, FORBID, 'Excluded alcohol types constraint failed'),
+                      ('basic_taste', BASIC_TASTES, REQUIRE_ALL, 'Basic tastes constraint failed'),
+                      ('exc_basic_taste', BASIC_TASTES, FORBID, 'Excluded basic tastes constraint failed')]
+
+# Files of a memory-mapped feature store, in a directory next to the case library
+# (or inside a sharded case library)
+FEATURES_SUFFIX = '.features'
+FEATURES_DIRNAME = 'features'
+HEADER_FILENAME = 'features.json'
+DATA_FILENAME = 'features.npy'
+NAMES_FILENAME = 'names.bin'
+
+# Rows of a memory-mapped feature store scanned at once, and rows allocated when it is created
+CHUNK_ROWS = 65536
+INITIAL_CAPACITY = 1024
+
+# Bitsets are stored in words of 64 bits
+WORD_BITS = 64
+WORD_MASK = 2**64 - 1
+
+
+class Vocabulary:
+    """ Mapping between the values of a feature and their indexes (bit positions).
+
+    New values get the next index, so the indexes of known values never change.
+    """
+
+    def __init__(self):
+        self.indexes = {}
+        self.values = []
+
+    def __len__(self):
+        return len(self.values)
+
+    def add(self, value):
+        """ Get the index of a value, adding it to the vocabulary if it is new.
+
+        Args:
+            value (str): feature value
+
+        Returns:
+            int: index of the value
+        """
+        index = self.indexes.get(value)
+        if index is None:
+            index = len(self.values)
+            self.indexes[value] = index
+            self.values.append(value)
+
+        return index
+
+    def mask(self, values):
+        """ Encode some values as a bitset, unknown values are ignored.
+
+        Args:
+            values (iterable): feature values
+
+        Returns:
+            int: bitset with the bit of each known value set
+        """
+        mask = 0
+        for value in values:
+            if value in self.indexes:
+                mask |= 1 << self.indexes[value]
+
+        return mask
+
+
+def check_fulfillment(checks, features):
+    """ Check which constraints are not fulfilled by a case.
+
+    Args:
+        checks (list): fulfillment checks of the constraints, from compile_fulfillment()
+        features (tuple): ingredient, alcohol type, basic taste, glass and category bitsets of the case
+
+    Returns:
+        list: error messages of the unfulfilled constraints
+    """
+    errors = []
+    for field, kind, mask, message in checks:
+        bits = features[field]
+        if mask is None or (kind == REQUIRE_ALL and bits & mask != mask) or \
+                (kind == REQUIRE_ANY and not bits & mask) or (kind == FORBID and bits & mask):
+            errors.append(message)
+
+    return errors
+
+
+def bit_indexes(bits):
+    """ Get the indexes of the set bits of a bitset.
+
+    Args:
+        bits (int): bitset
+
+    Yields:
+        int: index of each set bit, from the lowest one
+    """
+    while bits:
+        lowest = bits & -bits
+        yield lowest.bit_length() - 1
+        bits ^= lowest
+
+
+class CaseRows:
+    """ Sequence of the cases of some rows of a feature store, which are only read when accessed.
+    """
+
+    def __init__(self, store, rows):
+        self.store = store
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, index):
+        return self.store.case(self.rows[index])
+
+    def case_names(self, indexes):
+        """ Get the names of some of the cases, without loading them.
+
+        Args:
+            indexes (list): indexes of the cases in the sequence
+
+        Returns:
+            list: cocktail names
+        """
+        return self.store.case_names([self.rows[index] for index in indexes])
+
+
+class FeatureEncoder:
+    """ Vocabularies of the features of the cases, which grow when a case introduces a new value.
+
+    Cases are encoded as bitsets over the vocabularies, and sets of constraints are compiled
+    into similarity terms and fulfillment checks over the same bitsets.
+    """
+
+    def __init__(self):
+        self.ingredients = Vocabulary()
+        self.alc_types = Vocabulary()
+        self.basic_tastes = Vocabulary()
+        self.glass_types = Vocabulary()
+        self.categories = Vocabulary()
+
+    def encode_values(self, category, glasstype, ingredients):
+        """ Encode the category, glass type and ingredients of a case, extending the vocabularies if needed.
+
+        Args:
+            category (str): cocktail category
+            glasstype (str): cocktail glass type
+            ingredients (iterable): (name, alc_type, basic_taste) of each ingredient
+
+        Returns:
+            tuple: ingredient, alcohol type and basic taste bitsets and glass and category indexes
+        """
+        ingredient_bits = alc_type_bits = basic_taste_bits = 0
+        for name, alc_type, basic_taste in ingredients:
+            ingredient_bits |= 1 << self.ingredients.add(name)
+            alc_type_bits |= 1 << self.alc_types.add(alc_type)
+            basic_taste_bits |= 1 << self.basic_tastes.add(basic_taste)
+
+        return (ingredient_bits, alc_type_bits, basic_taste_bits,
+                self.glass_types.add(glasstype), self.categories.add(category))
+
+    def encode(self, case):
+        """ Encode the features of a case, extending the vocabularies if needed.
+
+        Args:
+            case (Element): cocktail Element
+
+        Returns:
+            tuple: ingredient, alcohol type and basic taste bitsets, glass and category indexes,
+                   utility and whether the case is a failure
+        """
+        ingredients = [(i.text, i.get('alc_type'), i.get('basic_taste'))
+                       for i in case.findall('ingredients/ingredient')]
+
+        return self.encode_values(case.find('category').text, case.find('glasstype').text, ingredients) + \
+            (float(case.find('utility').text), case.find('evaluation').text == 'Failure')
+
+    def compile_fulfillment(self, constraints):
+        """ Compile a set of constraints into fulfillment checks over the vocabularies.
+
+        Each check is (field, kind, mask, message): the required (REQUIRE_ALL), allowed (REQUIRE_ANY)
+        or forbidden (FORBID) values of the field as a bitset, and the error message if the check fails.
+        The mask is None if a required value is unknown, since no case can fulfill the check.
+
+        Args:
+            constraints (dict): constraints to fulfill
+
+        Returns:
+            list: fulfillment checks of the non-empty constraints
+        """
+        vocabularies = {INGREDIENTS: self.ingredients, ALC_TYPES: self.alc_types, BASIC_TASTES: self.basic_tastes,
+                        GLASS: self.glass_types, CATEGORY: self.categories}
+
+        checks = []
+        for key, field, kind, message in FULFILLMENT_CHECKS:
+            values = constraints.get(key)
+            if not values:
+                continue
+
+            vocabulary = vocabularies[field]
+            mask = vocabulary.mask(values)
+            if kind == REQUIRE_ALL and any(value not in vocabulary.indexes for value in values):
+                mask = None
+            checks.append((field, kind, mask, message))
+
+        return checks
+
+    def fulfillment_errors(self, constraints, category, glasstype, ingredients):
+        """ Check which constraints are not fulfilled by a case.
+
+        Args:
+            constraints (dict): constraints to fulfill
+            category (str): cocktail category
+            glasstype (str): cocktail glass type
+            ingredients (iterable): (name, alc_type, basic_taste) of each ingredient
+
+        Returns:
+            list: error messages of the unfulfilled constraints
+        """
+        # The case is encoded first, so that all its values are in the vocabularies of the checks
+        ingredient_bits, alc_type_bits, basic_taste_bits, glass_id, category_id = \
+            self.encode_values(category, glasstype, ingredients)
+        checks = self.compile_fulfillment(constraints)
+
+        return check_fulfillment(checks, (ingredient_bits, alc_type_bits, basic_taste_bits,
+                                          1 << glass_id, 1 << category_id))
+
+    def compile_similarity(self, constraints, weights, alcohol_dict, basic_dict):
+        """ Compile a set of constraints into similarity terms over the vocabularies of the store.
+
+        Each term is (field, bit, weight, type_field, type_bit, type_weight, norm_weight): weight is
+        added if the bit of the field is set in the case, otherwise type_weight if the type bit is set,
+        and norm_weight is always added to the normalization score.
+
+        Args:
+            constraints (dict): dictionary containing a set of constraints
+            weights (dict): similarity weights
+            alcohol_dict (dict): ingredient names of each alcohol type
+            basic_dict (dict): ingredient names of each basic taste
+
+        Returns:
+            list: similarity terms, in the order of the constraints
+        """
+        terms = []
+        for key in constraints:
+            if not constraints[key]:
+                continue
+
+            if key in ('ingredients', 'exc_ingredients'):
+                prefix = '' if key == 'ingredients' else 'exc_'
+                for ingredient in constraints[key]:
+                    bit = self.ingredients.mask([ingredient])
+
+                    # Alcohol type of the ingredient or, if it is not alcoholic, its basic taste
+                    alc_type = next((k for k in alcohol_dict if ingredient in alcohol_dict[k]), None)
+                    if alc_type is not None:
+                        type_term = (ALC_TYPES, self.alc_types.mask([alc_type]),
+                                     weights[prefix + 'ingr_alc_type_match'])
+                    else:
+                        basic_taste = next((k for k in basic_dict if ingredient in basic_dict[k]), None)
+                        type_term = (BASIC_TASTES, self.basic_tastes.mask([basic_taste]),
+                                     weights[prefix + 'ingr_basic_taste_match'])
+
+                    terms.append((INGREDIENTS, bit, weights[prefix + 'ingr_match'], *type_term,
+                                  weights['ingr_match']))
+
+            elif key in ('alc_type', 'exc_alc_type', 'basic_taste', 'exc_basic_taste'):
+                field, vocabulary = ((ALC_TYPES, self.alc_types) if key.endswith('alc_type')
+                                     else (BASIC_TASTES, self.basic_tastes))
+                weight = weights[key if key.startswith('exc_') else key + '_match']
+                norm_weight = weights['ingr_match'] if key.startswith('exc_') else weight
+                for value in constraints[key]:
+                    terms.append((field, vocabulary.mask([value]), weight, field, 0, 0, norm_weight))
+
+            elif key == 'glasstype':
+                weight = weights['glasstype_match']
+                terms.append((GLASS, self.glass_types.mask(constraints[key]), weight, GLASS, 0, 0, weight))
+
+        return terms
+
+
+class CaseFeatureStore(FeatureEncoder):
+    """ Encoded features of the cases of a case library, one row per case.
+
+    The ingredients, alcohol types and basic tastes of each case are stored as bitsets
+    over their vocabularies, and the glass type and category as indexes, so the similarity
+    can be computed without reading the XML Elements. Rows are appended in amortized O(1)
+    when cases are learned, and utility and evaluation are updated in place.
+    """
+
+    def __init__(self):
+        super().__init__()
+
+        # Columns of the features of each case
+        self.cases = []
+        self.names = []
+        self.ingredient_bits = []
+        self.alc_type_bits = []
+        self.basic_taste_bits = []
+        self.glass_ids = array('l')
+        self.category_ids = array('l')
+        self.utilities = array('d')
+        self.failures = bytearray()
+
+        # Rows of each case name and of each category, in insertion order
+        self.rows_by_name = {}
+        self.rows_by_category = {}
+
+        # Inverted index: rows of the cases with each value (bit index) of each field
+        self.rows_by_value = {field: {} for field in (INGREDIENTS, ALC_TYPES, BASIC_TASTES, GLASS, CATEGORY)}
+
+    def __len__(self):
+        return len(self.cases)
+
+    @classmethod
+    def from_cases(cls, cases):
+        """ Encode the features of some cases.
+
+        Args:
+            cases (iterable): cocktail Elements
+
+        Returns:
+            CaseFeatureStore: store with one row per case
+        """
+        store = cls()
+        for case in cases:
+            store.append(case)
+
+        return store
+
+    def append(self, case):
+        """ Encode a new case and append it to the store.
+
+        Args:
+            case (Element): cocktail Element
+
+        Returns:
+            int: row of the case
+        """
+        row = len(self.cases)
+        ingredient_bits, alc_type_bits, basic_taste_bits, glass_id, category_id, utility, failure = self.encode(case)
+
+        self.cases.append(case)
+        self.names.append(case.find('name').text)
+        self.ingredient_bits.append(ingredient_bits)
+        self.alc_type_bits.append(alc_type_bits)
+        self.basic_taste_bits.append(basic_taste_bits)
+        self.glass_ids.append(glass_id)
+        self.category_ids.append(category_id)
+        self.utilities.append(utility)
+        self.failures.append(failure)
+
+        self.rows_by_name[self.names[row]] = row
+        self.rows_by_category.setdefault(case.find('category').text, []).append(row)
+        for field, bits in [(INGREDIENTS, ingredient_bits), (ALC_TYPES, alc_type_bits),
+                            (BASIC_TASTES, basic_taste_bits), (GLASS, 1 << glass_id), (CATEGORY, 1 << category_id)]:
+            for bit in bit_indexes(bits):
+                self.rows_by_value[field].setdefault(bit, []).append(row)
+
+        return row
+
+    def update(self, case):
+        """ Update in place the utility and evaluation of a case of the store.
+
+        Args:
+            case (Element): cocktail Element, with the new utility and evaluation
+        """
+        row = self.rows_by_name.get(case.find('name').text)
+        if row is None:
+            return
+
+        self.utilities[row] = float(case.find('utility').text)
+        self.failures[row] = case.find('evaluation').text == 'Failure'
+
+    def case(self, row):
+        """ Get the case of a row.
+
+        Args:
+            row (int): row of the case
+
+        Returns:
+            Element: cocktail Element
+        """
+        return self.cases[row]
+
+    def case_names(self, rows):
+        """ Get the names of the cases of some rows.
+
+        Args:
+            rows (list): rows of the cases
+
+        Returns:
+            list: cocktail names
+        """
+        return [self.names[row] for row in rows]
+
+    def save(self):
+        """ Persist the changes of the store, there is nothing to save for an in-memory store.
+        """
+
+    def search(self, terms, categories=None, limit=None, excluded=(), checks=None):
+        """ Compute the similarity of the cases of some categories.
+
+        Args:
+            terms (list): similarity terms of the constraints, from compile_similarity()
+            categories (list, optional): categories of the cases. Defaults to None (all the cases).
+            limit (int, optional): ignored, the similarity of all the cases is returned. Defaults to None.
+            excluded (iterable, optional): names of the cases to skip if they are failures. Defaults to ().
+            checks (list, optional): fulfillment checks from compile_fulfillment(), the cases which do not
+                                     fulfill them are skipped before scoring, through the inverted index.
+                                     Defaults to None.
+
+        Returns:
+            rows (list): rows of the cases
+            sims (list): similarity of each case
+        """
+        rows = self.fulfilling_rows(checks, categories) if checks else self.rows(categories)
+        if excluded:
+            excluded = set(excluded)
+            rows = [r for r in rows if not self.failures[r] or self.names[r] not in excluded]
+
+        return rows, self.similarities(terms, rows)
+
+    def fulfilling_rows(self, checks, categories=None):
+        """ Get the rows of the cases of some categories that fulfill some checks, from the inverted index.
+
+        The rows of the required or allowed values are intersected, so only the candidates are visited,
+        and the rows with a forbidden value are removed. Without required or allowed values, each row of
+        the categories is only looked up in the forbidden rows.
+
+        Args:
+            checks (list): fulfillment checks of the constraints, from compile_fulfillment()
+            categories (list, optional): categories of the cases. Defaults to None (all the cases).
+
+        Returns:
+            list: rows of the cases, in increasing order if there are required or allowed values
+        """
+        candidates = None
+        forbidden = set()
+        for field, kind, mask, _ in checks:
+            if mask is None:
+                return []
+
+            postings = [self.rows_by_value[field].get(bit, ()) for bit in bit_indexes(mask)]
+            if kind == FORBID:
+                forbidden.update(itertools.chain.from_iterable(postings))
+                continue
+
+            if kind == REQUIRE_ANY:
+                matching = set(itertools.chain.from_iterable(postings))
+            else:
+                matching = set(min(postings, key=len)).intersection(*postings)
+            candidates = matching if candidates is None else candidates & matching
+
+        # Only exclusions: each row of the categories is looked up in the forbidden rows
+        if candidates is None:
+            return [r for r in self.rows(categories) if r not in forbidden]
+
+        if categories:
+            category_ids = set([self.categories.indexes[cat] for cat in categories if cat in self.categories.indexes])
+            candidates = [r for r in candidates if self.category_ids[r] in category_ids]
+
+        return sorted(set(candidates) - forbidden)
+
+    def unfulfilled(self, checks, rows):
+        """ Count the constraints not fulfilled by some cases.
+
+        Args:
+            checks (list): fulfillment checks of the constraints, from compile_fulfillment()
+            rows (list): rows of the cases
+
+        Returns:
+            list: number of unfulfilled constraints of each case
+        """
+        return [len(check_fulfillment(checks, (self.ingredient_bits[r], self.alc_type_bits[r],
+                                                self.basic_taste_bits[r], 1 << self.glass_ids[r],
+                                                1 << self.category_ids[r])))
+                for r in rows]
+
+    def rows(self, categories=None):
+        """ Get the rows of the cases of some categories.
+
+        Args:
+            categories (list, optional): categories of the cases. Defaults to None (all the cases).
+
+        Returns:
+            list: rows of the cases
+        """
+        if not categories:
+            return list(range(len(self.cases)))
+
+        rows = []
+        for cat in categories:
+            rows.extend(self.rows_by_category.get(cat, []))
+
+        return rows
+
+    def similarities(self, terms, rows):
+        """ Compute the similarity between a set of constraints and some cases.
+
+        Args:
+            terms (list): similarity terms of the constraints, from compile_similarity()
+            rows (list): rows of the cases
+
+        Returns:
+            list: similarity of each case, as computed by CBR._compute_similarity
+        """
+        sims = []
+        for row in rows:
+            features = (self.ingredient_bits[row], self.alc_type_bits[row], self.basic_taste_bits[row],
+                        1 << self.glass_ids[row])
+
+            # The weights are added in the same order as CBR._compute_similarity, so the results are identical
+            sim = 0
+            cumulative_normalization_score = 0
+            for field, bit, weight, type_field, type_bit, type_weight, norm_weight in terms:
+                if features[field] & bit:
+                    sim += weight
+                elif features[type_field] & type_bit:
+                    sim += type_weight
+                cumulative_normalization_score += norm_weight
+
+            if cumulative_normalization_score == 0:
+                normalized_sim = 1.0
+            else:
+                normalized_sim = sim / cumulative_normalization_score
+            sims.append(normalized_sim * self.utilities[row])
+
+        return sims
+
+
+def features_dirname(cbl_filename):
+    """ Get the directory of the memory-mapped feature store of a case library.
+
+    Args:
+        cbl_filename (str): path of the case library
+
+    Returns:
+        str: directory of the feature store
+    """
+    if os.path.isdir(cbl_filename):
+        return os.path.join(cbl_filename, FEATURES_DIRNAME)
+    return cbl_filename + FEATURES_SUFFIX
+
+
+def _bitset_dtype(np, words):
+    """ Get the dtype of the rows of a memory-mapped feature store.
+
+    Args:
+        np (module): numpy
+        words (dict): number of 64-bit words of the ingredient, alcohol type and basic taste bitsets
+
+    Returns:
+        dtype: structured dtype with one field per feature
+    """
+    return np.dtype([('ingredients', '<u8', (words['ingredients'],)),
+                     ('alc_types', '<u8', (words['alc_types'],)),
+                     ('basic_tastes', '<u8', (words['basic_tastes'],)),
+                     ('glass', '<i4'), ('category', '<i4'), ('utility', '<f8'), ('failure', '?'),
+                     ('name_offset', '<i8'), ('name_length', '<i4')])
+
+
+def _words(bits, n_words):
+    """ Split a bitset into 64-bit words, from the least significant one.
+
+    Args:
+        bits (int): bitset
+        n_words (int): number of words
+
+    Returns:
+        list: words of the bitset
+    """
+    return [(bits >> (WORD_BITS * w)) & WORD_MASK for w in range(n_words)]
+
+
+class MappedFeatureStore(FeatureEncoder):
+    """ Encoded features of the cases of a case library, stored in memory-mapped files.
+
+    The rows (bitsets, glass and category indexes, utility and failure flag) are stored in a
+    .npy file opened with numpy.memmap, the case names in a separate file and the vocabularies
+    in a JSON header. The similarity is computed scanning the rows in chunks, so only the pages
+    being scanned are resident, and the full cases are only loaded (with the loader) for the
+    winners. The store is modified under the lock of the case library and saved after each change.
+    """
+
+    def __init__(self, cbl_filename, loader=None):
+        """ Initialize an empty store, use open() or build() to get a store with rows.
+
+        Args:
+            cbl_filename (str): path of the case library
+            loader (function, optional): loader(name, category) of the cocktail Element of a case.
+                                         Defaults to None (cases are read from the case library).
+        """
+        super().__init__()
+        self.cbl_filename = cbl_filename
+        self.directory = features_dirname(cbl_filename)
+        self.loader = loader if loader is not None else open_storage(cbl_filename).load_case
+
+        self.n_rows = 0
+        self.words = {'ingredients': 1, 'alc_types': 1, 'basic_tastes': 1}
+        self.names_checksum = 0
+        self.data = None
+
+        # Rows of the case names that have been looked up, loaded or appended
+        self._rows = {}
+        self._header_signature = None
+
+    def __len__(self):
+        return self.n_rows
+
+    def _path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    @classmethod
+    def open(cls, cbl_filename, checksum=None, loader=None):
+        """ Open the memory-mapped feature store of a case library.
+
+        The store is valid if it was saved after the last change of the library files
+        and, if a checksum is given, if it has the same case names.
+
+        Args:
+            cbl_filename (str): path of the case library
+            checksum (int, optional): checksum of the names of the cases of the library. Defaults to None.
+            loader (function, optional): loader(name, category) of the cocktail Element of a case.
+                                         Defaults to None (cases are read from the case library).
+
+        Returns:
+            MappedFeatureStore: feature store, None if there is no valid store
+        """
+        store = cls(cbl_filename, loader)
+        try:
+            header = store._load_header()
+        except (OSError, ValueError):
+            return None
+
+        if header['signature'] != library_signature(cbl_filename) or \
+                (checksum is not None and header['names_checksum'] != checksum):
+            return None
+
+        return store
+
+    @classmethod
+    def build(cls, cbl_filename, cases, loader=None):
+        """ Encode some cases into a new memory-mapped feature store, replacing the existing one.
+
+        Args:
+            cbl_filename (str): path of the case library
+            cases (iterable): cocktail Elements of the library, which can be generated one category at a time
+            loader (function, optional): loader(name, category) of the cocktail Element of a case.
+                                         Defaults to None (cases are read from the case library).
+
+        Returns:
+            MappedFeatureStore: feature store with one row per case
+        """
+        store = cls(cbl_filename, loader)
+        os.makedirs(store.directory, exist_ok=True)
+
+        # Names are separated by NUL bytes, so that a name can be found as b'\0' + name + b'\0'
+        with open(store._path(NAMES_FILENAME), 'wb') as names_file:
+            names_file.write(b'\0')
+        store._allocate(INITIAL_CAPACITY, store.words)
+
+        for case in cases:
+            store._append(case)
+        store.save()
+
+        return store
+
+    def _load_header(self):
+        """ Read the header (vocabularies and sizes) and map the rows of the store.
+
+        Returns:
+            dict: header of the store
+        """
+        from numpy.lib.format import open_memmap
+
+        with open(self._path(HEADER_FILENAME)) as header_file:
+            header = json.load(header_file)
+        self._header_signature = file_signature(self._path(HEADER_FILENAME))
+
+        self.n_rows = header['n_rows']
+        self.words = header['words']
+        self.names_checksum = header['names_checksum']
+        for field, values in header['vocabularies'].items():
+            vocabulary = getattr(self, field)
+            for value in values[len(vocabulary):]:
+                vocabulary.add(value)
+
+        self.data = open_memmap(self._path(DATA_FILENAME), mode='r+')
+
+        return header
+
+    def _refresh(self):
+        """ Read the header again if the store was modified by another process.
+        """
+        if file_signature(self._path(HEADER_FILENAME)) != self._header_signature:
+            self._load_header()
+
+    def save(self):
+        """ Flush the rows and write the header, with the signature of the current library files.
+        """
+        self.data.flush()
+        header = {'n_rows': self.n_rows, 'capacity': len(self.data), 'words': self.words,
+                  'names_checksum': self.names_checksum, 'signature': library_signature(self.cbl_filename),
+                  'vocabularies': {field: getattr(self, field).values for field in
+                                   ['ingredients', 'alc_types', 'basic_tastes', 'glass_types', 'categories']}}
+
+        with atomic_write(self._path(HEADER_FILENAME), 'w') as header_file:
+            json.dump(header, header_file)
+        self._header_signature = file_signature(self._path(HEADER_FILENAME))
+
+    def _allocate(self, capacity, words):
+        """ Create the rows file with a new capacity or bitset width, copying the existing rows.
+
+        Args:
+            capacity (int): number of rows of the file
+            words (dict): number of 64-bit words of each bitset
+        """
+        import numpy as np
+        from numpy.lib.format import open_memmap
+
+        tmp_filename = self._path(DATA_FILENAME + '.tmp')
+        data = open_memmap(tmp_filename, mode='w+', dtype=_bitset_dtype(np, words), shape=(capacity,))
+        for start in range(0, self.n_rows, CHUNK_ROWS):
+            end = min(self.n_rows, start + CHUNK_ROWS)
+            for field in data.dtype.names:
+                if field in words:
+                    data[field][start:end, :self.words[field]] = self.data[field][start:end]
+                else:
+                    data[field][start:end] = self.data[field][start:end]
+        data.flush()
+        del data
+
+        os.replace(tmp_filename, self._path(DATA_FILENAME))
+        self.words = dict(words)
+        self.data = open_memmap(self._path(DATA_FILENAME), mode='r+')
+
+    def _append(self, case):
+        """ Encode a case and write it in a new row, growing the rows file if needed.
+
+        Args:
+            case (Element): cocktail Element
+
+        Returns:
+            int: row of the case
+        """
+        name = case.find('name').text
+        ingredient_bits, alc_type_bits, basic_taste_bits, glass_id, category_id, utility, failure = self.encode(case)
+
+        # The capacity and the width of the bitsets are doubled, so appends are amortized O(1)
+        words = {field: max(n_words, 1) for field, n_words in self.words.items()}
+        for field in words:
+            while len(getattr(self, field)) > words[field] * WORD_BITS:
+                words[field] *= 2
+        if self.n_rows == len(self.data) or words != self.words:
+            self._allocate(len(self.data) * 2 if self.n_rows == len(self.data) else len(self.data), words)
+
+        with open(self._path(NAMES_FILENAME), 'ab') as names_file:
+            name_offset = names_file.tell()
+            names_file.write(name.encode('utf-8') + b'\0')
+
+        row = self.n_rows
+        self.data['ingredients'][row] = _words(ingredient_bits, self.words['ingredients'])
+        self.data['alc_types'][row] = _words(alc_type_bits, self.words['alc_types'])
+        self.data['basic_tastes'][row] = _words(basic_taste_bits, self.words['basic_tastes'])
+        self.data['glass'][row] = glass_id
+        self.data['category'][row] = category_id
+        self.data['utility'][row] = utility
+        self.data['failure'][row] = failure
+        self.data['name_offset'][row] = name_offset
+        self.data['name_length'][row] = len(name.encode('utf-8'))
+
+        self.n_rows += 1
+        self.names_checksum = (self.names_checksum + names_checksum([name])) % 2**32
+        self._rows[name] = row
+
+        return row
+
+    def append(self, case):
+        """ Append a new case to the store, unless another process already added it.
+
+        Args:
+            case (Element): cocktail Element
+
+        Returns:
+            int: row of the case
+        """
+        self._refresh()
+        row = self.row(case.find('name').text)
+        if row is not None:
+            return row
+
+        return self._append(case)
+
+    def update(self, case):
+        """ Update in place the utility and evaluation of a case of the store.
+
+        Args:
+            case (Element): cocktail Element, with the new utility and evaluation
+        """
+        self._refresh()
+        row = self.row(case.find('name').text)
+        if row is None:
+            return
+
+        self.data['utility'][row] = float(case.find('utility').text)
+        self.data['failure'][row] = case.find('evaluation').text == 'Failure'
+
+    def name(self, row):
+        """ Read the name of the case of a row.
+
+        Args:
+            row (int): row of the case
+
+        Returns:
+            str: cocktail name
+        """
+        with open(self._path(NAMES_FILENAME), 'rb') as names_file:
+            names_file.seek(int(self.data['name_offset'][row]))
+            return names_file.read(int(self.data['name_length'][row])).decode('utf-8')
+
+    def case_names(self, rows):
+        """ Read the names of the cases of some rows, opening the names file once.
+
+        Args:
+            rows (list): rows of the cases
+
+        Returns:
+            list: cocktail names
+        """
+        names = []
+        with open(self._path(NAMES_FILENAME), 'rb') as names_file:
+            for row in rows:
+                names_file.seek(int(self.data['name_offset'][row]))
+                names.append(names_file.read(int(self.data['name_length'][row])).decode('utf-8'))
+
+        return names
+
+    def row(self, name):
+        """ Find the row of a case by its name.
+
+        Args:
+            name (str): cocktail name
+
+        Returns:
+            int: row of the case, None if the case is not in the store
+        """
+        if name in self._rows:
+            return self._rows[name]
+
+        import numpy as np
+
+        # Search the name in the names file, whose offsets increase with the rows
+        with open(self._path(NAMES_FILENAME), 'rb') as names_file:
+            with mmap.mmap(names_file.fileno(), 0, access=mmap.ACCESS_READ) as names:
+                position = names.find(b'\0' + name.encode('utf-8') + b'\0')
+        if position < 0:
+            return None
+
+        row = int(np.searchsorted(self.data['name_offset'][:self.n_rows], position + 1))
+        if row == self.n_rows or self.data['name_offset'][row] != position + 1:
+            return None
+
+        self._rows[name] = row
+        return row
+
+    def case(self, row):
+        """ Load the case of a row.
+
+        Args:
+            row (int): row of the case
+
+        Returns:
+            Element: cocktail Element
+        """
+        name = self.name(row)
+        self._rows[name] = row
+        return self.loader(name, self.categories.values[self.data['category'][row]])
+
+    def _bitset_match(self, np, chunk, field, mask):
+        """ Check which rows of a chunk have any of the bits of a mask set.
+
+        Args:
+            np (module): numpy
+            chunk (array): rows of the store
+            field (int): INGREDIENTS, ALC_TYPES, BASIC_TASTES or GLASS
+            mask (int): bitset over the vocabulary of the field
+
+        Returns:
+            array: boolean array, None if the mask is empty
+        """
+        if not mask:
+            return None
+
+        if field in (GLASS, CATEGORY):
+            return np.isin(chunk['glass' if field == GLASS else 'category'],
+                           [i for i in range(mask.bit_length()) if mask >> i & 1])
+
+        column = chunk[['ingredients', 'alc_types', 'basic_tastes'][field]]
+        match = np.zeros(len(chunk), dtype=bool)
+        for w, word in enumerate(_words(mask, column.shape[1])):
+            if word:
+                match |= (column[:, w] & np.uint64(word)) != 0
+
+        return match
+
+    def _bitset_all(self, np, chunk, field, mask):
+        """ Check which rows of a chunk have all the bits of a mask set.
+
+        Args:
+            np (module): numpy
+            chunk (array): rows of the store
+            field (int): INGREDIENTS, ALC_TYPES or BASIC_TASTES
+            mask (int): bitset over the vocabulary of the field
+
+        Returns:
+            array: boolean array
+        """
+        column = chunk[['ingredients', 'alc_types', 'basic_tastes'][field]]
+
+        # Bits beyond the width of the bitsets are not set in any case
+        if mask.bit_length() > column.shape[1] * WORD_BITS:
+            return np.zeros(len(chunk), dtype=bool)
+
+        match = np.ones(len(chunk), dtype=bool)
+        for w, word in enumerate(_words(mask, column.shape[1])):
+            if word:
+                match &= (column[:, w] & np.uint64(word)) == np.uint64(word)
+
+        return match
+
+    def unfulfilled(self, checks, rows):
+        """ Count the constraints not fulfilled by some cases, reading the rows in chunks.
+
+        Args:
+            checks (list): fulfillment checks of the constraints, from compile_fulfillment()
+            rows (list): rows of the cases
+
+        Returns:
+            list: number of unfulfilled constraints of each case
+        """
+        import numpy as np
+
+        self._refresh()
+        counts = []
+        for start in range(0, len(rows), CHUNK_ROWS):
+            chunk = self.data[np.asarray(rows[start:start + CHUNK_ROWS], dtype=np.int64)]
+            counts.extend(self._chunk_unfulfilled(np, checks, chunk).tolist())
+
+        return counts
+
+    def _chunk_unfulfilled(self, np, checks, chunk):
+        """ Count the constraints not fulfilled by the rows of a chunk.
+
+        Args:
+            np (module): numpy
+            checks (list): fulfillment checks of the constraints, from compile_fulfillment()
+            chunk (array): rows of the store
+
+        Returns:
+            array: number of unfulfilled constraints of each row
+        """
+        n_errors = np.zeros(len(chunk), dtype=np.int64)
+        for field, kind, mask, _ in checks:
+            if mask is None:
+                fulfilled = np.zeros(len(chunk), dtype=bool)
+            elif kind == REQUIRE_ALL:
+                fulfilled = self._bitset_all(np, chunk, field, mask)
+            else:
+                match = self._bitset_match(np, chunk, field, mask)
+                any_match = match if match is not None else np.zeros(len(chunk), dtype=bool)
+                fulfilled = any_match if kind == REQUIRE_ANY else ~any_match
+            n_errors += ~fulfilled
+
+        return n_errors
+
+    def _chunk_similarities(self, np, terms, chunk):
+        """ Compute the similarity between a set of constraints and the cases of a chunk.
+
+        Args:
+            np (module): numpy
+            terms (list): similarity terms of the constraints, from compile_similarity()
+            chunk (array): rows of the store
+
+        Returns:
+            array: similarity of each case, as computed by CBR._compute_similarity
+        """
+        # The weights are added in the same order as CBR._compute_similarity, so the results are identical
+        sim = np.zeros(len(chunk))
+        cumulative_normalization_score = 0
+        for field, bit, weight, type_field, type_bit, type_weight, norm_weight in terms:
+            match = self._bitset_match(np, chunk, field, bit)
+            type_match = self._bitset_match(np, chunk, type_field, type_bit)
+
+            added = np.zeros(len(chunk))
+            if type_match is not None:
+                added = np.where(type_match, type_weight, added)
+            if match is not None:
+                added = np.where(match, weight, added)
+            sim += added
+            cumulative_normalization_score += norm_weight
+
+        if cumulative_normalization_score == 0:
+            normalized_sim = np.ones(len(chunk))
+        else:
+            normalized_sim = sim / cumulative_normalization_score
+
+        return normalized_sim * chunk['utility']
+
+    def search(self, terms, categories=None, limit=None, excluded=(), checks=None):
+        """ Compute the similarity of the cases of some categories, scanning the store in chunks.
+
+        Args:
+            terms (list): similarity terms of the constraints, from compile_similarity()
+            categories (list, optional): categories of the cases. Defaults to None (all the cases).
+            limit (int, optional): only keep the cases at least as similar as the limit-th most
+                                   similar one, including ties. Defaults to None (all the cases).
+            excluded (iterable, optional): names of the cases to skip if they are failures. Defaults to ().
+            checks (list, optional): fulfillment checks from compile_fulfillment(), the cases which do not
+                                     fulfill them are skipped. Defaults to None.
+
+        Returns:
+            rows (list): rows of the cases, in insertion order
+            sims (list): similarity of each case
+        """
+        import numpy as np
+
+        self._refresh()
+        category_ids = [self.categories.indexes[c] for c in categories or [] if c in self.categories.indexes]
+        excluded_rows = [row for row in [self.row(name) for name in excluded] if row is not None]
+
+        best_rows = np.zeros(0, dtype=np.int64)
+        best_sims = np.zeros(0)
+        for start in range(0, self.n_rows, CHUNK_ROWS):
+            chunk = self.data[start:min(self.n_rows, start + CHUNK_ROWS)]
+            sims = self._chunk_similarities(np, terms, chunk)
+
+            keep = np.isin(chunk['category'], category_ids) if categories else np.ones(len(chunk), dtype=bool)
+            for row in excluded_rows:
+                if start <= row < start + len(chunk) and chunk['failure'][row - start]:
+                    keep[row - start] = False
+            if checks:
+                keep &= self._chunk_unfulfilled(np, checks, chunk) == 0
+
+            best_rows = np.concatenate([best_rows, np.flatnonzero(keep) + start])
+            best_sims = np.concatenate([best_sims, sims[keep]])
+
+            # Keep the cases at least as similar as the limit-th one, so the ties are kept
+            if limit is not None and len(best_sims) > limit:
+                threshold = np.partition(best_sims, len(best_sims) - limit)[len(best_sims) - limit]
+                selected = best_sims >= threshold
+                best_rows, best_sims = best_rows[selected], best_sims[selected]
+
+        return best_rows.tolist(), best_sims.tolist()
+
+
+def parse_arguments():
+    """ Define program input arguments and parse them.
+    """
+    # Create the parser and add arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument(dest='caselibrary', type=str, help="Filepath of the case library")
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    return args
+
+
+if __name__ == "__main__":
+    """ Build the memory-mapped feature store of a case library, used by CBR(..., mapped=True).
+
+    usage: features.py [-h] caselibrary
+    """
+    args = parse_arguments()
+    storage = open_storage(args.caselibrary)
+    if storage.supports_lazy:
+        vocabularies = storage.load_vocabularies()
+        cases = (case for category in sorted(vocabularies) for case in storage.load_category(category))
+    else:
+        cases = storage.load()
+
+    store = MappedFeatureStore.build(args.caselibrary, cases)
+    print(f'Encoded {len(store)} cases in {store.directory} ({len(store.ingredients)} ingredients, '
+          f'{len(store.alc_types)} alcohol types, {len(store.basic_tastes)} basic tastes)')
@@ -11,8 +11,12 @@ Authors:    Xavier Cucurull Salamero <xavier.cucurull@estudiantat.upc.edu>
 
 import sys
 import argparse
+import json
+import time
 
 from cbr import CBR
+from memory import format_report
+from rendering import render_recipe, recipe_to_dict
 from utils import load_constraints, interactive_menu, evaluation_menu
 
 
@@ -24,6 +28,14 @@ def parse_arguments():
     parser.add_argument(dest='caselibrary', type=str, help="Filepath of the XML case library")
     parser.add_argument("--verbosity", type=int, help="Output verbosity level. Set to 1 to print debug messages.", default=0)
     parser.add_argument('-c', '--constraints', type=str, help="Filepath of the JSON constraints file")
+    parser.add_argument('--record', type=str, help="Filepath of a JSONL log where the query and evaluation are recorded")
+    parser.add_argument('--memory-report', action='store_true',
+                        help="Print the memory used by each structure of the CBR, after loading and after learning")
+    parser.add_argument('--batch', type=str,
+                        help="Filepath of a JSONL file with one set of constraints (and optional score and seed) per line, "
+                             "or - for stdin. One JSON result per line is written to stdout")
+    parser.add_argument('--strict', action='store_true',
+                        help="Only retrieve cases that fulfill the glass and exclusion constraints, if any does")
 
     # Parse arguments
     args = parser.parse_args()
@@ -68,12 +80,81 @@ def get_constraints(args, cbr):
     print()
             
     return constraints
-        
+
+
+# Fields of a set of constraints, missing fields in batch requests are left empty
+CONSTRAINT_FIELDS = ['category', 'glass_type', 'alc_type', 'basic_taste', 'ingredients', 'exc_ingredients',
+                     'exc_alc_type', 'exc_basic_taste']
+
+
+def process_request(cbr, request):
+    """ Get a new case for a batch request, and evaluate it if a score is given.
+
+    Args:
+        cbr (CBR): initialized CBR system
+        request (dict): constraints, or dict with the "constraints" and an optional "score" and "seed"
+
+    Returns:
+        dict: retrieved and adapted cases, similarity, timings and evaluation, or the errors
+    """
+    score = request.get('score') if 'constraints' in request else None
+    seed = request.get('seed') if 'constraints' in request else None
+    constraints = {'name': ''}
+    constraints.update({field: [] for field in CONSTRAINT_FIELDS})
+    constraints.update(request['constraints'] if 'constraints' in request else request)
+
+    errors = cbr.check_constraints(constraints)
+    if errors:
+        return {'name': constraints['name'], 'errors': errors}
+
+    retrieved_case, adapted_case, original = cbr.get_new_case(constraints, seed)
+    result = {'name': constraints['name'],
+              'retrieved': recipe_to_dict(cbr.render_recipe(retrieved_case)),
+              'adapted': recipe_to_dict(render_recipe(adapted_case)),
+              'original': original,
+              'similarity': cbr.last_query.similarity,
+              'timings': dict(cbr.last_query.timings)}
+
+    # LEARNING with the given score, original cocktails are not evaluated
+    if score is not None and not original:
+        start_time = time.perf_counter()
+        cbr.evaluate_new_case(retrieved_case, adapted_case, float(score))
+        result['timings']['learning'] = time.perf_counter() - start_time
+        result['evaluation'] = adapted_case.find('evaluation').text
+
+    return result
+
+
+def run_batch(cbr, input_file, output_file):
+    """ Process a stream of batch requests, writing one JSON result per request.
+
+    Requests are read and results are written one line at a time, so that
+    memory does not grow with the length of the input.
+
+    Args:
+        cbr (CBR): initialized CBR system
+        input_file (file): JSONL requests
+        output_file (file): JSONL results
+    """
+    for line_number, line in enumerate(input_file, start=1):
+        if not line.strip():
+            continue
+
+        try:
+            result = process_request(cbr, json.loads(line))
+        except (ValueError, TypeError, AttributeError) as err:
+            result = {'errors': [f'Invalid request: {err}']}
+
+        result['line'] = line_number
+        output_file.write(json.dumps(result) + '\n')
+        output_file.flush()
+
 if __name__ == "__main__":
     """ Main program to get cocktails from the cocktails CBR
     given a set of constraints provided by the user.
     
-    usage: main.py [-h] [--verbosity VERBOSITY] [-c CONSTRAINTS] caselibrary
+    usage: main.py [-h] [--verbosity VERBOSITY] [-c CONSTRAINTS] [--record RECORD] [--memory-report]
+                   [--batch BATCH] [--strict] caselibrary
 
     positional arguments:
         caselibrary           Filepath of the XML case library
@@ -85,12 +166,49 @@ if __name__ == "__main__":
                                 messages.
         -c CONSTRAINTS, --constraints CONSTRAINTS
                                 Filepath of the JSON constraints file
+        --record RECORD       Filepath of a JSONL log where the query and
+                                evaluation are recorded
+        --memory-report       Print the memory used by each structure of the
+                                CBR, after loading and after learning
+        --batch BATCH         Filepath of a JSONL file with one set of
+                                constraints (and optional score and seed) per line, or -
+                                for stdin. One JSON result per line is written
+                                to stdout
+        --strict              Only retrieve cases that fulfill the glass and
+                                exclusion constraints, if any does
     """
     # Input arguments
     args = parse_arguments()
+
+    # Trace the allocations made while loading the case library
+    if args.memory_report:
+        import tracemalloc
+        tracemalloc.start()
     
     # Initialize CBR
-    cbr = CBR(args.caselibrary, verbose=args.verbosity)
+    cbr = CBR(args.caselibrary, verbose=args.verbosity, record=args.record, strict=args.strict)
+
+    # In batch mode stdout only contains the results, messages are printed to stderr
+    report_file = sys.stderr if args.batch else sys.stdout
+    if args.batch and args.verbosity:
+        cbr.verboseprint = lambda *a, **k: print(*a, file=sys.stderr, **k)
+
+    if args.memory_report:
+        memory_baseline = cbr.memory_report()
+        print(format_report(memory_baseline), file=report_file)
+
+    # Batch mode: the CBR is loaded once for all the requests
+    if args.batch:
+        if args.batch == '-':
+            run_batch(cbr, sys.stdin, sys.stdout)
+        else:
+            with open(args.batch) as input_file:
+                run_batch(cbr, input_file, sys.stdout)
+        cbr.close()
+
+        if args.memory_report:
+            print(format_report(cbr.memory_report(memory_baseline)), file=report_file)
+        sys.exit(0)
     
     # Get user constraints
     constraints = get_constraints(args, cbr)   
@@ -110,4 +228,9 @@ if __name__ == "__main__":
     if not original:
         ev_score = evaluation_menu(cbr, adapted_case)
         cbr.evaluate_new_case(retrieved_case, adapted_case, ev_score)
+    cbr.close()
+
+    # Memory after learning, with the growth per learned case
+    if args.memory_report:
+        print(format_report(cbr.memory_report(memory_baseline)))
         
\ No newline at end of file
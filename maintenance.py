@@ -0,0 +1,291 @@
+"""
+
+PW3 - SEL - 2021
+CBR for a cocktail recipe creator
+
+Authors:    Xavier Cucurull Salamero <xavier.cucurull@estudiantat.upc.edu>
+            Daniel Hinjos García <daniel.hinjos@estudiantat.upc.edu>
+            Fernando Vázquez Novoa <fernando.vazquez.novoa@estudiantat.upc.edu>
+            Estela Vázquez-Monjardín Lorenzo <estela.vazquez-monjardin@estudiantat.upc.edu>
+"""
+
+import argparse
+import copy
+import json
+import time
+from collections import namedtuple
+
+from cbr import CBR
+from storage import open_storage, MemoryStorage
+from usage import load_usage, compact_usage
+
+# Learned cases not retrieved for this number of days are unused
+MAX_IDLE_DAYS = 30
+
+# Declare CompactionReport namedtuple(), with the outcome of a case library compaction
+CompactionReport = namedtuple('CompactionReport', ['n_cases_before', 'n_cases_after', 'merged', 'dropped',
+                                                   'retrieval_time_before', 'retrieval_time_after',
+                                                   'quality_before', 'quality_after', 'applied'])
+
+
+def is_original(case):
+    """ Check if a case is an original cocktail of the dataset.
+
+    Args:
+        case (Element): cocktail Element
+
+    Returns:
+        boolean: True if the case is original, False if it was learned by the CBR
+    """
+    return case.find('derivation').text.lower() == 'original'
+
+
+def ingredient_overlap(case_a, case_b):
+    """ Compute the Jaccard similarity between the ingredient names of two cases.
+
+    Args:
+        case_a (Element): cocktail Element
+        case_b (Element): cocktail Element
+
+    Returns:
+        float: overlap between 0.0 and 1.0
+    """
+    ingredients_a = set([i.text for i in case_a.findall('ingredients/ingredient')])
+    ingredients_b = set([i.text for i in case_b.findall('ingredients/ingredient')])
+    if not ingredients_a and not ingredients_b:
+        return 1.0
+
+    return len(ingredients_a & ingredients_b) / len(ingredients_a | ingredients_b)
+
+
+def plan_compaction(cocktails, min_overlap=0.9, min_utility=0.5, keep_failures=True, usage=None,
+                    max_idle=MAX_IDLE_DAYS * 86400, now=None):
+    """ Decide which learned cases are merged or dropped.
+
+    A learned case is a near-duplicate of another case with the same category, glass type
+    and evaluation if their ingredients overlap at least min_overlap. Near-duplicates are merged
+    into the original case or, otherwise, into the learned case with the highest utility.
+
+    A learned case is unused if it has not been retrieved (nor added) for max_idle seconds,
+    according to the retrieval usage of the library. Unused cases with a utility below
+    min_utility are dropped. Original cases are always kept, and no case is dropped if the
+    usage of the library has not been tracked.
+
+    Args:
+        cocktails (iterable): cocktail Elements of the case library
+        min_overlap (float, optional): minimum ingredient overlap of near-duplicates. Defaults to 0.9.
+        min_utility (float, optional): minimum utility of the unused cases that are kept. Defaults to 0.5.
+        keep_failures (boolean, optional): do not drop failures, which are needed to detect failed
+                                           adaptations (they can still be merged). Defaults to True.
+        usage (CaseUsage, optional): retrieval usage of the library. Defaults to None (not tracked).
+        max_idle (float, optional): time in seconds without use after which a case is unused.
+                                    Defaults to MAX_IDLE_DAYS days.
+        now (float, optional): current time. Defaults to None (time.time()).
+
+    Returns:
+        merged (dict): name of the case each merged case is merged into, indexed by its name
+        dropped (list): names of the dropped cases
+    """
+    # Time of the last use of each case, merged cases count as uses of the case they are merged into
+    last_use = {c.find('name').text: usage.last_use(c.find('name').text) for c in cocktails} if usage is not None else {}
+    idle_since = (time.time() if now is None else now) - max_idle
+
+    # Originals are the first representatives, then learned cases from highest to lowest utility
+    cases = sorted(cocktails, key=lambda c: (not is_original(c), -float(c.find('utility').text)))
+
+    merged = {}
+    representatives = {}
+    for case in cases:
+        key = (case.find('category').text, case.find('glasstype').text, case.find('evaluation').text)
+        group = representatives.setdefault(key, [])
+
+        if not is_original(case):
+            duplicate_of = next((r for r in group if ingredient_overlap(case, r) >= min_overlap), None)
+            if duplicate_of is not None:
+                merged[case.find('name').text] = duplicate_of.find('name').text
+                if usage is not None:
+                    last_use[duplicate_of.find('name').text] = max(last_use[duplicate_of.find('name').text],
+                                                                   last_use[case.find('name').text])
+                continue
+
+        group.append(case)
+
+    if usage is None:
+        return merged, []
+
+    dropped = [c.find('name').text for c in cases
+               if not is_original(c) and c.find('name').text not in merged
+               and last_use[c.find('name').text] < idle_since and float(c.find('utility').text) < min_utility
+               and not (keep_failures and c.find('evaluation').text == 'Failure')]
+
+    return merged, dropped
+
+
+def apply_compaction(cocktails, merged, dropped):
+    """ Build a compacted copy of the case library.
+
+    Merged cases give their utility to the case they are merged into, if it is higher,
+    and the derivations of the remaining cases are redirected to it.
+
+    Args:
+        cocktails (Element): root cocktails Element of the case library
+        merged (dict): name of the case each merged case is merged into, indexed by its name
+        dropped (list): names of the dropped cases
+
+    Returns:
+        Element: root cocktails Element of the compacted case library
+    """
+    compacted = copy.deepcopy(cocktails)
+    cases_by_name = {c.find('name').text: c for c in compacted}
+
+    for name, target in merged.items():
+        target_utility = cases_by_name[target].find('utility')
+        target_utility.text = str(max(float(target_utility.text), float(cases_by_name[name].find('utility').text)))
+
+    removed = set(merged) | set(dropped)
+    for case in list(compacted):
+        derivation = case.find('derivation')
+        if derivation.text in merged:
+            derivation.text = merged[derivation.text]
+
+        if case.find('name').text in removed:
+            compacted.remove(case)
+
+    return compacted
+
+
+def evaluate_retrieval(cbr, held_out, repeat=3):
+    """ Measure the retrieval time and quality of a CBR on a held-out set of constraints.
+
+    The quality is the mean similarity of the best case retrieved for each set of constraints.
+
+    Args:
+        cbr (CBR): CBR with the case library to evaluate
+        held_out (list): sets of constraints
+        repeat (int, optional): number of timed passes, the fastest one is kept. Defaults to 3.
+
+    Returns:
+        retrieval_time (float): time in seconds to retrieve a case for all the constraints
+        quality (float): mean similarity of the retrieved cases
+    """
+    retrieval_time = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        similarities = [next(cbr._rank_cases(constraints), (None, 0.0))[1] for constraints in held_out]
+        retrieval_time = min(retrieval_time, time.perf_counter() - start)
+
+    quality = sum(similarities) / len(similarities) if similarities else 0.0
+
+    return retrieval_time, quality
+
+
+def load_held_out(filename):
+    """ Load a held-out set of constraints, such as the tests constraints files.
+
+    Args:
+        filename (str): filename of a JSON with sets of constraints indexed by key
+
+    Returns:
+        list: sets of constraints
+    """
+    with open(filename) as json_file:
+        data = json.load(json_file)
+
+    return list(data.values()) if isinstance(data, dict) else data
+
+
+def compact_case_library(cbl_filename, held_out=(), min_overlap=0.9, min_utility=0.5, keep_failures=True,
+                         max_quality_loss=0.02, dry_run=False, max_idle=MAX_IDLE_DAYS * 86400):
+    """ Compact a case library, merging near-duplicate and dropping unused low-utility learned cases.
+
+    The compacted library is only written if the relative loss of retrieval quality on the
+    held-out constraints does not exceed max_quality_loss, so without held-out constraints it is
+    only a dry run. The library is locked meanwhile, and the usage of the removed cases is forgotten.
+
+    Args:
+        cbl_filename (str): path of the case library
+        held_out (list, optional): sets of constraints to measure time and quality. Defaults to ().
+        min_overlap (float, optional): minimum ingredient overlap of near-duplicates. Defaults to 0.9.
+        min_utility (float, optional): minimum utility of the unused cases that are kept. Defaults to 0.5.
+        keep_failures (boolean, optional): do not drop failures. Defaults to True.
+        max_quality_loss (float, optional): maximum relative quality loss accepted. Defaults to 0.02.
+        dry_run (boolean, optional): only report, without writing the library. Defaults to False.
+        max_idle (float, optional): time in seconds without use after which a case is unused.
+                                    Defaults to MAX_IDLE_DAYS days.
+
+    Returns:
+        CompactionReport: sizes, merged and dropped cases, retrieval time and quality
+                          before and after compaction and whether it was applied
+    """
+    storage = open_storage(cbl_filename)
+
+    with storage.transaction():
+        cbr = CBR(cbl_filename, storage=storage)
+        usage = load_usage(cbl_filename)
+        merged, dropped = plan_compaction(cbr.cocktails, min_overlap, min_utility, keep_failures, usage, max_idle)
+        compacted = apply_compaction(cbr.cocktails, merged, dropped)
+
+        # Evaluate the compacted library without persisting it
+        compacted_cbr = CBR(cbl_filename, storage=MemoryStorage(compacted))
+        time_before, quality_before = evaluate_retrieval(cbr, held_out)
+        time_after, quality_after = evaluate_retrieval(compacted_cbr, held_out)
+
+        # The quality can not be checked without held-out constraints, so nothing is written
+        quality_loss = (quality_before - quality_after) / quality_before if quality_before > 0 else 0.0
+        applied = not dry_run and held_out and quality_loss <= max_quality_loss and (merged or dropped)
+        if applied:
+            storage.rewrite(compacted)
+            compact_usage(cbl_filename, merged, dropped)
+
+    return CompactionReport(len(cbr.cocktails), len(compacted), merged, dropped, time_before, time_after,
+                            quality_before, quality_after, bool(applied))
+
+
+def parse_arguments():
+    """ Define program input arguments and parse them.
+    """
+    # Create the parser and add arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument(dest='caselibrary', type=str, help="Filepath of the case library")
+    parser.add_argument('-t', '--held-out', type=str,
+                        help="Filepath of the JSON with the held-out constraints to measure retrieval")
+    parser.add_argument('--min-overlap', type=float, default=0.9,
+                        help="Minimum ingredient overlap of near-duplicate cases")
+    parser.add_argument('--min-utility', type=float, default=0.5,
+                        help="Minimum utility of the unused learned cases that are kept")
+    parser.add_argument('--max-idle-days', type=float, default=MAX_IDLE_DAYS,
+                        help="Days without being retrieved after which a learned case is unused")
+    parser.add_argument('--drop-failures', action='store_true', help="Also drop unused failures")
+    parser.add_argument('--max-quality-loss', type=float, default=0.02,
+                        help="Maximum relative loss of retrieval quality accepted")
+    parser.add_argument('--dry-run', action='store_true', help="Report without modifying the case library")
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    return args
+
+
+if __name__ == "__main__":
+    """ Compact a case library to bound its growth.
+
+    usage: maintenance.py [-h] [-t HELD_OUT] [--min-overlap MIN_OVERLAP] [--min-utility MIN_UTILITY]
+                          [--max-idle-days MAX_IDLE_DAYS] [--drop-failures] [--max-quality-loss MAX_QUALITY_LOSS]
+                          [--dry-run] caselibrary
+    """
+    args = parse_arguments()
+    held_out = load_held_out(args.held_out) if args.held_out else []
+    if not held_out and not args.dry_run:
+        print('No held-out constraints to check the retrieval quality (-t), running a dry run')
+
+    report = compact_case_library(args.caselibrary, held_out, args.min_overlap, args.min_utility,
+                                  not args.drop_failures, args.max_quality_loss, args.dry_run,
+                                  args.max_idle_days * 86400)
+
+    print(f'Cases: {report.n_cases_before} -> {report.n_cases_after} '
+          f'({len(report.merged)} merged, {len(report.dropped)} dropped)')
+    if held_out:
+        print(f'Retrieval time: {report.retrieval_time_before:.3f}s -> {report.retrieval_time_after:.3f}s '
+              f'({report.retrieval_time_before - report.retrieval_time_after:.3f}s saved)')
+        print(f'Retrieval quality: {report.quality_before:.4f} -> {report.quality_after:.4f}')
+    print('Case library compacted' if report.applied else 'Case library not modified')
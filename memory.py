@@ -0,0 +1,131 @@
+"""
+
+PW3 - SEL - 2021
+CBR for a cocktail recipe creator
+
+Authors:    Xavier Cucurull Salamero <xavier.cucurull@estudiantat.upc.edu>
+            Daniel Hinjos García <daniel.hinjos@estudiantat.upc.edu>
+            Fernando Vázquez Novoa <fernando.vazquez.novoa@estudiantat.upc.edu>
+            Estela Vázquez-Monjardín Lorenzo <estela.vazquez-monjardin@estudiantat.upc.edu>
+"""
+
+import os
+import sys
+from collections import namedtuple
+from lxml import etree
+
+# Declare MemoryReport namedtuple(), with the memory used by each structure of a CBR
+# sizes: bytes of each structure, objects shared between structures are counted in the first one
+# n_cases: number of cases of the case library
+# traced: (current, peak) bytes traced by tracemalloc, None if it is not tracing
+# top_allocations: (file:line, bytes) of the largest traced allocations of the CBR modules
+# growth_per_case: bytes added to each structure by each case learned since a baseline report
+MemoryReport = namedtuple('MemoryReport', ['sizes', 'n_cases', 'traced', 'top_allocations', 'growth_per_case'])
+
+# Approximate sizes of the libxml2 structures behind an lxml tree, which are not
+# allocated through Python: a node (xmlNode) and an attribute (xmlAttr)
+LXML_NODE_BYTES = 120
+LXML_ATTR_BYTES = 96
+
+
+def deep_getsizeof(obj, seen):
+    """ Compute the size of an object and all the objects it references.
+
+    Args:
+        obj (object): object to measure
+        seen (set): ids of the objects already counted, which are skipped
+
+    Returns:
+        int: size in bytes
+    """
+    size = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+
+        # The lxml nodes behind an Element are measured by lxml_tree_size()
+        if isinstance(obj, etree._Element):
+            continue
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        elif hasattr(obj, '__dict__'):
+            stack.append(vars(obj))
+
+    return size
+
+
+def lxml_tree_size(elements):
+    """ Approximate the memory used by libxml2 for some Elements and their descendants.
+
+    Each element, text, tail and attribute is a libxml2 node, plus the bytes of its content.
+
+    Args:
+        elements (iterable): Elements to measure
+
+    Returns:
+        int: approximate size in bytes
+    """
+    size = 0
+    for element in elements:
+        for node in element.iter():
+            size += LXML_NODE_BYTES + len(node.tag)
+            for text in (node.text, node.tail):
+                if text:
+                    size += LXML_NODE_BYTES + len(text.encode('utf-8'))
+            for key, value in node.attrib.items():
+                size += LXML_ATTR_BYTES + len(key) + LXML_NODE_BYTES + len(value.encode('utf-8'))
+
+    return size
+
+
+def top_allocations(filenames, limit=10):
+    """ Get the largest allocations traced by tracemalloc in some source files.
+
+    Args:
+        filenames (iterable): filenames of the source files
+        limit (int, optional): number of allocation sites. Defaults to 10.
+
+    Returns:
+        list: (file:line, bytes) of the allocation sites, from the largest
+    """
+    import tracemalloc
+
+    filenames = set([os.path.abspath(f) for f in filenames])
+    statistics = tracemalloc.take_snapshot().statistics('lineno')
+    sites = [(f'{os.path.basename(s.traceback[0].filename)}:{s.traceback[0].lineno}', s.size)
+             for s in statistics if os.path.abspath(s.traceback[0].filename) in filenames]
+
+    return sites[:limit]
+
+
+def format_report(report):
+    """ Format a memory report as text.
+
+    Args:
+        report (MemoryReport): memory report
+
+    Returns:
+        str: one line per structure, followed by the traced memory and allocations (if any)
+    """
+    lines = [f'Memory of the CBR ({report.n_cases} cases):']
+    for name, size in sorted(report.sizes.items(), key=lambda item: -item[1]):
+        line = f'  {name:<22}{size / 1024:>10.1f} KiB'
+        if report.growth_per_case is not None:
+            line += f'  {report.growth_per_case[name]:>+10.1f} B/case'
+        lines.append(line)
+    lines.append(f'  {"total":<22}{sum(report.sizes.values()) / 1024:>10.1f} KiB')
+
+    if report.traced is not None:
+        lines.append(f'Traced by tracemalloc: {report.traced[0] / 1024:.1f} KiB '
+                     f'(peak {report.traced[1] / 1024:.1f} KiB)')
+        for location, size in report.top_allocations:
+            lines.append(f'  {location:<22}{size / 1024:>10.1f} KiB')
+
+    return '\n'.join(lines)
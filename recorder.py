@@ -0,0 +1,108 @@
+"""
+
+PW3 - SEL - 2021
+CBR for a cocktail recipe creator
+
+Authors:    Xavier Cucurull Salamero <xavier.cucurull@estudiantat.upc.edu>
+            Daniel Hinjos García <daniel.hinjos@estudiantat.upc.edu>
+            Fernando Vázquez Novoa <fernando.vazquez.novoa@estudiantat.upc.edu>
+            Estela Vázquez-Monjardín Lorenzo <estela.vazquez-monjardin@estudiantat.upc.edu>
+"""
+
+import json
+import os
+import time
+
+
+class WorkloadRecorder:
+    """ Append the queries and evaluations received by a CBR to a JSONL log.
+
+    Each line is a JSON object with the type of event ("query" or "evaluation"),
+    the time it was recorded and its fields. Evaluations refer to the query of the
+    adapted case they evaluate, so that the log can be replayed with replay.py.
+    """
+
+    def __init__(self, filename):
+        """ Initialize the recorder.
+
+        Args:
+            filename (str): filename of the JSONL log, new events are appended to it
+        """
+        self.filename = filename
+        self.log_file = open(filename, 'a')
+
+        # Identifier of the events of this process, so that logs written concurrently can be told apart
+        self.session = f'{os.getpid()}-{time.time_ns()}'
+        self.n_queries = 0
+
+    def _write(self, event):
+        """ Write an event as a single line, so that concurrent writers do not interleave.
+
+        Args:
+            event (dict): fields of the event
+        """
+        self.log_file.write(json.dumps(event) + '\n')
+        self.log_file.flush()
+
+    def record_query(self, constraints, retrieved, adapted, original, n_retrievals, timings, seed=None):
+        """ Record a call to get_new_case.
+
+        Args:
+            constraints (dict): constraints of the query
+            retrieved (str): name of the retrieved case
+            adapted (str): name of the adapted case
+            original (boolean): whether the adapted case is the original retrieved one
+            n_retrievals (int): number of cases retrieved until one was accepted
+            timings (dict): time in seconds of the retrieval, adaptation and whole query
+            seed (int, optional): seed of the random generator of the query. Defaults to None.
+
+        Returns:
+            int: identifier of the query in the session
+        """
+        query_id = self.n_queries
+        self.n_queries += 1
+
+        event = {'event': 'query', 'session': self.session, 'query': query_id, 'timestamp': time.time(),
+                 'constraints': constraints, 'retrieved': retrieved, 'adapted': adapted,
+                 'original': original, 'n_retrievals': n_retrievals, 'timings': timings}
+        if seed is not None:
+            event['seed'] = seed
+        self._write(event)
+
+        return query_id
+
+    def record_evaluation(self, query_id, retrieved, adapted, score, evaluation, timings):
+        """ Record a call to evaluate_new_case.
+
+        Args:
+            query_id (int): identifier of the query of the evaluated case, returned by record_query
+            retrieved (str): name of the retrieved case
+            adapted (str): name of the evaluated adapted case
+            score (float): evaluation score given by the user
+            evaluation (str): resulting evaluation, Success or Failure
+            timings (dict): time in seconds of the learning phase
+        """
+        self._write({'event': 'evaluation', 'session': self.session,
+                     'query': query_id, 'timestamp': time.time(),
+                     'retrieved': retrieved, 'adapted': adapted, 'score': score, 'evaluation': evaluation,
+                     'timings': timings})
+
+    def close(self):
+        """ Close the log file.
+        """
+        self.log_file.close()
+
+
+def read_log(filename):
+    """ Read the events of a JSONL log.
+
+    Args:
+        filename (str): filename of the JSONL log
+
+    Yields:
+        dict: recorded events, in order
+    """
+    with open(filename) as log_file:
+        for line in log_file:
+            if line.strip():
+                yield json.loads(line)
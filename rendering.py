@@ -0,0 +1,130 @@
+"""
+
+PW3 - SEL - 2021
+CBR for a cocktail recipe creator
+
+Authors:    Xavier Cucurull Salamero <xavier.cucurull@estudiantat.upc.edu>
+            Daniel Hinjos García <daniel.hinjos@estudiantat.upc.edu>
+            Fernando Vázquez Novoa <fernando.vazquez.novoa@estudiantat.upc.edu>
+            Estela Vázquez-Monjardín Lorenzo <estela.vazquez-monjardin@estudiantat.upc.edu>
+"""
+
+import re
+from collections import namedtuple, OrderedDict
+
+# Declare RecipeIngredient namedtuple(), with an ingredient line of a recipe
+RecipeIngredient = namedtuple('RecipeIngredient', ['name', 'measure', 'alc_type', 'basic_taste'])
+
+# Declare Recipe namedtuple(), with the rendered recipe of a cocktail
+# steps: preparation steps, with the ingredient identifiers replaced by their names
+# ingredients_text, preparation_text: one line per ingredient (measure and name) and per step
+Recipe = namedtuple('Recipe', ['name', 'category', 'glasstype', 'ingredients', 'steps',
+                               'ingredients_text', 'preparation_text'])
+
+# Ingredient identifiers in the preparation steps
+INGREDIENT_ID_PATTERN = re.compile(r'\b(ingr\d+)\b')
+
+# Number of recipes kept by the cache of the CBR
+RECIPE_CACHE_SIZE = 256
+
+
+def render_recipe(cocktail):
+    """ Render the recipe of a cocktail.
+
+    Args:
+        cocktail (Element): cocktail Element
+
+    Returns:
+        Recipe: structured recipe, with its ingredients and preparation as text
+    """
+    ingredients = []
+    names = {}
+    for i in cocktail.findall('ingredients/ingredient'):
+        ingredients.append(RecipeIngredient(i.text, i.get('measure'), i.get('alc_type'), i.get('basic_taste')))
+        # If an identifier is repeated, the steps refer to its first ingredient
+        names.setdefault(i.get('id'), i.text)
+
+    # Replace the identifiers of all the ingredients in a single pass over each step
+    steps = [INGREDIENT_ID_PATTERN.sub(lambda match: names.get(match.group(1), match.group(1)), s.text)
+             for s in cocktail.findall('preparation/step')]
+
+    return Recipe(cocktail.find('name').text, cocktail.find('category').text, cocktail.find('glasstype').text,
+                  tuple(ingredients), tuple(steps),
+                  ''.join([f'{i.measure} {i.name}\n' for i in ingredients]),
+                  ''.join([f'{step}\n' for step in steps]))
+
+
+def format_recipe(recipe):
+    """ Format a recipe as text, with its name, ingredients and preparation.
+
+    Args:
+        recipe (Recipe): rendered recipe
+
+    Returns:
+        str: text of the recipe
+    """
+    return f'{recipe.name}\n\nIngredients:\n{recipe.ingredients_text}\nPreparation:\n{recipe.preparation_text}'
+
+
+def recipe_to_dict(recipe):
+    """ Convert a recipe into a JSON serializable dict.
+
+    Args:
+        recipe (Recipe): rendered recipe
+
+    Returns:
+        dict: name, category, glass type, ingredients and preparation steps of the recipe
+    """
+    return {'name': recipe.name,
+            'category': recipe.category,
+            'glasstype': recipe.glasstype,
+            'ingredients': [dict(i._asdict()) for i in recipe.ingredients],
+            'preparation': list(recipe.steps)}
+
+
+class RecipeCache:
+    """ Least recently used cache of the rendered recipes of the cocktails, by name.
+
+    A cached recipe is only used for the same Element it was rendered from, and
+    it must be invalidated when the Element is modified.
+    """
+
+    def __init__(self, max_size=RECIPE_CACHE_SIZE):
+        """ Initialize the cache.
+
+        Args:
+            max_size (int, optional): maximum number of recipes. Defaults to RECIPE_CACHE_SIZE.
+        """
+        self.max_size = max_size
+        self._recipes = OrderedDict()
+
+    def get(self, cocktail):
+        """ Get the recipe of a cocktail, rendering it if it is not cached.
+
+        Args:
+            cocktail (Element): cocktail Element
+
+        Returns:
+            Recipe: rendered recipe
+        """
+        name = cocktail.find('name').text
+        cached = self._recipes.get(name)
+        if cached is not None and cached[0] is cocktail:
+            self._recipes.move_to_end(name)
+            return cached[1]
+
+        recipe = render_recipe(cocktail)
+        self._recipes[name] = (cocktail, recipe)
+        self._recipes.move_to_end(name)
+        if len(self._recipes) > self.max_size:
+            self._recipes.popitem(last=False)
+
+        return recipe
+
+    def invalidate(self, name):
+        """ Remove the recipe of a cocktail from the cache.
+
+        Args:
+            name (str): cocktail name
+        """
+        self._recipes.pop(name, None)
@@ -0,0 +1,156 @@
+"""
+
+PW3 - SEL - 2021
+CBR for a cocktail recipe creator
+
+Authors:    Xavier Cucurull Salamero <xavier.cucurull@estudiantat.upc.edu>
+            Daniel Hinjos García <daniel.hinjos@estudiantat.upc.edu>
+            Fernando Vázquez Novoa <fernando.vazquez.novoa@estudiantat.upc.edu>
+            Estela Vázquez-Monjardín Lorenzo <estela.vazquez-monjardin@estudiantat.upc.edu>
+"""
+
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+from collections import namedtuple
+
+from cbr import CBR
+from recorder import read_log
+
+# Declare ReplayReport namedtuple(), with the timings of the replayed and the recorded workload
+ReplayReport = namedtuple('ReplayReport', ['n_queries', 'n_evaluations', 'n_diverged', 'n_errors',
+                                           'query_times', 'recorded_query_times',
+                                           'learning_times', 'recorded_learning_times'])
+
+
+def copy_case_library(cbl_filename, directory):
+    """ Copy a case library (XML file, sharded directory or SQLite database) into a directory.
+
+    Args:
+        cbl_filename (str): path of the case library
+        directory (str): directory where the copy is created
+
+    Returns:
+        str: path of the copy
+    """
+    copy_path = os.path.join(directory, os.path.basename(os.path.normpath(cbl_filename)))
+    if os.path.isdir(cbl_filename):
+        shutil.copytree(cbl_filename, copy_path)
+    else:
+        shutil.copy(cbl_filename, copy_path)
+
+    return copy_path
+
+
+def replay(log_filename, cbl_filename, seed=0, lazy=False, record=None):
+    """ Re-run a recorded workload against a copy of a case library.
+
+    Queries are run with get_new_case and evaluations with evaluate_new_case, using the same
+    scores, so that the library evolves as in the recorded run. Queries recorded with a seed are
+    replayed with the same seed, the others use the global generator seeded with seed.
+    The original library is not modified.
+
+    Args:
+        log_filename (str): filename of the JSONL log recorded by the CBR
+        cbl_filename (str): path of the case library
+        seed (int, optional): seed of the random generator. Defaults to 0.
+        lazy (boolean, optional): load the categories of the library lazily. Defaults to False.
+        record (str, optional): filename of a JSONL log where the replay is recorded. Defaults to None.
+
+    Returns:
+        ReplayReport: number of replayed events, queries whose retrieved or adapted case differ from
+                      the recorded ones, queries that failed and replayed and recorded timings
+    """
+    random.seed(seed)
+    report = ReplayReport(0, 0, 0, 0, [], [], [], [])
+
+    with tempfile.TemporaryDirectory() as directory:
+        cbr = CBR(copy_case_library(cbl_filename, directory), lazy=lazy, record=record)
+
+        # Cases returned by each query, to be evaluated by the following evaluation events
+        results = {}
+        for event in read_log(log_filename):
+            query = (event.get('session'), event.get('query'))
+
+            if event['event'] == 'query':
+                start_time = time.perf_counter()
+                try:
+                    retrieved_case, adapted_case, original = cbr.get_new_case(event['constraints'], event.get('seed'))
+                except ValueError:
+                    report = report._replace(n_errors=report.n_errors + 1)
+                    continue
+                report.query_times.append(time.perf_counter() - start_time)
+                report.recorded_query_times.append(event['timings']['total'])
+
+                results[query] = (retrieved_case, adapted_case, cbr.last_query.query)
+                diverged = (retrieved_case.find('name').text != event['retrieved'] or
+                            adapted_case.find('name').text != event['adapted'])
+                report = report._replace(n_queries=report.n_queries + 1,
+                                         n_diverged=report.n_diverged + diverged)
+
+            elif event['event'] == 'evaluation' and query in results:
+                retrieved_case, adapted_case, query_id = results.pop(query)
+                start_time = time.perf_counter()
+                cbr.evaluate_new_case(retrieved_case, adapted_case, event['score'], query_id)
+                report.learning_times.append(time.perf_counter() - start_time)
+                report.recorded_learning_times.append(event['timings']['learning'])
+                report = report._replace(n_evaluations=report.n_evaluations + 1)
+
+        cbr.close()
+
+    return report
+
+
+def percentile(values, q):
+    """ Compute a percentile of a list of values (nearest rank).
+
+    Args:
+        values (list): values
+        q (float): percentile, between 0 and 100
+
+    Returns:
+        float: percentile of the values, 0.0 if there are none
+    """
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+def parse_arguments():
+    """ Define program input arguments and parse them.
+    """
+    # Create the parser and add arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument(dest='log', type=str, help="Filepath of the JSONL log recorded by the CBR")
+    parser.add_argument(dest='caselibrary', type=str, help="Filepath of the case library (it is not modified)")
+    parser.add_argument('--seed', type=int, help="Seed of the random generator", default=0)
+    parser.add_argument('--lazy', action='store_true', help="Load the categories of the library lazily")
+    parser.add_argument('--record', type=str, help="Filepath of a JSONL log where the replay is recorded")
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    return args
+
+
+if __name__ == "__main__":
+    """ Replay a recorded workload to reproduce and benchmark its performance.
+
+    usage: replay.py [-h] [--seed SEED] [--lazy] [--record RECORD] log caselibrary
+    """
+    args = parse_arguments()
+    report = replay(args.log, args.caselibrary, args.seed, args.lazy, args.record)
+
+    print(f'Replayed {report.n_queries} queries and {report.n_evaluations} evaluations '
+          f'({report.n_diverged} diverged from the log, {report.n_errors} failed)')
+    for title, times, recorded_times in [('Query', report.query_times, report.recorded_query_times),
+                                         ('Learning', report.learning_times, report.recorded_learning_times)]:
+        if times:
+            print(f'{title} time (replayed / recorded): '
+                  f'total {sum(times):.3f}s / {sum(recorded_times):.3f}s, '
+                  f'p50 {percentile(times, 50) * 1000:.1f}ms / {percentile(recorded_times, 50) * 1000:.1f}ms, '
+                  f'p95 {percentile(times, 95) * 1000:.1f}ms / {percentile(recorded_times, 95) * 1000:.1f}ms')
@@ -0,0 +1,152 @@
+"""
+
+PW3 - SEL - 2021
+CBR for a cocktail recipe creator
+
+Authors:    Xavier Cucurull Salamero <xavier.cucurull@estudiantat.upc.edu>
+            Daniel Hinjos García <daniel.hinjos@estudiantat.upc.edu>
+            Fernando Vázquez Novoa <fernando.vazquez.novoa@estudiantat.upc.edu>
+            Estela Vázquez-Monjardín Lorenzo <estela.vazquez-monjardin@estudiantat.upc.edu>
+"""
+
+import itertools
+from abc import ABC, abstractmethod
+
+from features import CaseRows
+
+# Registered similarity backends, by name
+SIMILARITY_BACKENDS = {}
+
+
+def register_backend(name, backend_class):
+    """ Register a similarity backend, so that it can be chosen by name with CBR(..., similarity=name).
+
+    Args:
+        name (str): name of the backend
+        backend_class (type): subclass of SimilarityBackend
+    """
+    SIMILARITY_BACKENDS[name] = backend_class
+
+
+def create_backend(name, cbr):
+    """ Create the similarity backend of a CBR.
+
+    Args:
+        name (str): name of a registered backend
+        cbr (CBR): CBR whose cases are scored
+
+    Returns:
+        SimilarityBackend: similarity backend
+    """
+    if name not in SIMILARITY_BACKENDS:
+        raise ValueError(f'Unknown similarity backend: {name} (available: {", ".join(sorted(SIMILARITY_BACKENDS))})')
+
+    backend_class = SIMILARITY_BACKENDS[name]
+    if not backend_class.supports(cbr):
+        raise ValueError(f'The similarity backend {name} is not supported by this CBR')
+
+    return backend_class(cbr)
+
+
+class SimilarityBackend(ABC):
+    """ Computes the similarity between a set of constraints and the cases of a CBR.
+
+    Backends must give the same similarities and rankings as the reference backend,
+    or differ at most by their tolerance if they are approximate.
+    """
+
+    # Maximum absolute difference with the similarities of the reference backend
+    tolerance = 0.0
+
+    def __init__(self, cbr):
+        self.cbr = cbr
+
+    @classmethod
+    def supports(cls, cbr):
+        """ Check if the backend can score the cases of a CBR.
+
+        Args:
+            cbr (CBR): CBR whose cases are scored
+
+        Returns:
+            boolean: True if the backend can be used
+        """
+        return True
+
+    @abstractmethod
+    def similarities(self, constraints, categories, skip_failures=False, limit=None, hard_constraints=None):
+        """ Compute the similarity between a set of constraints and the cases of some categories.
+
+        Args:
+            constraints (dict): dictionary of constraints
+            categories (list): categories of the cases, all the cases if it is empty
+            skip_failures (boolean, optional): skip the cases which are failures and parents of failures.
+                                               Defaults to False.
+            limit (int, optional): number of most similar cases needed, backends may only return them
+                                   (and their ties). Defaults to None.
+            hard_constraints (dict, optional): constraints that the cases must fulfill to be scored.
+                                               Defaults to None.
+
+        Returns:
+            searching_list (list): cocktail Elements of the cases
+            sim_list (list): similarity of each case
+        """
+
+
+class ReferenceBackend(SimilarityBackend):
+    """ Pure Python similarity, reading each case Element with CBR._compute_similarity. """
+
+    def similarities(self, constraints, categories, skip_failures=False, limit=None, hard_constraints=None):
+        cbr = self.cbr
+        # Cases in library order (by sorted category in lazy mode, where there is no tree)
+        if categories:
+            searching_list = list(itertools.chain.from_iterable([cbr.library_by_category[cat]
+                                                                 for cat in categories]))
+        elif cbr.cocktails is not None:
+            searching_list = list(cbr.cocktails)
+        else:
+            searching_list = list(itertools.chain.from_iterable(cbr.library_by_category.values()))
+
+        # Keep only the cases which are not failure nor parents of failures
+        if skip_failures:
+            failure_parents = set(cbr.failure_parents)
+            searching_list = [c for c in searching_list if c.find("evaluation").text != "Failure"
+                              or c.find("name").text not in failure_parents]
+
+        # Keep only the cases which fulfill the hard constraints, through the indexes of the storage if it can
+        if hard_constraints and cbr.storage.supports_queries:
+            candidates = set(cbr.storage.find_cases(
+                categories, glass_types=hard_constraints.get('glass_type') or (),
+                exc_ingredients=hard_constraints.get('exc_ingredients') or (),
+                exc_alc_types=hard_constraints.get('exc_alc_type') or (),
+                exc_basic_tastes=hard_constraints.get('exc_basic_taste') or ()))
+            searching_list = [c for c in searching_list if c.find('name').text in candidates]
+        elif hard_constraints:
+            searching_list = [c for c in searching_list
+                              if cbr._evaluate_constraints_fulfillment(hard_constraints, c)[0]]
+
+        return searching_list, [cbr._compute_similarity(constraints, c) for c in searching_list]
+
+
+class FeatureBackend(SimilarityBackend):
+    """ Vectorized similarity, computed from the bitsets of the feature store of the CBR
+    (in memory or memory-mapped). The cases are only loaded when they are accessed.
+    """
+
+    @classmethod
+    def supports(cls, cbr):
+        return cbr.features is not None
+
+    def similarities(self, constraints, categories, skip_failures=False, limit=None, hard_constraints=None):
+        cbr = self.cbr
+        terms = cbr.features.compile_similarity(constraints, cbr.similarity_weights,
+                                                cbr.alcohol_dict, cbr.basic_dict)
+        checks = cbr.features.compile_fulfillment(hard_constraints) if hard_constraints else None
+        rows, sim_list = cbr.features.search(terms, categories, limit,
+                                             set(cbr.failure_parents) if skip_failures else (), checks)
+
+        return CaseRows(cbr.features, rows), sim_list
+
+
+register_backend('reference', ReferenceBackend)
+register_backend('features', FeatureBackend)
@@ -0,0 +1,346 @@
+"""
+
+PW3 - SEL - 2021
+CBR for a cocktail recipe creator
+
+Authors:    Xavier Cucurull Salamero <xavier.cucurull@estudiantat.upc.edu>
+            Daniel Hinjos García <daniel.hinjos@estudiantat.upc.edu>
+            Fernando Vázquez Novoa <fernando.vazquez.novoa@estudiantat.upc.edu>
+            Estela Vázquez-Monjardín Lorenzo <estela.vazquez-monjardin@estudiantat.upc.edu>
+"""
+
+import json
+import os
+import zlib
+from collections import Counter
+
+from storage import MANIFEST_FILENAME, atomic_write, file_signature, open_storage
+
+# Name of the statistics cache, next to the case library (or inside a sharded case library)
+STATS_SUFFIX = '.stats.json'
+STATS_FILENAME = 'stats.json'
+
+
+def names_checksum(names):
+    """ Compute an order independent checksum of the names of the cases of a library.
+
+    Args:
+        names (iterable): case names
+
+    Returns:
+        int: checksum, which can be updated by adding the checksum of new names
+    """
+    return sum([zlib.crc32(name.encode('utf-8')) for name in names]) % 2**32
+
+
+def statistics_filename(cbl_filename):
+    """ Get the filename of the statistics cache of a case library.
+
+    Args:
+        cbl_filename (str): path of the case library
+
+    Returns:
+        str: filename of the statistics cache
+    """
+    if os.path.isdir(cbl_filename):
+        return os.path.join(cbl_filename, STATS_FILENAME)
+    return cbl_filename + STATS_SUFFIX
+
+
+def library_signature(cbl_filename):
+    """ Get a signature of the files of a case library that change when cases are added or removed.
+
+    Args:
+        cbl_filename (str): path of the case library
+
+    Returns:
+        list: signature of the library file (the manifest for sharded libraries)
+    """
+    if os.path.isdir(cbl_filename):
+        return list(file_signature(os.path.join(cbl_filename, MANIFEST_FILENAME)))
+    return list(file_signature(cbl_filename))
+
+
+class IngredientCooccurrence:
+    """ Number of cases in which each pair of ingredients appears together.
+
+    Failed cases are not counted, since their ingredients were judged incompatible.
+    """
+
+    def __init__(self):
+        # Number of cases of each ingredient, and of each pair of ingredients (in both orders)
+        self.cases = Counter()
+        self.pairs = {}
+
+    @classmethod
+    def from_cases(cls, cases):
+        """ Count the co-occurrences of the ingredients of some cases.
+
+        Args:
+            cases (iterable): cocktail Elements
+
+        Returns:
+            IngredientCooccurrence: co-occurrences of the cases
+        """
+        cooccurrence = cls()
+        for case in cases:
+            cooccurrence.add_case(case)
+
+        return cooccurrence
+
+    def add_case(self, case):
+        """ Update the co-occurrences with a new case.
+
+        Args:
+            case (Element): cocktail Element
+        """
+        if case.find('evaluation').text == 'Failure':
+            return
+
+        names = set([ingr.text for ingr in case.findall('ingredients/ingredient')])
+        for name in names:
+            self.cases[name] += 1
+            pairs = self.pairs.setdefault(name, Counter())
+            for other in names:
+                if other != name:
+                    pairs[other] += 1
+
+    def compatibility(self, name, names):
+        """ Compute the compatibility of an ingredient with the ingredients of a cocktail.
+
+        Args:
+            name (str): ingredient name
+            names (iterable): ingredient names of the cocktail
+
+        Returns:
+            float: sum of the fractions of the cases of the ingredient that contain each ingredient
+                   of the cocktail, 0 if the ingredient is unknown
+        """
+        if not self.cases[name]:
+            return 0.0
+
+        pairs = self.pairs[name]
+        return sum([pairs[other] for other in names if other != name]) / self.cases[name]
+
+
+class LibraryStatistics:
+    """ Frequencies and unique counts of a case library, computed in a single pass over its cases.
+
+    Cases can be added incrementally and the statistics can be cached as JSON.
+    """
+
+    def __init__(self):
+        self.n_cases = 0
+        self.n_learned = 0
+        self.names_checksum = 0
+
+        # Number of cases of each category and glass type
+        self.categories = Counter()
+        self.glass_types = Counter()
+
+        # Number of occurrences of each ingredient, alcohol type and (non-alcoholic) basic taste
+        self.ingredients = Counter()
+        self.alc_types = Counter()
+        self.basic_tastes = Counter()
+
+        # Unique ingredients of each alcohol type, of each (non-alcoholic) basic taste and of each category
+        self.alc_type_ingredients = {}
+        self.basic_taste_ingredients = {}
+        self.category_ingredients = {}
+
+    @classmethod
+    def from_cases(cls, cases):
+        """ Compute the statistics of some cases.
+
+        Args:
+            cases (iterable): cocktail Elements
+
+        Returns:
+            LibraryStatistics: statistics of the cases
+        """
+        statistics = cls()
+        for case in cases:
+            statistics.add_case(case)
+
+        return statistics
+
+    def add_case(self, case):
+        """ Update the statistics with a new case.
+
+        Args:
+            case (Element): cocktail Element
+        """
+        self.n_cases += 1
+        self.n_learned += case.find('derivation').text.lower() != 'original'
+        self.names_checksum = (self.names_checksum + names_checksum([case.find('name').text])) % 2**32
+
+        self.categories[case.find('category').text] += 1
+        self.glass_types[case.find('glasstype').text] += 1
+
+        category_ingredients = self.category_ingredients.setdefault(case.find('category').text, set())
+        for ingr in case.findall('ingredients/ingredient'):
+            self.ingredients[ingr.text] += 1
+            category_ingredients.add(ingr.text)
+            if ingr.get('alc_type'):
+                self.alc_types[ingr.get('alc_type')] += 1
+                self.alc_type_ingredients.setdefault(ingr.get('alc_type'), set()).add(ingr.text)
+            elif ingr.get('basic_taste'):
+                self.basic_tastes[ingr.get('basic_taste')] += 1
+                self.basic_taste_ingredients.setdefault(ingr.get('basic_taste'), set()).add(ingr.text)
+
+    def matches(self, checksum):
+        """ Check if the statistics correspond to the cases with the given names checksum.
+
+        Args:
+            checksum (int): checksum of the case names, from names_checksum()
+
+        Returns:
+            boolean: True if the statistics are up to date
+        """
+        return self.names_checksum == checksum
+
+    def to_dict(self):
+        """ Convert the statistics into a JSON serializable dict.
+
+        Returns:
+            dict: statistics
+        """
+        return {'n_cases': self.n_cases, 'n_learned': self.n_learned, 'names_checksum': self.names_checksum,
+                'categories': self.categories, 'glass_types': self.glass_types, 'ingredients': self.ingredients,
+                'alc_types': self.alc_types, 'basic_tastes': self.basic_tastes,
+                'alc_type_ingredients': {k: sorted(v) for k, v in self.alc_type_ingredients.items()},
+                'basic_taste_ingredients': {k: sorted(v) for k, v in self.basic_taste_ingredients.items()},
+                'category_ingredients': {k: sorted(v) for k, v in self.category_ingredients.items()}}
+
+    @classmethod
+    def from_dict(cls, data):
+        """ Build the statistics from a dict created by to_dict().
+
+        Args:
+            data (dict): statistics
+
+        Returns:
+            LibraryStatistics: statistics
+        """
+        statistics = cls()
+        statistics.n_cases = data['n_cases']
+        statistics.n_learned = data['n_learned']
+        statistics.names_checksum = data['names_checksum']
+        for field in ['categories', 'glass_types', 'ingredients', 'alc_types', 'basic_tastes']:
+            setattr(statistics, field, Counter(data[field]))
+        for field in ['alc_type_ingredients', 'basic_taste_ingredients', 'category_ingredients']:
+            setattr(statistics, field, {k: set(v) for k, v in data[field].items()})
+
+        return statistics
+
+
+def save_statistics(cbl_filename, statistics):
+    """ Cache the statistics of a case library next to it.
+
+    Args:
+        cbl_filename (str): path of the case library
+        statistics (LibraryStatistics): statistics of the library
+    """
+    data = statistics.to_dict()
+    data['signature'] = library_signature(cbl_filename)
+
+    # The cache is optional, libraries in read-only directories are not cached
+    try:
+        with atomic_write(statistics_filename(cbl_filename), 'w') as json_file:
+            json.dump(data, json_file)
+    except OSError:
+        pass
+
+
+def load_statistics(cbl_filename, checksum=None):
+    """ Load the cached statistics of a case library.
+
+    The cache is valid if it matches the checksum of the case names or, if no checksum
+    is given, if the library files have not changed since the cache was written.
+
+    Args:
+        cbl_filename (str): path of the case library
+        checksum (int, optional): checksum of the names of the cases of the library. Defaults to None.
+
+    Returns:
+        LibraryStatistics: cached statistics, None if there is no valid cache
+    """
+    try:
+        with open(statistics_filename(cbl_filename)) as json_file:
+            data = json.load(json_file)
+    except (OSError, ValueError):
+        return None
+
+    if checksum is None and data.get('signature') != library_signature(cbl_filename):
+        return None
+
+    # Caches written without some of the statistics are computed again
+    try:
+        statistics = LibraryStatistics.from_dict(data)
+    except KeyError:
+        return None
+
+    if checksum is not None and not statistics.matches(checksum):
+        return None
+
+    return statistics
+
+
+def get_statistics(cbl_filename):
+    """ Get the statistics of a case library, from the cache if it is up to date.
+
+    Args:
+        cbl_filename (str): path of the case library
+
+    Returns:
+        LibraryStatistics: statistics of the library
+    """
+    statistics = load_statistics(cbl_filename)
+    if statistics is None:
+        statistics = LibraryStatistics.from_cases(open_storage(cbl_filename).load())
+        save_statistics(cbl_filename, statistics)
+
+    return statistics
+
+
+def print_statistics(statistics):
+    """ Print the statistics of a case library.
+
+    Args:
+        statistics (LibraryStatistics): statistics of the library
+    """
+    print(f'Cases: {statistics.n_cases} ({statistics.n_learned} learned)')
+    for title, values in [('Categories', statistics.categories), ('Alcohol Type', statistics.alc_types),
+                          ('Basic Taste', statistics.basic_tastes), ('Ingredients', statistics.ingredients),
+                          ('Glass', statistics.glass_types)]:
+        print(f'\n{title} ({len(values)}):')
+        print(', '.join(values).replace(' / ', '/'))
+
+
+def plot_statistics(statistics, output_dir):
+    """ Save the histograms of the statistics of a case library.
+
+    Args:
+        statistics (LibraryStatistics): statistics of the library
+        output_dir (str): directory where the images are saved
+    """
+    from matplotlib import pyplot as plt
+
+    unique_alc = Counter({k: len(v) for k, v in statistics.alc_type_ingredients.items()})
+    unique_basic = Counter({k: len(v) for k, v in statistics.basic_taste_ingredients.items()})
+    unique_category = Counter({k: len(v) for k, v in statistics.category_ingredients.items()})
+
+    for counts, title, filename in [
+            (statistics.alc_types, "Number of times an alcohol appears in a recipe", 'popular_alcohol_types'),
+            (statistics.basic_tastes, "Number of times a basic taste appears in a recipe", 'popular_basic_tastes'),
+            (unique_alc, "Number of unique ingredients for each type of alcohol", 'unique_alcohols_by_type'),
+            (unique_basic, "Number of unique ingredients for each type of non alcoholic beverage",
+             'unique_beverages_by_type'),
+            (unique_category, "Number of unique cocktails for each category", 'unique_cocktails_by_category')]:
+        labels, values = zip(*counts.most_common()) if counts else ((), ())
+        plt.bar(range(len(values)), values, color="tab:green")
+        plt.xticks(range(len(labels)), labels, rotation=45, horizontalalignment='right', fontsize=10)
+        plt.title(title)
+        plt.tight_layout()
+        plt.savefig(os.path.join(output_dir, filename))
+        plt.clf()
@@ -0,0 +1,943 @@
+"""
+
+PW3 - SEL - 2021
+CBR for a cocktail recipe creator
+
+Authors:    Xavier Cucurull Salamero <xavier.cucurull@estudiantat.upc.edu>
+            Daniel Hinjos García <daniel.hinjos@estudiantat.upc.edu>
+            Fernando Vázquez Novoa <fernando.vazquez.novoa@estudiantat.upc.edu>
+            Estela Vázquez-Monjardín Lorenzo <estela.vazquez-monjardin@estudiantat.upc.edu>
+"""
+
+import argparse
+import json
+import os
+import re
+import tempfile
+from abc import ABC, abstractmethod
+from collections import OrderedDict, Counter
+from collections.abc import Mapping
+from contextlib import contextmanager
+from lxml import etree
+
+# Advisory file locks are only available on POSIX systems
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Name of the file describing a case library sharded by category
+MANIFEST_FILENAME = 'manifest.json'
+
+# Suffix of the lock files of the case libraries
+LOCK_SUFFIX = '.lock'
+
+# Extensions of the SQLite case libraries
+SQLITE_EXTENSIONS = ('.db', '.sqlite', '.sqlite3')
+
+# Schema of the SQLite case libraries
+SQLITE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS cases (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    category TEXT NOT NULL,
+    glasstype TEXT,
+    utility TEXT,
+    derivation TEXT,
+    evaluation TEXT,
+    revision INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS ingredients (
+    case_id INTEGER NOT NULL REFERENCES cases(id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    identifier TEXT,
+    name TEXT NOT NULL,
+    alc_type TEXT,
+    basic_taste TEXT,
+    measure TEXT,
+    quantity TEXT,
+    unit TEXT
+);
+CREATE TABLE IF NOT EXISTS steps (
+    case_id INTEGER NOT NULL REFERENCES cases(id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    text TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_cases_category ON cases(category);
+CREATE INDEX IF NOT EXISTS idx_cases_glasstype ON cases(glasstype);
+CREATE INDEX IF NOT EXISTS idx_cases_revision ON cases(revision);
+CREATE INDEX IF NOT EXISTS idx_ingredients_case ON ingredients(case_id);
+CREATE INDEX IF NOT EXISTS idx_ingredients_name ON ingredients(name);
+CREATE INDEX IF NOT EXISTS idx_ingredients_alc_type ON ingredients(alc_type);
+CREATE INDEX IF NOT EXISTS idx_ingredients_basic_taste ON ingredients(basic_taste);
+CREATE INDEX IF NOT EXISTS idx_steps_case ON steps(case_id);
+'''
+
+
+@contextmanager
+def atomic_write(filename, mode='wb'):
+    """ Open a temporary file that replaces the given file once it is completely written.
+
+    A crash while writing leaves the previous version of the file untouched.
+
+    Args:
+        filename (str): filename to write
+        mode (str, optional): mode to open the file. Defaults to 'wb'.
+
+    Yields:
+        file: temporary file object
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmp_filename = tempfile.mkstemp(dir=directory, prefix=f'.{os.path.basename(filename)}.', suffix='.tmp')
+    try:
+        # Keep the permissions of the replaced file
+        if os.path.exists(filename):
+            os.chmod(tmp_filename, os.stat(filename).st_mode)
+
+        with os.fdopen(fd, mode) as tmp_file:
+            yield tmp_file
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+
+
+@contextmanager
+def file_lock(filename):
+    """ Hold an exclusive advisory lock on a lock file.
+
+    On systems without fcntl the lock does nothing.
+
+    Args:
+        filename (str): filename of the lock file
+    """
+    with open(filename, 'a') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def file_signature(filename):
+    """ Get a signature of a file that changes when the file is rewritten.
+
+    Args:
+        filename (str): filename
+
+    Returns:
+        tuple: modification time (ns), size and inode of the file
+    """
+    stat = os.stat(filename)
+    return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+
+def shard_filename(category, used_filenames=()):
+    """ Get the filename of the shard of a category.
+
+    Args:
+        category (str): cocktail category
+        used_filenames (iterable, optional): filenames already assigned to other categories
+
+    Returns:
+        str: shard filename
+    """
+    slug = re.sub(r'[^a-z0-9]+', '_', category.lower()).strip('_') or 'category'
+    filename = f'{slug}.xml'
+    idx = 1
+    while filename in used_filenames:
+        idx += 1
+        filename = f'{slug}_{idx}.xml'
+
+    return filename
+
+
+def load_manifest(library_dir):
+    """ Load the manifest of a sharded case library.
+
+    Args:
+        library_dir (str): directory of the sharded case library
+
+    Returns:
+        dict: manifest, with the shard filename and vocabularies of each category
+    """
+    with open(os.path.join(library_dir, MANIFEST_FILENAME)) as json_file:
+        return json.load(json_file)
+
+
+def save_manifest(library_dir, manifest):
+    """ Save the manifest of a sharded case library.
+
+    Args:
+        library_dir (str): directory of the sharded case library
+        manifest (dict): manifest to save
+    """
+    with atomic_write(os.path.join(library_dir, MANIFEST_FILENAME), 'w') as json_file:
+        json.dump(manifest, json_file)
+
+
+def write_cases(filename, cases):
+    """ Write a list of cocktail Elements as a case library XML file.
+
+    Args:
+        filename (str): filename of the XML file
+        cases (list): cocktail Elements to write
+    """
+    with atomic_write(filename) as xml_file:
+        xml_file.write(b"<?xml version='1.0' encoding='UTF-8'?>\n<cocktails>\n")
+        for case in cases:
+            xml_file.write(b'  ' + etree.tostring(case, encoding='UTF-8', xml_declaration=False, with_tail=False))
+            xml_file.write(b'\n')
+        xml_file.write(b'</cocktails>\n')
+
+
+def load_shards(library_dir, manifest):
+    """ Load all the shards of a sharded case library into a single tree.
+
+    Args:
+        library_dir (str): directory of the sharded case library
+        manifest (dict): manifest of the library
+
+    Returns:
+        Element: root cocktails Element with the cases of all categories
+    """
+    cocktails = etree.Element('cocktails')
+    for shard in manifest['shards'].values():
+        cocktails.extend(etree.parse(os.path.join(library_dir, shard['file'])).getroot())
+
+    return cocktails
+
+
+def write_shard(library_dir, manifest, category, cases):
+    """ Rewrite the shard of a single category.
+
+    Args:
+        library_dir (str): directory of the sharded case library
+        manifest (dict): manifest of the library
+        category (str): category of the shard
+        cases (list): cocktail Elements of the category
+    """
+    write_cases(os.path.join(library_dir, manifest['shards'][category]['file']), cases)
+
+
+def summarize_cases(cases):
+    """ Get the vocabularies of a list of cases, as stored in the manifest.
+
+    Args:
+        cases (list): cocktail Elements
+
+    Returns:
+        dict: names, glass types and ingredients (with their number of occurrences) of the cases
+    """
+    ingredients = Counter([(i.text, i.get('alc_type'), i.get('basic_taste'), i.get('measure'),
+                            i.get('quantity'), i.get('unit'))
+                           for c in cases for i in c.findall('ingredients/ingredient')])
+
+    return {'names': [c.find('name').text for c in cases],
+            'glass_types': sorted(set([c.find('glasstype').text for c in cases])),
+            'ingredients': [list(ingr) + [count] for ingr, count in ingredients.items()]}
+
+
+def add_case_to_manifest(manifest, case):
+    """ Update the vocabularies of the manifest with a new case.
+
+    Args:
+        manifest (dict): manifest of the library
+        case (Element): new cocktail Element
+    """
+    shard = manifest['shards'][case.find('category').text]
+    new_summary = summarize_cases([case])
+
+    shard['names'] += new_summary['names']
+    shard['glass_types'] = sorted(set(shard['glass_types'] + new_summary['glass_types']))
+
+    ingredients = Counter({tuple(ingr[:-1]): ingr[-1] for ingr in shard['ingredients']})
+    ingredients.update({tuple(ingr[:-1]): ingr[-1] for ingr in new_summary['ingredients']})
+    shard['ingredients'] = [list(ingr) + [count] for ingr, count in ingredients.items()]
+
+
+class LazyCaseLibrary(Mapping):
+    """ Cases of a case library divided by category, loaded from the storage on first access.
+
+    Loaded categories are cached. When the size of the cached categories exceeds the
+    memory budget, the least recently used categories are evicted.
+    """
+
+    def __init__(self, storage, categories, memory_budget=None):
+        """ Initialize the lazy library.
+
+        Args:
+            storage (CaseStorage): storage of the case library
+            categories (iterable): categories of the library
+            memory_budget (int, optional): maximum size in bytes of the categories kept in
+                                           memory. Defaults to None (no limit).
+        """
+        self.storage = storage
+        self.categories = list(categories)
+        self.memory_budget = memory_budget
+        self._cache = OrderedDict()
+        self._sizes = {}
+        self._indexes = {}
+
+    def __getitem__(self, category):
+        if category not in self.categories:
+            raise KeyError(category)
+
+        # Mark category as the most recently used
+        if category in self._cache:
+            self._cache.move_to_end(category)
+            return self._cache[category]
+
+        self._cache[category] = self.storage.load_category(category)
+        self._sizes[category] = self.storage.category_size(category)
+
+        # Evict least recently used categories, always keeping the requested one
+        while self.memory_budget is not None and len(self._cache) > 1 and \
+                sum(self._sizes.values()) > self.memory_budget:
+            evicted, _ = self._cache.popitem(last=False)
+            self._sizes.pop(evicted)
+            self._indexes.pop(evicted, None)
+
+        return self._cache[category]
+
+    def __contains__(self, category):
+        return category in self.categories
+
+    def __iter__(self):
+        return iter(self.categories)
+
+    def __len__(self):
+        return len(self.categories)
+
+    def find_case(self, category, name):
+        """ Find a case of a category by its name, loading the category if needed.
+
+        The name index of each category is built on first use and extended
+        with the cases appended to the category afterwards.
+
+        Args:
+            category (str): cocktail category
+            name (str): cocktail name
+
+        Returns:
+            Element: cocktail Element, None if there is no case with this name
+        """
+        cases = self[category]
+        index = self._indexes.setdefault(category, {})
+        for case in cases[len(index):]:
+            index[case.find('name').text] = case
+
+        return index.get(name)
+
+    def loaded_categories(self):
+        """ Get the categories currently loaded in memory.
+
+        Returns:
+            list: loaded categories, from the least to the most recently used
+        """
+        return list(self._cache)
+
+
+class CaseStorage(ABC):
+    """ Interface of the persistence of a case library.
+
+    The CBR works on the cocktail Elements returned by the storage and notifies it
+    of every new or modified case so that it is persisted. Modifications are done inside
+    a transaction, which locks the library and reports the changes made by other processes.
+
+    Storages must implement load, add_case, update_case and rewrite. By default the other
+    methods load the whole library, storages that support lazy loading override them.
+    """
+    # Whether the storage can load the cases of a single category
+    supports_lazy = False
+
+    # Whether the storage can prefilter the cases through its indexes with find_cases
+    supports_queries = False
+
+    # Filename of the lock file of the library
+    lock_filename = None
+
+    @contextmanager
+    def transaction(self):
+        """ Lock the case library for a read-modify-write.
+
+        Yields:
+            list: cocktail Elements added or modified by other processes since the last
+                  load, refresh or write of this storage
+        """
+        with file_lock(self.lock_filename):
+            yield self.refresh()
+
+    def refresh(self):
+        """ Get the cases added or modified by other processes.
+
+        Returns:
+            list: cocktail Elements that may have changed (known cases can be included)
+        """
+        return []
+
+    @abstractmethod
+    def load(self):
+        """ Load the whole case library.
+
+        Returns:
+            Element: root cocktails Element with all the cases
+        """
+
+    def load_vocabularies(self):
+        """ Get the vocabularies of each category without loading the cases.
+
+        Returns:
+            dict: names, glass types and ingredients (with their counts) of each category
+        """
+        library_by_category = {}
+        for c in self.load():
+            library_by_category.setdefault(c.find('category').text, []).append(c)
+
+        return {category: summarize_cases(cases) for category, cases in library_by_category.items()}
+
+    def load_category(self, category):
+        """ Load the cases of a single category.
+
+        Args:
+            category (str): cocktail category
+
+        Returns:
+            list: cocktail Elements of the category
+        """
+        return [c for c in self.load() if c.find('category').text == category]
+
+    def load_case(self, name, category):
+        """ Load a single case, without keeping the other cases of its category.
+
+        Args:
+            name (str): cocktail name
+            category (str): cocktail category
+
+        Returns:
+            Element: cocktail Element, None if there is no case with this name
+        """
+        for case in self.load_category(category):
+            if case.find('name').text == name:
+                return case
+
+        return None
+
+    def category_size(self, category):
+        """ Get the approximate size in bytes of the cases of a category.
+
+        Args:
+            category (str): cocktail category
+
+        Returns:
+            int: size in bytes
+        """
+        return sum([len(etree.tostring(c)) for c in self.load_category(category)])
+
+    @abstractmethod
+    def add_case(self, case, category_cases):
+        """ Persist a case added to the library.
+
+        Args:
+            case (Element): new cocktail Element
+            category_cases (list): all the cocktail Elements of its category, including the new one
+        """
+
+    @abstractmethod
+    def update_case(self, case, category_cases):
+        """ Persist the changes (utility, evaluation) of a case of the library.
+
+        Args:
+            case (Element): modified cocktail Element
+            category_cases (list): all the cocktail Elements of its category
+        """
+
+    @abstractmethod
+    def rewrite(self, cocktails):
+        """ Replace the whole case library, e.g. after compacting it.
+
+        Other processes using the library must load it again, since removed cases
+        are not reported by refresh().
+
+        Args:
+            cocktails (Element): root cocktails Element with all the cases to keep
+        """
+
+
+class MemoryStorage(CaseStorage):
+    """ Case library kept in memory and never persisted, e.g. to evaluate a modified library.
+    """
+
+    def __init__(self, cocktails):
+        self.cocktails = cocktails
+
+    @contextmanager
+    def transaction(self):
+        yield []
+
+    def load(self):
+        return self.cocktails
+
+    def add_case(self, case, category_cases):
+        pass
+
+    def update_case(self, case, category_cases):
+        pass
+
+    def rewrite(self, cocktails):
+        self.cocktails = cocktails
+
+
+class XMLStorage(CaseStorage):
+    """ Case library stored in a single XML file, rewritten after each change.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock_filename = filename + LOCK_SUFFIX
+        self.cocktails = None
+        self._signature = None
+
+    def load(self):
+        self._signature = file_signature(self.filename)
+        self.cocktails = etree.parse(self.filename).getroot()
+        return self.cocktails
+
+    def refresh(self):
+        # If the file was rewritten by another process, all its cases are reported
+        signature = file_signature(self.filename)
+        if self._signature is None or signature == self._signature:
+            return []
+
+        self._signature = signature
+        return list(etree.parse(self.filename).getroot())
+
+    def _write(self):
+        et = etree.ElementTree(self.cocktails)
+        with atomic_write(self.filename) as xml_file:
+            et.write(xml_file, pretty_print=True, encoding="UTF-8")
+        self._signature = file_signature(self.filename)
+
+    def add_case(self, case, category_cases):
+        self._write()
+
+    def update_case(self, case, category_cases):
+        self._write()
+
+    def rewrite(self, cocktails):
+        self.cocktails = cocktails
+        self._write()
+
+
+class ShardedXMLStorage(CaseStorage):
+    """ Case library stored in a directory with one XML file per category plus a manifest.
+
+    Only the file of the modified category is rewritten after each change.
+    """
+    supports_lazy = True
+
+    def __init__(self, library_dir):
+        self.library_dir = library_dir
+        self.lock_filename = os.path.join(library_dir, LOCK_SUFFIX)
+        self.manifest = load_manifest(library_dir)
+        self._signatures = {MANIFEST_FILENAME: file_signature(os.path.join(library_dir, MANIFEST_FILENAME))}
+
+    def _shard_path(self, category):
+        return os.path.join(self.library_dir, self.manifest['shards'][category]['file'])
+
+    def _parse_shard(self, category):
+        """ Parse the shard of a category, remembering its signature.
+        """
+        self._signatures[category] = file_signature(self._shard_path(category))
+        return list(etree.parse(self._shard_path(category)).getroot())
+
+    def load(self):
+        cocktails = etree.Element('cocktails')
+        for category in self.manifest['shards']:
+            cocktails.extend(self._parse_shard(category))
+        return cocktails
+
+    def load_vocabularies(self):
+        return self.manifest['shards']
+
+    def load_category(self, category):
+        return self._parse_shard(category)
+
+    def category_size(self, category):
+        return os.path.getsize(self._shard_path(category))
+
+    def refresh(self):
+        # Reload the manifest if another process learned new cases
+        manifest_path = os.path.join(self.library_dir, MANIFEST_FILENAME)
+        if file_signature(manifest_path) != self._signatures[MANIFEST_FILENAME]:
+            self._signatures[MANIFEST_FILENAME] = file_signature(manifest_path)
+            self.manifest = load_manifest(self.library_dir)
+
+        # Only the shards that were loaded and rewritten by another process are reported
+        changed_cases = []
+        for category in self.manifest['shards']:
+            if category in self._signatures and file_signature(self._shard_path(category)) != self._signatures[category]:
+                changed_cases += self._parse_shard(category)
+
+        return changed_cases
+
+    def _write_shard(self, category, category_cases):
+        write_shard(self.library_dir, self.manifest, category, category_cases)
+        self._signatures[category] = file_signature(self._shard_path(category))
+
+    def add_case(self, case, category_cases):
+        self._write_shard(case.find('category').text, category_cases)
+
+        # Keep the vocabularies of the manifest up to date
+        add_case_to_manifest(self.manifest, case)
+        save_manifest(self.library_dir, self.manifest)
+        self._signatures[MANIFEST_FILENAME] = file_signature(os.path.join(self.library_dir, MANIFEST_FILENAME))
+
+    def update_case(self, case, category_cases):
+        self._write_shard(case.find('category').text, category_cases)
+
+    def rewrite(self, cocktails):
+        library_by_category = {category: [] for category in self.manifest['shards']}
+        for c in cocktails:
+            library_by_category.setdefault(c.find('category').text, []).append(c)
+
+        # Keep the shard files of the existing categories and rebuild their vocabularies
+        for category, cases in library_by_category.items():
+            if category not in self.manifest['shards']:
+                used_filenames = [shard['file'] for shard in self.manifest['shards'].values()]
+                self.manifest['shards'][category] = {'file': shard_filename(category, used_filenames)}
+            self.manifest['shards'][category].update(summarize_cases(cases))
+            self._write_shard(category, cases)
+
+        save_manifest(self.library_dir, self.manifest)
+        self._signatures[MANIFEST_FILENAME] = file_signature(os.path.join(self.library_dir, MANIFEST_FILENAME))
+
+
+class SQLiteStorage(CaseStorage):
+    """ Case library stored in a SQLite database with tables for cases, ingredients and steps.
+
+    Categories, ingredients, alcohol types and basic tastes are indexed, and each change
+    is written in its own transaction.
+    """
+    supports_lazy = True
+    supports_queries = True
+
+    def __init__(self, filename):
+        # sqlite3 is only imported when a SQLite case library is used
+        import sqlite3
+
+        self.filename = filename
+        self.lock_filename = filename + LOCK_SUFFIX
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute('PRAGMA foreign_keys = ON')
+
+        # Databases created before change tracking lack the revision column
+        columns = [row[1] for row in self.connection.execute('PRAGMA table_info(cases)')]
+        if columns and 'revision' not in columns:
+            with self.connection:
+                self.connection.execute('ALTER TABLE cases ADD COLUMN revision INTEGER NOT NULL DEFAULT 0')
+
+        self.connection.executescript(SQLITE_SCHEMA)
+        self._revision = self._max_revision()
+
+    def _max_revision(self):
+        """ Get the revision of the last change written to the database.
+        """
+        revision, = self.connection.execute('SELECT COALESCE(MAX(revision), 0) FROM cases').fetchone()
+        return revision
+
+    def _load_cases(self, where='', params=()):
+        """ Build the cocktail Elements of the cases matching a condition.
+
+        Args:
+            where (str, optional): SQL condition over the cases table. Defaults to '' (all cases).
+            params (tuple, optional): parameters of the condition. Defaults to ().
+
+        Returns:
+            list: cocktail Elements
+        """
+        condition = f'WHERE {where}' if where else ''
+        cases = self.connection.execute(
+            f'SELECT id, name, category, glasstype, utility, derivation, evaluation FROM cases {condition} '
+            f'ORDER BY id', params).fetchall()
+
+        ingredients = {}
+        for row in self.connection.execute(
+                f'SELECT case_id, identifier, name, alc_type, basic_taste, measure, quantity, unit '
+                f'FROM ingredients WHERE case_id IN (SELECT id FROM cases {condition}) '
+                f'ORDER BY case_id, position', params):
+            ingredients.setdefault(row[0], []).append(row[1:])
+
+        steps = {}
+        for case_id, text in self.connection.execute(
+                f'SELECT case_id, text FROM steps WHERE case_id IN (SELECT id FROM cases {condition}) '
+                f'ORDER BY case_id, position', params):
+            steps.setdefault(case_id, []).append(text)
+
+        cocktails = []
+        for case_id, name, category, glasstype, utility, derivation, evaluation in cases:
+            cocktail = etree.Element('cocktail')
+            etree.SubElement(cocktail, 'name').text = name
+            etree.SubElement(cocktail, 'category').text = category
+            etree.SubElement(cocktail, 'glasstype').text = glasstype
+
+            ingredients_el = etree.SubElement(cocktail, 'ingredients')
+            for identifier, ingr_name, alc_type, basic_taste, measure, quantity, unit in ingredients.get(case_id, []):
+                ingr = etree.SubElement(ingredients_el, 'ingredient', id=identifier, alc_type=alc_type,
+                                        basic_taste=basic_taste, measure=measure, quantity=quantity, unit=unit)
+                ingr.text = ingr_name
+
+            preparation = etree.SubElement(cocktail, 'preparation')
+            for text in steps.get(case_id, []):
+                etree.SubElement(preparation, 'step').text = text
+
+            etree.SubElement(cocktail, 'utility').text = utility
+            etree.SubElement(cocktail, 'derivation').text = derivation
+            etree.SubElement(cocktail, 'evaluation').text = evaluation
+            cocktails.append(cocktail)
+
+        return cocktails
+
+    def load(self):
+        self._revision = self._max_revision()
+        cocktails = etree.Element('cocktails')
+        cocktails.extend(self._load_cases())
+        return cocktails
+
+    def refresh(self):
+        # Every change increases the revision of the modified case
+        cases = self._load_cases('revision > ?', (self._revision,))
+        self._revision = self._max_revision()
+        return cases
+
+    def load_vocabularies(self):
+        vocabularies = {}
+        for category, in self.connection.execute('SELECT DISTINCT category FROM cases'):
+            vocabularies[category] = {
+                'names': [name for name, in self.connection.execute(
+                    'SELECT name FROM cases WHERE category = ? ORDER BY id', (category,))],
+                'glass_types': [glass for glass, in self.connection.execute(
+                    'SELECT DISTINCT glasstype FROM cases WHERE category = ? ORDER BY glasstype', (category,))],
+                'ingredients': [list(row) for row in self.connection.execute(
+                    'SELECT i.name, i.alc_type, i.basic_taste, i.measure, i.quantity, i.unit, COUNT(*) '
+                    'FROM ingredients i JOIN cases c ON i.case_id = c.id WHERE c.category = ? '
+                    'GROUP BY i.name, i.alc_type, i.basic_taste, i.measure, i.quantity, i.unit', (category,))]}
+
+        return vocabularies
+
+    def load_category(self, category):
+        return self._load_cases('category = ?', (category,))
+
+    def load_case(self, name, category):
+        cases = self._load_cases('name = ?', (name,))
+        return cases[0] if cases else None
+
+    def category_size(self, category):
+        size, = self.connection.execute(
+            'SELECT COALESCE(SUM(LENGTH(i.name) + LENGTH(i.measure)), 0) + '
+            '(SELECT COALESCE(SUM(LENGTH(s.text)), 0) FROM steps s JOIN cases c ON s.case_id = c.id '
+            ' WHERE c.category = ?) '
+            'FROM ingredients i JOIN cases c ON i.case_id = c.id WHERE c.category = ?',
+            (category, category)).fetchone()
+        return size
+
+    def _insert_case(self, case):
+        """ Insert a case (without committing the transaction).
+
+        Args:
+            case (Element): cocktail Element
+        """
+        cursor = self.connection.execute(
+            'INSERT INTO cases (name, category, glasstype, utility, derivation, evaluation, revision) '
+            'VALUES (?, ?, ?, ?, ?, ?, (SELECT COALESCE(MAX(revision), 0) + 1 FROM cases))',
+            [case.find(field).text for field in ['name', 'category', 'glasstype', 'utility',
+                                                 'derivation', 'evaluation']])
+        case_id = cursor.lastrowid
+
+        self.connection.executemany(
+            'INSERT INTO ingredients (case_id, position, identifier, name, alc_type, basic_taste, measure, quantity, '
+            'unit) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            [(case_id, pos, i.get('id'), i.text, i.get('alc_type'), i.get('basic_taste'), i.get('measure'),
+              i.get('quantity'), i.get('unit')) for pos, i in enumerate(case.findall('ingredients/ingredient'))])
+        self.connection.executemany(
+            'INSERT INTO steps (case_id, position, text) VALUES (?, ?, ?)',
+            [(case_id, pos, s.text) for pos, s in enumerate(case.findall('preparation/step'))])
+
+    def import_cases(self, cases):
+        """ Insert many cases in a single transaction.
+
+        Args:
+            cases (iterable): cocktail Elements
+        """
+        with self.connection:
+            for case in cases:
+                self._insert_case(case)
+
+    def add_case(self, case, category_cases):
+        with self.connection:
+            self._insert_case(case)
+        self._revision = self._max_revision()
+
+    def update_case(self, case, category_cases):
+        with self.connection:
+            self.connection.execute('UPDATE cases SET utility = ?, evaluation = ?, '
+                                    'revision = (SELECT MAX(revision) + 1 FROM cases) WHERE name = ?',
+                                    (case.find('utility').text, case.find('evaluation').text, case.find('name').text))
+        self._revision = self._max_revision()
+
+    def rewrite(self, cocktails):
+        names = [c.find('name').text for c in cocktails]
+        stored_names = set([name for name, in self.connection.execute('SELECT name FROM cases')])
+
+        with self.connection:
+            # Remove the cases that are not kept
+            self.connection.executemany('DELETE FROM cases WHERE name = ?',
+                                        [(name,) for name in stored_names.difference(names)])
+
+            for case, name in zip(cocktails, names):
+                if name not in stored_names:
+                    self._insert_case(case)
+                    continue
+
+                # Only the fields modified by the CBR can differ from the stored case
+                self.connection.execute(
+                    'UPDATE cases SET utility = ?, derivation = ?, evaluation = ?, '
+                    'revision = (SELECT MAX(revision) + 1 FROM cases) '
+                    'WHERE name = ? AND (utility IS NOT ? OR derivation IS NOT ? OR evaluation IS NOT ?)',
+                    (case.find('utility').text, case.find('derivation').text, case.find('evaluation').text, name,
+                     case.find('utility').text, case.find('derivation').text, case.find('evaluation').text))
+
+        self._revision = self._max_revision()
+
+    def find_cases(self, categories=(), ingredients=(), alc_types=(), basic_tastes=(), glass_types=(),
+                   exc_ingredients=(), exc_alc_types=(), exc_basic_tastes=()):
+        """ Prefilter the cases through the indexes of the database.
+
+        Args:
+            categories (iterable, optional): the case belongs to one of these categories
+            ingredients (iterable, optional): the case contains all these ingredients
+            alc_types (iterable, optional): the case contains all these alcohol types
+            basic_tastes (iterable, optional): the case contains all these basic tastes
+            glass_types (iterable, optional): the case is served in one of these glasses
+            exc_ingredients (iterable, optional): the case contains none of these ingredients
+            exc_alc_types (iterable, optional): the case contains none of these alcohol types
+            exc_basic_tastes (iterable, optional): the case contains none of these basic tastes
+
+        Returns:
+            list: names of the matching cases
+        """
+        queries = []
+        params = []
+        for column, values in [('category', list(categories)), ('glasstype', list(glass_types))]:
+            if values:
+                queries.append(f'SELECT id FROM cases WHERE {column} IN ({", ".join("?" * len(values))})')
+                params += values
+        for column, values in [('name', ingredients), ('alc_type', alc_types), ('basic_taste', basic_tastes)]:
+            for value in values:
+                queries.append(f'SELECT case_id FROM ingredients WHERE {column} = ?')
+                params.append(value)
+
+        if not queries:
+            queries.append('SELECT id FROM cases')
+
+        # Cases with any excluded ingredient, alcohol type or basic taste
+        exclusions = []
+        for column, values in [('name', list(exc_ingredients)), ('alc_type', list(exc_alc_types)),
+                               ('basic_taste', list(exc_basic_tastes))]:
+            if values:
+                exclusions.append(f'SELECT case_id FROM ingredients WHERE {column} IN ({", ".join("?" * len(values))})')
+                params += values
+
+        query = ' INTERSECT '.join(queries)
+        if exclusions:
+            query += ' EXCEPT ' + ' EXCEPT '.join(exclusions)
+
+        return [name for name, in self.connection.execute(
+            f'SELECT name FROM cases WHERE id IN ({query}) ORDER BY id', params)]
+
+
+def open_storage(path):
+    """ Open the storage of a case library depending on its path.
+
+    Directories are case libraries sharded by category, files with a SQLite extension
+    are SQLite databases and any other file is an XML case library.
+
+    Args:
+        path (str): path of the case library
+
+    Returns:
+        CaseStorage: storage of the case library
+    """
+    if os.path.isdir(path):
+        return ShardedXMLStorage(path)
+    if path.lower().endswith(SQLITE_EXTENSIONS):
+        return SQLiteStorage(path)
+    return XMLStorage(path)
+
+
+def split_case_library(xml_file, library_dir):
+    """ Split an XML case library into one file per category plus a manifest.
+
+    Args:
+        xml_file (str): filename of the XML case library
+        library_dir (str): directory where the sharded case library is created
+    """
+    cocktails = etree.parse(xml_file).getroot()
+
+    # Divide cases by category, keeping the order of the library
+    library_by_category = {}
+    for c in cocktails:
+        library_by_category.setdefault(c.find('category').text, []).append(c)
+
+    os.makedirs(library_dir, exist_ok=True)
+    manifest = {'shards': {}}
+    for category, cases in library_by_category.items():
+        filename = shard_filename(category, [shard['file'] for shard in manifest['shards'].values()])
+        manifest['shards'][category] = {'file': filename, **summarize_cases(cases)}
+        write_shard(library_dir, manifest, category, cases)
+
+    save_manifest(library_dir, manifest)
+
+
+def convert_to_sqlite(xml_file, db_file):
+    """ Import an XML case library into a SQLite database.
+
+    Args:
+        xml_file (str): filename of the XML case library
+        db_file (str): filename of the SQLite database
+    """
+    SQLiteStorage(db_file).import_cases(etree.parse(xml_file).getroot())
+
+
+def parse_arguments():
+    """ Define program input arguments and parse them.
+    """
+    # Create the parser and add arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument(dest='caselibrary', type=str, help="Filepath of the XML case library")
+    parser.add_argument(dest='output', type=str,
+                        help="Directory where the sharded case library is created, or filepath of the "
+                             "SQLite database (.db, .sqlite, .sqlite3)")
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    return args
+
+
+if __name__ == "__main__":
+    """ Convert an XML case library into another storage.
+
+    usage: storage.py [-h] caselibrary output
+    """
+    args = parse_arguments()
+    if args.output.lower().endswith(SQLITE_EXTENSIONS):
+        convert_to_sqlite(args.caselibrary, args.output)
+    else:
+        split_case_library(args.caselibrary, args.output)
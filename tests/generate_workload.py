@@ -0,0 +1,176 @@
+import argparse
+import json
+import os
+import random
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from stats import get_statistics
+
+DATA_PATH = os.path.join(os.path.dirname(__file__), '..', 'Data')
+
+# Maximum number of values of each constraint, the number of values is drawn uniformly from 0 to it
+MAX_VALUES = 3
+
+
+class WorkloadVocabularies:
+    """ Values of each constraint field of a case library, taken from its cached statistics
+    so that the CBR does not need to be loaded.
+    """
+
+    def __init__(self, statistics):
+        """ Initialize the vocabularies from the statistics of a case library.
+
+        Args:
+            statistics (LibraryStatistics): statistics of the case library
+        """
+        # Sorted lists, so that the generated workload only depends on the seed
+        self.categories = sorted(statistics.categories)
+        self.category_counts = [statistics.categories[c] for c in self.categories]
+        self.glass_types = sorted(statistics.glass_types)
+        self.alc_types = sorted(statistics.alc_types)
+        self.basic_tastes = sorted(statistics.basic_tastes)
+        self.ingredients = sorted(statistics.ingredients)
+        self.ingredient_counts = [statistics.ingredients[name] for name in self.ingredients]
+
+        # Alcohol types and basic tastes of all the variants of each ingredient, which can not be excluded
+        # if it is requested
+        self.ingredient_alc_types = {}
+        for alc_type, names in statistics.alc_type_ingredients.items():
+            for name in names:
+                self.ingredient_alc_types.setdefault(name, set()).add(alc_type)
+        self.ingredient_basic_tastes = {}
+        for basic_taste, names in statistics.basic_taste_ingredients.items():
+            for name in names:
+                self.ingredient_basic_tastes.setdefault(name, set()).add(basic_taste)
+
+
+def weighted_sample(rng, values, weights, k):
+    """ Draw k distinct values with probability proportional to their weights.
+
+    Args:
+        rng (random.Random): random generator
+        values (list): values to draw
+        weights (list): weight of each value
+        k (int): number of values
+
+    Returns:
+        list: drawn values
+    """
+    values, weights = list(values), list(weights)
+    sample = []
+    for _ in range(min(k, len(values))):
+        index = rng.choices(range(len(values)), weights=weights)[0]
+        sample.append(values.pop(index))
+        weights.pop(index)
+
+    return sample
+
+
+def generate_constraints(vocabularies, n_sets, seed=0, max_values=MAX_VALUES, exclusion_ratio=1.0,
+                         category_skew=0.0):
+    """ Generate random sets of constraints, one at a time.
+
+    Exclusions never contradict the positive constraints of the same set (directly or through the
+    types of the requested ingredients), so all the sets are valid for the CBR. Ingredients are
+    drawn without repetition, with probability proportional to their number of occurrences in
+    the case library.
+
+    Args:
+        vocabularies (WorkloadVocabularies): values of each constraint field
+        n_sets (int): number of sets of constraints
+        seed (int, optional): seed of the random generator. Defaults to 0.
+        max_values (int, optional): maximum number of values of each constraint. Defaults to MAX_VALUES.
+        exclusion_ratio (float, optional): probability of each exclusion constraint being non-empty.
+                                           Defaults to 1.0.
+        category_skew (float, optional): categories are drawn with probability proportional to their
+                                         number of cases to this power, 0 for uniform. Defaults to 0.0.
+
+    Yields:
+        dict: set of constraints
+    """
+    rng = random.Random(seed)
+    category_weights = [count ** category_skew for count in vocabularies.category_counts]
+
+    def sample(values, excluded=None, weights=None):
+        n_values = rng.randint(0, max_values)
+        if excluded is not None and (rng.random() >= exclusion_ratio or not n_values):
+            return []
+        if weights is not None:
+            values, weights = zip(*[(v, w) for v, w in zip(values, weights) if not excluded or v not in excluded])
+            return weighted_sample(rng, values, weights, n_values)
+        if excluded:
+            values = [v for v in values if v not in excluded]
+        return rng.sample(values, min(n_values, len(values)))
+
+    for i in range(n_sets):
+        constraints = {'name': f'cocktail_{i}'}
+
+        # Categories are drawn with replacement from their weights, repetitions are removed
+        n_categories = rng.randint(0, max_values)
+        categories = rng.choices(vocabularies.categories, weights=category_weights, k=n_categories)
+        constraints['category'] = sorted(set(categories), key=categories.index)
+
+        constraints['glass_type'] = sample(vocabularies.glass_types)
+        constraints['alc_type'] = sample(vocabularies.alc_types)
+        constraints['basic_taste'] = sample(vocabularies.basic_tastes)
+        constraints['ingredients'] = sample(vocabularies.ingredients, weights=vocabularies.ingredient_counts)
+
+        # Types of the requested ingredients, which are also positive constraints
+        alc_types = set(constraints['alc_type'])
+        basic_tastes = set(constraints['basic_taste'])
+        for name in constraints['ingredients']:
+            alc_types.update(vocabularies.ingredient_alc_types.get(name, ()))
+            basic_tastes.update(vocabularies.ingredient_basic_tastes.get(name, ()))
+
+        constraints['exc_ingredients'] = sample(vocabularies.ingredients, set(constraints['ingredients']),
+                                                vocabularies.ingredient_counts)
+        constraints['exc_alc_type'] = sample(vocabularies.alc_types, alc_types)
+        constraints['exc_basic_taste'] = sample(vocabularies.basic_tastes, basic_tastes)
+
+        yield constraints
+
+
+def parse_arguments():
+    """ Define program input arguments and parse them.
+    """
+    # Create the parser and add arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--number', type=int, help="Number of sets of constraints", default=1000)
+    parser.add_argument('-o', '--output', type=str, help="Filepath of the JSONL output, - for stdout", default='-')
+    parser.add_argument('--caselibrary', type=str, help="Filepath of the case library",
+                        default=os.path.join(DATA_PATH, 'case_library.xml'))
+    parser.add_argument('--seed', type=int, help="Seed of the random generator", default=0)
+    parser.add_argument('--max-values', type=int, help="Maximum number of values of each constraint",
+                        default=MAX_VALUES)
+    parser.add_argument('--exclusion-ratio', type=float, help="Probability of each exclusion constraint being non-empty",
+                        default=1.0)
+    parser.add_argument('--category-skew', type=float, default=0.0,
+                        help="Draw the categories proportionally to their number of cases to this power (0 for uniform)")
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    return args
+
+
+if __name__ == "__main__":
+    """ Stream random sets of constraints to a JSONL file, one set per line,
+    which can be used as the input of main.py --batch.
+
+    usage: generate_workload.py [-h] [-n NUMBER] [-o OUTPUT] [--caselibrary CASELIBRARY] [--seed SEED]
+                                [--max-values MAX_VALUES] [--exclusion-ratio EXCLUSION_RATIO]
+                                [--category-skew CATEGORY_SKEW]
+    """
+    args = parse_arguments()
+    vocabularies = WorkloadVocabularies(get_statistics(args.caselibrary))
+    workload = generate_constraints(vocabularies, args.number, args.seed, args.max_values, args.exclusion_ratio,
+                                    args.category_skew)
+
+    output_file = sys.stdout if args.output == '-' else open(args.output, 'w')
+    try:
+        for constraints in workload:
+            output_file.write(json.dumps(constraints) + '\n')
+    finally:
+        if output_file is not sys.stdout:
+            output_file.close()
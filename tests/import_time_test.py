@@ -0,0 +1,59 @@
+import os
+import re
+import subprocess
+import sys
+
+ROOT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Modules imported by a CLI query, and budget of their cumulative import time (in ms)
+# The budget can be overridden with the IMPORT_TIME_BUDGET_MS environment variable
+IMPORT_BUDGETS_MS = {'main': 400, 'cbr': 300}
+
+# Heavy dependencies that must only be imported on demand
+LAZY_MODULES = ['pandas', 'matplotlib', 'numpy', 'sqlite3']
+
+# Number of runs, the fastest one is kept to reduce the noise
+N_RUNS = 5
+
+
+def import_times(module):
+    """ Import a module in a new interpreter with -X importtime.
+
+    Args:
+        module (str): module to import
+
+    Returns:
+        dict: cumulative import time (in us) of each imported module
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            cwd=ROOT_PATH, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+
+    times = {}
+    for line in result.stderr.splitlines():
+        match = re.match(r'import time:\s+\d+ \|\s+(\d+) \|(\s*)(\S+)', line)
+        if match:
+            times[match.group(3)] = int(match.group(1))
+
+    return times
+
+
+failed = False
+for module, budget in IMPORT_BUDGETS_MS.items():
+    budget = float(os.environ.get('IMPORT_TIME_BUDGET_MS', budget))
+    runs = [import_times(module) for _ in range(N_RUNS)]
+    import_time = min([times[module] for times in runs]) / 1000
+
+    print(f'import {module}: {import_time:.1f} ms (budget {budget:.0f} ms)')
+    if import_time > budget:
+        print(f'Error: import {module} exceeds its budget')
+        failed = True
+
+    # Any submodule of a heavy dependency counts
+    heavy = sorted(set([m.split('.')[0] for m in runs[0] if m.split('.')[0] in LAZY_MODULES]))
+    if heavy:
+        print(f'Error: import {module} imports heavy dependencies: {", ".join(heavy)}')
+        failed = True
+
+if failed:
+    sys.exit(1)
+print('Import times within budget!')
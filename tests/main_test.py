@@ -31,11 +31,14 @@ cocktails_cbr.print_ingredients(c)
 print('\nOriginal Preparation:')
 cocktails_cbr.print_preparation(c)
 
-adapted_cocktail, n_changes = cocktails_cbr._adaptation(constraints, c)
-print(f'\n{adapted_cocktail.find("name").text} cocktail adapted after {n_changes} changes')
+adapted_case, n_changes = cocktails_cbr._adaptation(constraints, c)
+print(f'\n{adapted_case.name} cocktail adapted after {n_changes} changes')
 
 # Check adapted failure
-adapted_failure = cocktails_cbr._check_adapted_failure(adapted_cocktail)
+adapted_failure = cocktails_cbr._check_adapted_failure(adapted_case)
+
+# Materialize the adapted case into a cocktail Element
+adapted_cocktail = adapted_case.to_element()
 
 print('\nAdapted Ingredients:')
 cocktails_cbr.print_ingredients(adapted_cocktail)
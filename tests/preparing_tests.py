@@ -1,79 +1,22 @@
-import random
 import os
 import json
 import sys
 
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
-from cbr import CBR
+from stats import get_statistics
+from generate_workload import WorkloadVocabularies, generate_constraints
 
 DATA_PATH = '../Data'
 
-# Create cocktails CBR
-cocktails_cbr = CBR(os.path.join(DATA_PATH, 'case_library.xml'), verbose=True)
+# Vocabularies of the case library, from its cached statistics (the CBR is not loaded)
+vocabularies = WorkloadVocabularies(get_statistics(os.path.join(DATA_PATH, 'case_library.xml')))
 
 number_of_tests = [100, 500, 1000]
 
-n_constraints = 8
-
 for n_tests in number_of_tests:
-    names = [f"cocktail_{i}" for i in range(n_tests)]
-
-    all_tests = {}
-
-    for i in range(n_tests):
-
-        my_dict = {"name": names[i]}
-
-        n_categories, n_glasses, n_alc_types, n_basic_tastes, n_ingredients, n_exc_ingredients, n_exc_alc_types, \
-            n_exc_basic_tastes = [random.randint(0, 3) for i in range(n_constraints)]
-
-        my_dict["category"] = random.sample(cocktails_cbr.categories, n_categories)
-        my_dict["glass_type"] = random.sample(cocktails_cbr.glass_types, n_glasses)
-        my_dict["alc_type"] = random.sample(cocktails_cbr.alcohol_types, n_alc_types)
-        my_dict["basic_taste"] = random.sample(cocktails_cbr.basic_tastes, n_basic_tastes)
-
-        ingredients = random.sample([ingr for ingr in cocktails_cbr.ingredients_list], n_ingredients)
-        if ingredients:
-            my_dict["ingredients"] = [ingr.name for ingr in ingredients]
-        else:
-            my_dict["ingredients"] = []
-
-        exc_ingredients = random.sample([ingr for ingr in cocktails_cbr.ingredients_list], n_exc_ingredients)
-        if exc_ingredients:
-            my_dict["exc_ingredients"] = [ingr.name for ingr in exc_ingredients]
-        else:
-            my_dict["exc_ingredients"] = []
-
-        my_dict["exc_alc_type"] = random.sample(cocktails_cbr.alcohol_types, n_exc_alc_types)
-        my_dict["exc_basic_taste"] = random.sample(cocktails_cbr.basic_tastes, n_exc_basic_tastes)
-
-        # Check contradictions between positive and negative constraints
-        # For each excluded ingredient
-        for ingr in exc_ingredients:
-            # Direct contradiction with the requested ingredients
-            if ingr.name in my_dict["ingredients"]:
-                my_dict["exc_ingredients"].remove(ingr.name)
-
-        # For each excluded alcohol type
-        for a_type in my_dict["exc_alc_type"]:
-            # Direct contradiction with the requested alcohol types
-            if a_type in my_dict["alc_type"]:
-                my_dict["exc_alc_type"].remove(a_type)
-            # Indirect contradiction when some of the requested ingredients has this alcohol type
-            elif a_type in [ingr.alc_type for ingr in exc_ingredients]:
-                my_dict["exc_alc_type"].remove(a_type)
-
-        # For each excluded basic taste
-        for b_taste in my_dict["exc_basic_taste"]:
-            # Direct contradiction with the requested basic tastes
-            if b_taste in my_dict["basic_taste"]:
-                my_dict["exc_basic_taste"].remove(b_taste)
-            # Indirect contradiction when some of the requested ingredients has this basic taste
-            elif b_taste in [ingr.basic_taste for ingr in exc_ingredients]:
-                my_dict["exc_basic_taste"].remove(b_taste)
-
-        # Save this set of constraints to the whole dict
-        all_tests[f"constraints_{i}"] = my_dict
+    # Exclusions that contradict the positive constraints are never generated
+    all_tests = {f"constraints_{i}": constraints
+                 for i, constraints in enumerate(generate_constraints(vocabularies, n_tests, seed=n_tests))}
 
     # Save all the tests' constraints to a json file
     with open(f'{n_tests}_tests_constraints.json', 'w') as tests_file:
@@ -0,0 +1,211 @@
+import hashlib
+import itertools
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from cbr import CBR, HARD_CONSTRAINTS, MAX_RETRIEVE_RETRIES
+from similarity import SIMILARITY_BACKENDS, create_backend
+from storage import convert_to_sqlite, split_case_library
+
+DATA_PATH = os.path.join(os.path.dirname(__file__), '..', 'Data')
+
+# Number of random sets of constraints scored by every backend, and seed of the corpus
+# The number of queries can be overridden with the SIMILARITY_TEST_QUERIES environment variable
+N_QUERIES = 500
+SEED = 0
+
+# Number of seeded queries run in new interpreters with different hash seeds
+N_SEEDED_QUERIES = 50
+HASH_SEEDS = ['1', '2']
+
+
+def random_constraints(cbr, rng):
+    """ Generate a random set of constraints from the vocabularies of a CBR.
+
+    Args:
+        cbr (CBR): initialized CBR
+        rng (random.Random): random generator
+
+    Returns:
+        dict: set of constraints
+    """
+    vocabularies = {'category': cbr.categories, 'glass_type': cbr.glass_types, 'glasstype': cbr.glass_types,
+                    'alc_type': cbr.alcohol_types, 'basic_taste': cbr.basic_tastes,
+                    'ingredients': cbr.ingredient_names, 'exc_ingredients': cbr.ingredient_names,
+                    'exc_alc_type': cbr.alcohol_types, 'exc_basic_taste': cbr.basic_tastes}
+
+    return {key: rng.sample(sorted(values), rng.randint(0, 3)) for key, values in vocabularies.items()}
+
+
+def ranking(cases, sims):
+    """ Order some cases by decreasing similarity, ties by name.
+
+    Args:
+        cases (list): cocktail Elements
+        sims (list): similarity of each case
+
+    Returns:
+        list: (similarity, name) of each case
+    """
+    return sorted([(sim, c.find('name').text) for c, sim in zip(cases, sims)], key=lambda item: (-item[0], item[1]))
+
+
+def compare_backends(cbr, label, n_queries):
+    """ Score a random corpus of constraints with every backend supported by a CBR and
+    compare their similarities and rankings with the reference backend.
+
+    Args:
+        cbr (CBR): initialized CBR
+        label (str): description of the CBR
+        n_queries (int): number of sets of constraints
+
+    Returns:
+        int: number of mismatches
+    """
+    reference = create_backend('reference', cbr)
+    backends = {name: create_backend(name, cbr) for name, backend_class in SIMILARITY_BACKENDS.items()
+                if name != 'reference' and backend_class.supports(cbr)}
+
+    rng = random.Random(SEED)
+    mismatches = dict.fromkeys(backends, 0)
+    for i in range(n_queries):
+        constraints = random_constraints(cbr, rng)
+
+        # Half of the queries filter the cases by their hard constraints, as in strict mode
+        hard_constraints = {key: constraints[key] for key in HARD_CONSTRAINTS} if i % 2 else None
+        expected = ranking(*reference.similarities(constraints, constraints['category'], True,
+                                                   MAX_RETRIEVE_RETRIES, hard_constraints))
+
+        for name, backend in backends.items():
+            # Backends may only return the most similar cases, which must be the first ones of the reference
+            result = ranking(*backend.similarities(constraints, constraints['category'], True,
+                                                   MAX_RETRIEVE_RETRIES, hard_constraints))
+            top = expected[:len(result)]
+            if len(result) < min(len(expected), MAX_RETRIEVE_RETRIES) or \
+                    any(abs(a[0] - b[0]) > backend.tolerance for a, b in zip(result, top)) or \
+                    (backend.tolerance == 0 and result != top):
+                mismatches[name] += 1
+                if mismatches[name] == 1:
+                    print(f'Error: {name} backend differs from the reference for {constraints}')
+
+    for name, n_mismatches in mismatches.items():
+        print(f'{label}, {name} backend: {n_queries - n_mismatches}/{n_queries} queries equal to the reference')
+
+    return sum(mismatches.values()) + compare_retrievals(cbr, label, backends, n_queries)
+
+
+def compare_retrievals(cbr, label, backends, n_queries):
+    """ Check that every backend retrieves the same cases as the reference backend for the same seeds,
+    so that the ties are broken in the same way.
+
+    Args:
+        cbr (CBR): initialized CBR
+        label (str): description of the CBR
+        backends (dict): similarity backends to compare, indexed by name
+        n_queries (int): number of sets of constraints
+
+    Returns:
+        int: number of mismatches
+    """
+    reference = cbr.similarity_backend
+    rng = random.Random(SEED)
+    corpus = [random_constraints(cbr, rng) for _ in range(n_queries)]
+
+    def retrieved_names(backend):
+        cbr.similarity_backend = backend
+        return [[c.find('name').text for c, _ in itertools.islice(cbr._rank_cases(constraints, random.Random(seed)),
+                                                                  MAX_RETRIEVE_RETRIES)]
+                for seed, constraints in enumerate(corpus)]
+
+    try:
+        expected = retrieved_names(create_backend('reference', cbr))
+        n_mismatches = 0
+        for name, backend in backends.items():
+            mismatches = sum([a != b for a, b in zip(expected, retrieved_names(backend))])
+            print(f'{label}, {name} backend: {n_queries - mismatches}/{n_queries} seeded retrievals equal to the reference')
+            n_mismatches += mismatches
+    finally:
+        cbr.similarity_backend = reference
+
+    return n_mismatches
+
+
+def seeded_digest(cbl_filename, n_queries):
+    """ Run seeded queries with the default backend of a lazily loaded library and hash their results.
+
+    Args:
+        cbl_filename (str): path of the case library
+        n_queries (int): number of sets of constraints
+
+    Returns:
+        str: digest of the retrieved and adapted cases
+    """
+    cbr = CBR(cbl_filename, lazy=True)
+    rng = random.Random(SEED)
+    digest = hashlib.sha1()
+    for seed in range(n_queries):
+        constraints = random_constraints(cbr, rng)
+        constraints['name'] = f'cocktail_{seed}'
+        try:
+            retrieved_case, adapted_case, _ = cbr.get_new_case(constraints, seed)
+        except ValueError:
+            continue
+        digest.update(retrieved_case.find('name').text.encode('utf-8'))
+        digest.update(repr([(i.text, i.get('measure')) for i in adapted_case.iter('ingredient')]).encode('utf-8'))
+        digest.update(adapted_case.find('glasstype').text.encode('utf-8'))
+
+    return digest.hexdigest()
+
+
+def compare_hash_seeds(cbl_filename, n_queries):
+    """ Check that seeded queries give the same results in interpreters with different hash seeds.
+
+    Args:
+        cbl_filename (str): path of the case library
+        n_queries (int): number of sets of constraints
+
+    Returns:
+        boolean: True if all the interpreters gave the same results
+    """
+    digests = set()
+    for hash_seed in HASH_SEEDS:
+        result = subprocess.run([sys.executable, os.path.abspath(__file__), '--digest', cbl_filename, str(n_queries)],
+                                env=dict(os.environ, PYTHONHASHSEED=hash_seed), stdout=subprocess.PIPE,
+                                universal_newlines=True, check=True)
+        digests.add(result.stdout.strip())
+
+    print(f'Seeded queries with hash seeds {", ".join(HASH_SEEDS)}: '
+          f'{"identical" if len(digests) == 1 else "different"} results')
+    return len(digests) == 1
+
+
+# Digest of the seeded queries, run by compare_hash_seeds in a new interpreter
+if sys.argv[1:2] == ['--digest']:
+    print(seeded_digest(sys.argv[2], int(sys.argv[3])))
+    sys.exit(0)
+
+n_queries = int(os.environ.get('SIMILARITY_TEST_QUERIES', N_QUERIES))
+failed = compare_backends(CBR(os.path.join(DATA_PATH, 'case_library.xml')), 'In-memory library', n_queries) > 0
+
+# Memory-mapped features of a SQLite copy of the library
+directory = tempfile.mkdtemp()
+try:
+    db_file = os.path.join(directory, 'case_library.db')
+    convert_to_sqlite(os.path.join(DATA_PATH, 'case_library.xml'), db_file)
+    failed |= compare_backends(CBR(db_file, mapped=True), 'Memory-mapped library', n_queries) > 0
+
+    # Lazily loaded sharded library, scored by the reference backend
+    library_dir = os.path.join(directory, 'case_library')
+    split_case_library(os.path.join(DATA_PATH, 'case_library.xml'), library_dir)
+    failed |= not compare_hash_seeds(library_dir, N_SEEDED_QUERIES)
+finally:
+    shutil.rmtree(directory)
+
+if failed:
+    sys.exit(1)
+print('All similarity backends equal to the reference!')
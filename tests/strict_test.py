@@ -0,0 +1,148 @@
+import os
+import random
+import shutil
+import sys
+import tempfile
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from cbr import CBR, HARD_CONSTRAINTS
+from storage import convert_to_sqlite
+
+DATA_PATH = os.path.join(os.path.dirname(__file__), '..', 'Data')
+
+# Number of random sets of constraints and seed of the corpus
+N_QUERIES = 200
+SEED = 0
+
+
+def random_constraints(cbr, rng):
+    """ Generate a random set of constraints from the vocabularies of a CBR.
+
+    Args:
+        cbr (CBR): initialized CBR
+        rng (random.Random): random generator
+
+    Returns:
+        dict: set of constraints
+    """
+    vocabularies = {'category': cbr.categories, 'glass_type': cbr.glass_types, 'alc_type': cbr.alcohol_types,
+                    'basic_taste': cbr.basic_tastes, 'ingredients': cbr.ingredient_names,
+                    'exc_ingredients': cbr.ingredient_names, 'exc_alc_type': cbr.alcohol_types,
+                    'exc_basic_taste': cbr.basic_tastes}
+
+    return {key: rng.sample(sorted(values), rng.randint(0, 3)) for key, values in vocabularies.items()}
+
+
+def compare_find_cases(cbr, corpus):
+    """ Check that the indexed prefilter of a SQLite library finds the same cases as checking each case.
+
+    Args:
+        cbr (CBR): CBR of a SQLite case library, fully loaded
+        corpus (list): sets of constraints
+
+    Returns:
+        int: number of mismatches
+    """
+    mismatches = 0
+    for constraints in corpus:
+        hard_constraints = {key: constraints[key] for key in HARD_CONSTRAINTS}
+        found = cbr.storage.find_cases(constraints['category'], glass_types=constraints['glass_type'],
+                                       exc_ingredients=iter(constraints['exc_ingredients']),
+                                       exc_alc_types=constraints['exc_alc_type'],
+                                       exc_basic_tastes=constraints['exc_basic_taste'])
+        expected = [c.find('name').text for c in cbr.cocktails
+                    if (not constraints['category'] or c.find('category').text in constraints['category'])
+                    and cbr._evaluate_constraints_fulfillment(hard_constraints, c)[0]]
+        if found != expected:
+            mismatches += 1
+            if mismatches == 1:
+                print(f'Error: find_cases differs from the fulfillment checks for {constraints}')
+
+    print(f'SQLite prefilter: {len(corpus) - mismatches}/{len(corpus)} queries equal to the fulfillment checks')
+    return mismatches
+
+
+def check_strict_mode(cbr, soft_cbr, label, corpus):
+    """ Check that a strict CBR retrieves a case that fulfills the hard constraints whenever one of the
+    scored cases does, and the same case as a soft CBR for the same seed otherwise.
+
+    Args:
+        cbr (CBR): strict CBR
+        soft_cbr (CBR): CBR of the same library, without strict mode
+        label (str): description of the CBR
+        corpus (list): sets of constraints
+
+    Returns:
+        int: number of wrong retrievals
+    """
+    n_filtered = n_fallbacks = errors = 0
+    for seed, constraints in enumerate(corpus):
+        hard_constraints = {key: constraints[key] for key in HARD_CONSTRAINTS}
+        scored_cases, _ = soft_cbr._similarities(constraints, constraints['category'], skip_failures=True)
+        fulfillable = any(cbr._evaluate_constraints_fulfillment(hard_constraints, c)[0] for c in scored_cases)
+
+        retrieved = next(cbr._rank_cases(constraints, random.Random(seed)))[0]
+        if fulfillable:
+            n_filtered += 1
+            errors += not cbr._evaluate_constraints_fulfillment(hard_constraints, retrieved)[0]
+        else:
+            n_fallbacks += 1
+            expected = next(soft_cbr._rank_cases(constraints, random.Random(seed)))[0]
+            errors += retrieved.find('name').text != expected.find('name').text
+
+    print(f'{label}: {errors} wrong retrievals in strict mode '
+          f'({n_filtered} queries with fulfilling cases, {n_fallbacks} fallbacks to soft scoring)')
+    return errors if n_filtered and n_fallbacks else errors + 1
+
+
+def compare_strict_retrievals(cbr, expected_cbr, label, corpus):
+    """ Check that a strict CBR retrieves the same cases as a strict in-memory CBR for the same seeds.
+
+    Args:
+        cbr (CBR): strict CBR to check
+        expected_cbr (CBR): strict in-memory CBR
+        label (str): description of the CBR
+        corpus (list): sets of constraints
+
+    Returns:
+        int: number of mismatches
+    """
+    mismatches = 0
+    for seed, constraints in enumerate(corpus):
+        retrieved = next(cbr._rank_cases(constraints, random.Random(seed)))[0].find('name').text
+        expected = next(expected_cbr._rank_cases(constraints, random.Random(seed)))[0].find('name').text
+        mismatches += retrieved != expected
+
+    print(f'{label}: {len(corpus) - mismatches}/{len(corpus)} strict retrievals equal to the in-memory library')
+    return mismatches
+
+
+xml_file = os.path.join(DATA_PATH, 'case_library.xml')
+memory_cbr = CBR(xml_file, strict=True)
+rng = random.Random(SEED)
+corpus = [random_constraints(memory_cbr, rng) for _ in range(N_QUERIES)]
+
+directory = tempfile.mkdtemp()
+try:
+    db_file = os.path.join(directory, 'case_library.db')
+    convert_to_sqlite(xml_file, db_file)
+
+    failed = compare_find_cases(CBR(db_file), corpus) > 0
+
+    # The features backend filters the cases with the inverted index of the in-memory feature store,
+    # the reference backend checks each case and the memory-mapped store checks chunks of bitsets
+    soft_cbr = CBR(xml_file)
+    failed |= check_strict_mode(memory_cbr, soft_cbr, 'In-memory library, features backend', corpus) > 0
+    failed |= check_strict_mode(CBR(xml_file, strict=True, similarity='reference'), soft_cbr,
+                                'In-memory library, reference backend', corpus) > 0
+    failed |= check_strict_mode(CBR(db_file, mapped=True, strict=True), soft_cbr, 'Memory-mapped library', corpus) > 0
+
+    # The reference backend of a lazily loaded SQLite library filters the cases with find_cases
+    failed |= compare_strict_retrievals(CBR(db_file, lazy=True, strict=True), memory_cbr,
+                                        'Lazy SQLite library', corpus) > 0
+finally:
+    shutil.rmtree(directory)
+
+if failed:
+    sys.exit(1)
+print('Strict mode filters the cases correctly!')
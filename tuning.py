@@ -0,0 +1,519 @@
+"""
+
+PW3 - SEL - 2021
+CBR for a cocktail recipe creator
+
+Authors:    Xavier Cucurull Salamero <xavier.cucurull@estudiantat.upc.edu>
+            Daniel Hinjos García <daniel.hinjos@estudiantat.upc.edu>
+            Fernando Vázquez Novoa <fernando.vazquez.novoa@estudiantat.upc.edu>
+            Estela Vázquez-Monjardín Lorenzo <estela.vazquez-monjardin@estudiantat.upc.edu>
+"""
+
+import argparse
+import itertools
+import json
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from cbr import CBR
+
+# Declare FeatureTensors namedtuple(), with the weight independent part of the similarity of each case
+# matrices: incidence matrix (cases, values) of the ingredients, types, glasses and categories of the cases
+# terms: for each set of constraints, the similarity terms counted by feature_counts
+# norms: (constraints, features) number of times each weight is added to the normalization score
+# utilities: (cases,) utility of each case
+# candidates: (constraints, cases) whether the case belongs to the categories of the constraints
+FeatureTensors = namedtuple('FeatureTensors', ['matrices', 'terms', 'norms', 'utilities', 'candidates', 'names'])
+
+# Declare TuningResult namedtuple(), with the retrieval quality of a weight vector
+TuningResult = namedtuple('TuningResult', ['weights', 'top1', 'mean_rank'])
+
+# Decimals kept when comparing similarities, so that rounding errors do not break ties
+SIMILARITY_DECIMALS = 12
+
+# Bytes used while evaluating the similarity of a case for a weight vector and a set of constraints
+# (the float64 similarity and the temporary arrays derived from it)
+BYTES_PER_SIMILARITY = 64
+
+# Bytes of the count of a feature for a case and a set of constraints, built for each block of constraints
+BYTES_PER_COUNT = 8
+
+# Default memory budget of the feature counts and similarities being evaluated, shared by all the worker processes
+MEMORY_BUDGET = 512 * 2**20
+
+# Number of chunks of weight vectors given to each worker process, to balance their load
+CHUNKS_PER_PROCESS = 4
+
+
+def _ingredient_type(cbr, ingredient):
+    """ Get the alcohol type or, for non-alcoholic ingredients, the basic taste used by the similarity.
+
+    Args:
+        cbr (CBR): CBR with the ingredient dicts
+        ingredient (str): ingredient name
+
+    Returns:
+        (str, str): 'alcohol' or 'non-alcohol' and the type of the ingredient (None if unknown)
+    """
+    alc_type = next((k for k in cbr.alcohol_dict if ingredient in cbr.alcohol_dict[k]), None)
+    if alc_type is not None:
+        return 'alcohol', alc_type
+
+    return 'non-alcohol', next((k for k in cbr.basic_dict if ingredient in cbr.basic_dict[k]), None)
+
+
+def _incidence(values_per_case, vocabulary):
+    """ Build a boolean (cases, values) matrix with the values of each case.
+
+    Args:
+        values_per_case (list): set of values of each case
+        vocabulary (dict): column of each value
+
+    Returns:
+        array: (cases, values) incidence matrix
+    """
+    incidence = np.zeros((len(values_per_case), len(vocabulary)), dtype=bool)
+    for c, values in enumerate(values_per_case):
+        incidence[c, [vocabulary[v] for v in values]] = True
+
+    return incidence
+
+
+def _columns(vocabulary, values):
+    """ Get the columns of some values in an incidence matrix.
+
+    Args:
+        vocabulary (dict): column of each value
+        values (list): values to look up, unknown values never match
+
+    Returns:
+        list: columns of the known values
+    """
+    return [vocabulary[v] for v in values if v in vocabulary]
+
+
+def build_feature_tensors(cbr, constraints_list):
+    """ Prepare the matches of each similarity feature between each set of constraints and each case.
+
+    The similarity computed by CBR._compute_similarity for weights w is
+    (counts . w) / (norms . w) * utility (or utility if the normalization score is 0),
+    so these tensors allow scoring any number of weight vectors without parsing the cases again.
+
+    The ingredients, types, glasses and categories of the cases are encoded as incidence matrices,
+    and each set of constraints as the columns its similarity terms count. The dense counts, with
+    one value per set of constraints, case and feature, are only built by feature_counts for the
+    block of constraints being scored.
+
+    Args:
+        cbr (CBR): CBR with the case library (not lazy)
+        constraints_list (list): sets of constraints
+
+    Returns:
+        FeatureTensors: incidence matrices, terms, normalization counts, utilities and candidate cases
+    """
+    features = {name: idx for idx, name in enumerate(cbr.similarity_cases)}
+    cases = list(cbr.cocktails)
+    case_ingredients = [set([i.text for i in c.findall('ingredients/ingredient')]) for c in cases]
+    case_alc_types = [set([i.get('alc_type') for i in c.findall('ingredients/ingredient')]) for c in cases]
+    case_basic_tastes = [set([i.get('basic_taste') for i in c.findall('ingredients/ingredient')]) for c in cases]
+    case_glasses = [set([c.find('glasstype').text]) for c in cases]
+    case_categories = [set([c.find('category').text]) for c in cases]
+
+    # Incidence matrices of the cases and the column of each value in their vocabularies
+    matrices = {}
+    vocabularies = {}
+    for key, values_per_case in [('ingredients', case_ingredients), ('alc_types', case_alc_types),
+                                 ('basic_tastes', case_basic_tastes), ('glasses', case_glasses),
+                                 ('categories', case_categories)]:
+        vocabularies[key] = {v: idx for idx, v in enumerate(sorted(set().union(*values_per_case), key=str))}
+        matrices[key] = _incidence(values_per_case, vocabularies[key])
+
+    terms = []
+    norms = np.zeros((len(constraints_list), len(features)))
+    candidates = np.zeros((len(constraints_list), len(cases)), dtype=bool)
+
+    for q, constraints in enumerate(constraints_list):
+        ingredients = [(ingr, *_ingredient_type(cbr, ingr)) for ingr in constraints.get('ingredients') or []]
+        exc_ingredients = [(ingr, *_ingredient_type(cbr, ingr)) for ingr in constraints.get('exc_ingredients') or []]
+        alc_types = constraints.get('alc_type') or []
+        basic_tastes = constraints.get('basic_taste') or []
+        glasses = constraints.get('glasstype') or []
+        exc_alc_types = constraints.get('exc_alc_type') or []
+        exc_basic_tastes = constraints.get('exc_basic_taste') or []
+
+        # Every ingredient and exclusion adds the ingredient weight to the normalization score
+        norms[q, features['ingr_match']] = len(ingredients) + len(exc_ingredients) + len(exc_alc_types) + \
+            len(exc_basic_tastes)
+        norms[q, features['alc_type_match']] = len(alc_types)
+        norms[q, features['basic_taste_match']] = len(basic_tastes)
+        norms[q, features['glasstype_match']] = 1 if glasses else 0
+
+        categories = constraints.get('category')
+        if categories:
+            candidates[q] = matrices['categories'][:, _columns(vocabularies['categories'], categories)].any(axis=1)
+        else:
+            candidates[q] = True
+
+        # Terms (kind, feature, matrix, columns): 'sum' counts the matching columns and 'any' whether one matches.
+        # An ingredient matches by name or, otherwise, by its alcohol type or basic taste:
+        # ('ingredient', (name feature, type feature), (name columns, type matrix), type columns)
+        query_terms = []
+        for ingr_features, ingr_list in [(('ingr_match', 'ingr_alc_type_match', 'ingr_basic_taste_match'),
+                                          ingredients),
+                                         (('exc_ingr_match', 'exc_ingr_alc_type_match',
+                                           'exc_ingr_basic_taste_match'), exc_ingredients)]:
+            for ingr, itype, ingr_type in ingr_list:
+                type_key = 'alc_types' if itype == 'alcohol' else 'basic_tastes'
+                query_terms.append(('ingredient',
+                                    (features[ingr_features[0]], features[ingr_features[1 if itype == 'alcohol' else 2]]),
+                                    (_columns(vocabularies['ingredients'], [ingr]), type_key),
+                                    _columns(vocabularies[type_key], [ingr_type])))
+
+        for kind, feature, key, values in [('sum', 'alc_type_match', 'alc_types', alc_types),
+                                           ('sum', 'basic_taste_match', 'basic_tastes', basic_tastes),
+                                           ('any', 'glasstype_match', 'glasses', glasses),
+                                           ('sum', 'exc_alc_type', 'alc_types', exc_alc_types),
+                                           ('sum', 'exc_basic_taste', 'basic_tastes', exc_basic_tastes)]:
+            query_terms.append((kind, features[feature], key, _columns(vocabularies[key], values)))
+        terms.append(query_terms)
+
+    utilities = np.array([float(c.find('utility').text) for c in cases])
+    names = [c.find('name').text for c in cases]
+
+    return FeatureTensors(matrices, terms, norms, utilities, candidates, names)
+
+
+def feature_counts(tensors, queries):
+    """ Count the matches of each similarity feature between a block of sets of constraints and each case.
+
+    Args:
+        tensors (FeatureTensors): feature tensors of the constraints and cases
+        queries (slice): block of sets of constraints
+
+    Returns:
+        array: (constraints, cases, features) number of matches of each feature
+    """
+    matrices = tensors.matrices
+    block_terms = tensors.terms[queries]
+    counts = np.zeros((len(block_terms), len(tensors.utilities), tensors.norms.shape[1]))
+
+    for q, query_terms in enumerate(block_terms):
+        for kind, feature, key, columns in query_terms:
+            if kind == 'ingredient':
+                name_match = matrices['ingredients'][:, key[0]].any(axis=1)
+                type_match = ~name_match & matrices[key[1]][:, columns].any(axis=1)
+                counts[q, :, feature[0]] += name_match
+                counts[q, :, feature[1]] += type_match
+            elif kind == 'sum':
+                counts[q, :, feature] = matrices[key][:, columns].sum(axis=1)
+            else:
+                counts[q, :, feature] = matrices[key][:, columns].any(axis=1)
+
+    return counts
+
+
+def score_weights(tensors, weights, queries=slice(None), counts=None):
+    """ Compute the similarities of all the cases for many weight vectors at once.
+
+    Args:
+        tensors (FeatureTensors): feature tensors of the constraints and cases
+        weights (array): (weight vectors, features) weights to score
+        queries (slice, optional): block of sets of constraints to score. Defaults to all of them.
+        counts (array, optional): feature counts of the block, built by feature_counts. Defaults to None (built).
+
+    Returns:
+        array: (weight vectors, constraints, cases) similarities, -inf for cases outside the categories
+    """
+    weights = np.atleast_2d(weights)
+    if counts is None:
+        counts = feature_counts(tensors, queries)
+    sims = np.einsum('qcf,wf->wqc', counts, weights)
+    norms = np.einsum('qf,wf->wq', tensors.norms[queries], weights)[:, :, np.newaxis]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sims = np.where(norms == 0, 1.0, sims / norms) * tensors.utilities
+
+    return np.where(tensors.candidates[queries], sims, -np.inf)
+
+
+def block_sizes(n_queries, n_cases, n_features, memory_budget):
+    """ Get the number of sets of constraints and of weight vectors scored at once within a memory budget.
+
+    The budget holds the feature counts of the block of sets of constraints and the similarities
+    of each (weight vector, constraints) pair of the block.
+
+    Args:
+        n_queries (int): number of sets of constraints
+        n_cases (int): number of cases
+        n_features (int): number of similarity features
+        memory_budget (int): bytes available for the counts and similarities of a block
+
+    Returns:
+        query_chunk (int): number of sets of constraints of a block (at least 1)
+        weight_chunk (int): number of weight vectors of a block (at least 1)
+    """
+    counts_bytes = n_cases * n_features * BYTES_PER_COUNT
+    similarity_bytes = n_cases * BYTES_PER_SIMILARITY
+    query_chunk = min(n_queries, max(1, memory_budget // (counts_bytes + similarity_bytes)))
+    weight_chunk = max(1, (memory_budget - query_chunk * counts_bytes) // (query_chunk * similarity_bytes))
+
+    return query_chunk, weight_chunk
+
+
+def _evaluate_block(tensors, relevant, weights, queries, counts):
+    """ Measure the retrieval quality of some weight vectors for a block of sets of constraints.
+
+    Args:
+        tensors (FeatureTensors): feature tensors of the constraints and cases
+        relevant (array): (constraints, cases) whether each case of the block is a correct answer
+        weights (array): (weight vectors, features) weights to evaluate
+        queries (slice): block of sets of constraints
+        counts (array): feature counts of the block
+
+    Returns:
+        top1 (array): (weight vectors, constraints) probability of retrieving a relevant case first
+        ranks (array): (weight vectors, constraints) expected rank of the first relevant case
+    """
+    sims = np.round(score_weights(tensors, weights, queries, counts), SIMILARITY_DECIMALS)
+
+    # Retrieved case: a random case among the ones with the highest similarity
+    best = sims == sims.max(axis=2, keepdims=True)
+    top1 = (best & relevant).sum(axis=2) / best.sum(axis=2)
+    del best
+
+    # Rank of the first relevant case: cases with higher similarity plus the expected position of the
+    # first relevant case among the n non-relevant and r relevant cases tied with it: n / (r + 1) + 1
+    best_relevant = np.where(relevant, sims, -np.inf).max(axis=2, keepdims=True)
+    greater = (sims > best_relevant).sum(axis=2)
+    tied = sims == best_relevant
+    del sims
+    n_tied_relevant = (tied & relevant).sum(axis=2)
+    n_tied_other = (tied & ~relevant).sum(axis=2)
+    ranks = greater + n_tied_other / (n_tied_relevant + 1) + 1
+
+    # Unreachable relevant cases rank after all the cases
+    ranks = np.where(np.isinf(best_relevant[:, :, 0]), relevant.shape[1] + 1, ranks)
+
+    return top1, ranks
+
+
+def evaluate_weights(tensors, relevant, weights, memory_budget=MEMORY_BUDGET):
+    """ Measure the retrieval quality of many weight vectors against a labelled set.
+
+    Ties between cases are broken randomly by the CBR, so expected values are reported.
+    The feature counts and similarities are computed in blocks of weight vectors and sets of
+    constraints that fit in the memory budget, and only the top1 and rank of each pair are kept.
+
+    Args:
+        tensors (FeatureTensors): feature tensors of the constraints and cases
+        relevant (array): (constraints, cases) whether each case is a correct answer
+        weights (array): (weight vectors, features) weights to evaluate
+        memory_budget (int, optional): bytes available for the counts and similarities. Defaults to MEMORY_BUDGET.
+
+    Returns:
+        top1 (array): (weight vectors,) probability of retrieving a relevant case first
+        mean_rank (array): (weight vectors,) expected rank of the first relevant case
+    """
+    weights = np.atleast_2d(weights)
+    n_queries, n_cases = relevant.shape
+    query_chunk, weight_chunk = block_sizes(n_queries, n_cases, tensors.norms.shape[1], memory_budget)
+
+    top1 = np.zeros(len(weights))
+    rank_sum = np.zeros(len(weights))
+    for q in range(0, n_queries, query_chunk):
+        queries = slice(q, q + query_chunk)
+        counts = feature_counts(tensors, queries)
+        for w in range(0, len(weights), weight_chunk):
+            block_top1, block_ranks = _evaluate_block(tensors, relevant[queries], weights[w:w + weight_chunk],
+                                                      queries, counts)
+            top1[w:w + weight_chunk] += block_top1.sum(axis=1)
+            rank_sum[w:w + weight_chunk] += block_ranks.sum(axis=1)
+
+    return top1 / n_queries, rank_sum / n_queries
+
+
+def grid_weights(base_weights, levels=(0.5, 1.0)):
+    """ Build a grid of weight vectors, keeping the sign of each base weight.
+
+    Args:
+        base_weights (list): current weights, which give the sign of each weight
+        levels (tuple, optional): absolute values of the weights. Defaults to (0.5, 1.0).
+
+    Returns:
+        array: (levels ** features, features) weight vectors
+    """
+    signs = np.sign(base_weights)
+    return np.array(list(itertools.product(levels, repeat=len(base_weights)))) * signs
+
+
+def random_weights(base_weights, n_samples, seed=0):
+    """ Sample random weight vectors, keeping the sign of each base weight.
+
+    Args:
+        base_weights (list): current weights, which give the sign of each weight
+        n_samples (int): number of weight vectors
+        seed (int, optional): seed of the random generator. Defaults to 0.
+
+    Returns:
+        array: (n_samples, features) weight vectors
+    """
+    rng = np.random.default_rng(seed)
+    return rng.uniform(0.0, 1.0, size=(n_samples, len(base_weights))) * np.sign(base_weights)
+
+
+def label_by_fulfillment(cbr, constraints_list):
+    """ Label as relevant the cases of each set of constraints with the fewest unfulfilled constraints.
+
+    Args:
+        cbr (CBR): CBR with the case library (not lazy)
+        constraints_list (list): sets of constraints
+
+    Returns:
+        list: names of the relevant cases of each set of constraints
+    """
+    labels = []
+    for constraints in constraints_list:
+        # Count the unfulfilled constraints of all the candidates at once with the bitsets of the features
+        candidates = sorted(set(cbr.features.rows(constraints.get('category'))))
+        n_errors = cbr.features.unfulfilled(cbr.features.compile_fulfillment(constraints), candidates)
+        labels.append([cbr.features.names[r] for r, n in zip(candidates, n_errors) if n == min(n_errors)])
+
+    return labels
+
+
+def load_labelled_set(filename):
+    """ Load a labelled set of constraints.
+
+    Each entry is either a set of constraints or a dict with the "constraints" and the
+    names of the "relevant" cases. Tests constraints files can be used as they are.
+
+    Args:
+        filename (str): filename of the JSON labelled set
+
+    Returns:
+        constraints_list (list): sets of constraints
+        labels (list): names of the relevant cases of each set of constraints, None if not labelled
+    """
+    with open(filename) as json_file:
+        data = json.load(json_file)
+    entries = list(data.values()) if isinstance(data, dict) else data
+
+    constraints_list = [e['constraints'] if 'constraints' in e else e for e in entries]
+    labels = [e.get('relevant') if 'constraints' in e else None for e in entries]
+
+    return constraints_list, labels
+
+
+# Data shared with the worker processes, set once by their initializer
+_worker_data = {}
+
+
+def _init_worker(tensors, relevant, memory_budget):
+    _worker_data['tensors'] = tensors
+    _worker_data['relevant'] = relevant
+    _worker_data['memory_budget'] = memory_budget
+
+
+def _evaluate_chunk(weights):
+    return evaluate_weights(_worker_data['tensors'], _worker_data['relevant'], weights,
+                            _worker_data['memory_budget'])
+
+
+def tune(cbr, constraints_list, labels, candidate_weights, processes=None, memory_budget=MEMORY_BUDGET):
+    """ Evaluate candidate weight vectors and sort them by retrieval quality.
+
+    Args:
+        cbr (CBR): CBR with the case library (not lazy)
+        constraints_list (list): sets of constraints
+        labels (list): names of the relevant cases of each set of constraints
+        candidate_weights (array): (weight vectors, features) weights to evaluate
+        processes (int, optional): number of worker processes. Defaults to None (one per CPU).
+        memory_budget (int, optional): bytes available for the counts and similarities being evaluated, split
+                                       between the worker processes. Defaults to MEMORY_BUDGET.
+
+    Returns:
+        list: TuningResult of each weight vector, from best to worst (highest top1, then lowest mean rank)
+    """
+    tensors = build_feature_tensors(cbr, constraints_list)
+    name_idx = {name: idx for idx, name in enumerate(tensors.names)}
+    relevant = np.zeros(tensors.candidates.shape, dtype=bool)
+    for q, names in enumerate(labels):
+        relevant[q, [name_idx[name] for name in names if name in name_idx]] = True
+
+    # The memory used by each worker is bounded by its share of the budget, whatever the chunk size
+    processes = processes or os.cpu_count()
+    chunk_size = max(1, -(-len(candidate_weights) // (processes * CHUNKS_PER_PROCESS)))
+    chunks = [candidate_weights[i:i + chunk_size] for i in range(0, len(candidate_weights), chunk_size)]
+    if processes == 1:
+        outputs = [evaluate_weights(tensors, relevant, chunk, memory_budget) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(processes, initializer=_init_worker,
+                                 initargs=(tensors, relevant, memory_budget // processes)) as executor:
+            outputs = list(executor.map(_evaluate_chunk, chunks))
+
+    top1 = np.concatenate([out[0] for out in outputs])
+    mean_rank = np.concatenate([out[1] for out in outputs])
+    order = np.lexsort((mean_rank, -top1))
+
+    return [TuningResult(candidate_weights[i].tolist(), float(top1[i]), float(mean_rank[i])) for i in order]
+
+
+def parse_arguments():
+    """ Define program input arguments and parse them.
+    """
+    # Create the parser and add arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument(dest='caselibrary', type=str, help="Filepath of the case library")
+    parser.add_argument(dest='labelled', type=str,
+                        help="Filepath of the JSON labelled set (unlabelled constraints are labelled with the "
+                             "cases that fulfill most constraints)")
+    parser.add_argument('--search', choices=['grid', 'random'], default='random', help="Search strategy")
+    parser.add_argument('--levels', type=float, nargs='+', default=[0.5, 1.0],
+                        help="Absolute values of the weights in grid search")
+    parser.add_argument('--samples', type=int, default=10000, help="Number of weight vectors in random search")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the random search")
+    parser.add_argument('--processes', type=int, default=os.cpu_count(), help="Number of worker processes")
+    parser.add_argument('--memory-budget', type=int, default=MEMORY_BUDGET // 2**20,
+                        help="Memory (in MB) of the counts and similarities being evaluated, shared by the worker processes")
+    parser.add_argument('--top', type=int, default=5, help="Number of best weight vectors printed")
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    return args
+
+
+if __name__ == "__main__":
+    """ Tune the similarity weights of the CBR offline.
+
+    usage: tuning.py [-h] [--search {grid,random}] [--levels LEVELS [LEVELS ...]] [--samples SAMPLES]
+                     [--seed SEED] [--processes PROCESSES] [--memory-budget MEMORY_BUDGET] [--top TOP]
+                     caselibrary labelled
+    """
+    args = parse_arguments()
+    cbr = CBR(args.caselibrary)
+    constraints_list, labels = load_labelled_set(args.labelled)
+
+    # Label the constraints without relevant cases
+    unlabelled = [q for q, names in enumerate(labels) if names is None]
+    for q, names in zip(unlabelled, label_by_fulfillment(cbr, [constraints_list[q] for q in unlabelled])):
+        labels[q] = names
+
+    if args.search == 'grid':
+        candidate_weights = grid_weights(cbr.similarity_weights_values, args.levels)
+    else:
+        candidate_weights = random_weights(cbr.similarity_weights_values, args.samples, args.seed)
+
+    # The current weights are always evaluated, as a reference
+    candidate_weights = np.vstack([cbr.similarity_weights_values, candidate_weights])
+    results = tune(cbr, constraints_list, labels, candidate_weights, args.processes, args.memory_budget * 2**20)
+
+    current = next(r for r in results if r.weights == list(cbr.similarity_weights_values))
+    print(f'Current weights: top1 {current.top1:.4f}, mean rank {current.mean_rank:.2f}')
+    print(f'Best of {len(results)} weight vectors:')
+    for result in results[:args.top]:
+        weights = ', '.join([f'{w:.3f}' for w in result.weights])
+        print(f'top1 {result.top1:.4f}, mean rank {result.mean_rank:.2f}: [{weights}]')
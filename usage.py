@@ -0,0 +1,188 @@
+"""
+
+PW3 - SEL - 2021
+CBR for a cocktail recipe creator
+
+Authors:    Xavier Cucurull Salamero <xavier.cucurull@estudiantat.upc.edu>
+            Daniel Hinjos García <daniel.hinjos@estudiantat.upc.edu>
+            Fernando Vázquez Novoa <fernando.vazquez.novoa@estudiantat.upc.edu>
+            Estela Vázquez-Monjardín Lorenzo <estela.vazquez-monjardin@estudiantat.upc.edu>
+"""
+
+import json
+import os
+import time
+from collections import Counter
+
+from storage import LOCK_SUFFIX, atomic_write, file_lock
+
+# Name of the retrieval usage of the cases, next to the case library (or inside a sharded case library)
+USAGE_SUFFIX = '.usage.json'
+USAGE_FILENAME = 'usage.json'
+
+
+def usage_filename(cbl_filename):
+    """ Get the filename of the retrieval usage of a case library.
+
+    Args:
+        cbl_filename (str): path of the case library
+
+    Returns:
+        str: filename of the retrieval usage
+    """
+    if os.path.isdir(cbl_filename):
+        return os.path.join(cbl_filename, USAGE_FILENAME)
+    return cbl_filename + USAGE_SUFFIX
+
+
+class CaseUsage:
+    """ Number of times each case has been retrieved and time of its last use.
+
+    Learned cases are used for the first time when they are added to the library,
+    the cases without a recorded use have not been used since the tracking started.
+    """
+
+    def __init__(self, since=None):
+        """ Initialize an empty usage.
+
+        Args:
+            since (float, optional): time when the tracking started. Defaults to None (now).
+        """
+        self.since = time.time() if since is None else since
+        self.retrievals = Counter()
+        self.last_used = {}
+
+    def record_retrieval(self, name, timestamp=None):
+        """ Record that a case has been retrieved.
+
+        Args:
+            name (str): name of the case
+            timestamp (float, optional): time of the retrieval. Defaults to None (now).
+        """
+        self.retrievals[name] += 1
+        self.last_used[name] = time.time() if timestamp is None else timestamp
+
+    def record_addition(self, name, timestamp=None):
+        """ Record that a case has been added to the library, which counts as a use.
+
+        Args:
+            name (str): name of the case
+            timestamp (float, optional): time of the addition. Defaults to None (now).
+        """
+        self.last_used[name] = time.time() if timestamp is None else timestamp
+
+    def last_use(self, name):
+        """ Get the time of the last use of a case.
+
+        Args:
+            name (str): name of the case
+
+        Returns:
+            float: time of the last use, or of the start of the tracking if it has not been used
+        """
+        return self.last_used.get(name, self.since)
+
+    def update(self, other):
+        """ Add the uses recorded by another usage.
+
+        Args:
+            other (CaseUsage): usage to add
+        """
+        self.since = min(self.since, other.since)
+        self.retrievals.update(other.retrievals)
+        for name, timestamp in other.last_used.items():
+            self.last_used[name] = max(self.last_used.get(name, timestamp), timestamp)
+
+    def compact(self, merged, dropped):
+        """ Move the uses of merged cases to the case they are merged into and forget the dropped cases.
+
+        Args:
+            merged (dict): name of the case each merged case is merged into, indexed by its name
+            dropped (list): names of the dropped cases
+        """
+        for name, target in merged.items():
+            self.retrievals[target] += self.retrievals.pop(name, 0)
+            if name in self.last_used:
+                self.last_used[target] = max(self.last_used.get(target, 0.0), self.last_used.pop(name))
+
+        for name in dropped:
+            self.retrievals.pop(name, None)
+            self.last_used.pop(name, None)
+
+    def to_dict(self):
+        return {'since': self.since,
+                'cases': {name: [self.retrievals[name], timestamp] for name, timestamp in self.last_used.items()}}
+
+    @classmethod
+    def from_dict(cls, data):
+        usage = cls(data['since'])
+        for name, (retrievals, timestamp) in data['cases'].items():
+            if retrievals:
+                usage.retrievals[name] = retrievals
+            usage.last_used[name] = timestamp
+
+        return usage
+
+
+def load_usage(cbl_filename):
+    """ Load the retrieval usage of a case library.
+
+    Args:
+        cbl_filename (str): path of the case library
+
+    Returns:
+        CaseUsage: usage of the cases, None if it has never been tracked
+    """
+    try:
+        with open(usage_filename(cbl_filename)) as json_file:
+            return CaseUsage.from_dict(json.load(json_file))
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def save_usage(cbl_filename, usage):
+    """ Add the uses recorded by a process to the retrieval usage of a case library.
+
+    The usage file is locked meanwhile, so that processes sharing the library do not lose uses.
+
+    Args:
+        cbl_filename (str): path of the case library
+        usage (CaseUsage): uses recorded since the last save
+    """
+    filename = usage_filename(cbl_filename)
+
+    # The usage is optional, libraries in read-only directories are not tracked
+    try:
+        with file_lock(filename + LOCK_SUFFIX):
+            stored = load_usage(cbl_filename)
+            if stored is not None:
+                stored.update(usage)
+                usage = stored
+
+            with atomic_write(filename, 'w') as json_file:
+                json.dump(usage.to_dict(), json_file)
+    except OSError:
+        pass
+
+
+def compact_usage(cbl_filename, merged, dropped):
+    """ Update the retrieval usage of a case library after merging and dropping some of its cases.
+
+    Args:
+        cbl_filename (str): path of the case library
+        merged (dict): name of the case each merged case is merged into, indexed by its name
+        dropped (list): names of the dropped cases
+    """
+    filename = usage_filename(cbl_filename)
+
+    try:
+        with file_lock(filename + LOCK_SUFFIX):
+            usage = load_usage(cbl_filename)
+            if usage is None:
+                return
+
+            usage.compact(merged, dropped)
+            with atomic_write(filename, 'w') as json_file:
+                json.dump(usage.to_dict(), json_file)
+    except OSError:
+        pass